@@ -1,31 +1,13 @@
+import argparse
 import time
-import pigpio
-import motoron
+import hal
 import rotary_encoder
 import numpy as np
-from scipy.signal import detrend
-
-# Initialize Motoron
-mc = motoron.MotoronI2C(bus=3)
-mc.reinitialize()
-mc.clear_reset_flag()
-mc.set_error_response(motoron.ERROR_RESPONSE_COAST)
-mc.set_command_timeout_milliseconds(500)
-mc.set_max_acceleration(1, 32767)
-mc.set_max_deceleration(1, 32767)
-mc.clear_motor_fault()
+from scipy.signal import chirp, coherence, csd, welch
 
 # Rotary Encoder Setup
 ENCODER_A = 25
 ENCODER_B = 24
-position = 0
-
-def callback(way):
-    global position
-    position += way
-
-pi = pigpio.pi()
-decoder = rotary_encoder.decoder(pi, ENCODER_A, ENCODER_B, callback)
 
 # Frequency response test parameters
 frequencies = np.logspace(-1, 1.3, num=15)  # ~0.1 Hz to 20 Hz
@@ -34,68 +16,328 @@ duration_per_freq = 4  # cycles
 sample_interval = 0.01  # 100 Hz
 warmup_cycles = 2
 
-# Output data
-gain_phase_data = []
+# Broadband test parameters
+broadband_fs = 200  # Hz
+broadband_f0 = 0.2  # Hz
+broadband_f1 = 20  # Hz
+broadband_duration = 30  # s
+broadband_nperseg = 1024  # samples per Welch segment, ~0.2 Hz resolution at 200 Hz
+min_coherence = 0.6
 
-print("Starting frequency response test...")
+OUTPUT_FILE = "frequency_response_gain_phase.csv"
 
-for freq in frequencies:
-    print(f"Testing frequency: {freq:.2f} Hz")
-    position = 0
-    warmup_time = warmup_cycles / freq
-    test_time = duration_per_freq / freq
 
-    # Warm-up phase
-    start_time = time.time()
-    while time.time() - start_time < warmup_time:
-        t = time.time() - start_time
-        control_input = int(amplitude * np.sin(2 * np.pi * freq * t))
-        mc.set_speed(1, control_input)
-        time.sleep(sample_interval)
+def init_motor():
+    mc = hal.motor_driver(bus=3)
+    mc.reinitialize()
+    mc.clear_reset_flag()
+    mc.set_error_response(hal.ERROR_RESPONSE_COAST)
+    mc.set_command_timeout_milliseconds(500)
+    mc.set_max_acceleration(1, 32767)
+    mc.set_max_deceleration(1, 32767)
+    mc.clear_motor_fault()
+    return mc
+
+
+class Sampler:
+    """Deadline-scheduled sampling of the commanded input and encoder count.
+
+    Buffers are preallocated for `capacity` samples. Deadlines are kept on
+    time.perf_counter() so sleep jitter does not accumulate. Every sample
+    records when the command was actually applied and the count together
+    with the time of the encoder edge that produced it, converted from the
+    pigpio tick to the perf_counter time base. The count is exact at that
+    edge time, not at the moment it was read.
+    """
+
+    def __init__(self, pi, encoder, capacity, period):
+        self.pi = pi
+        self.encoder = encoder
+        self.period = period
+        self.cmd_times = np.empty(capacity)
+        self.inputs = np.empty(capacity)
+        self.counts = np.empty(capacity)
+        self.edge_times = np.empty(capacity)
+        self.n = 0
+        self.missed = 0
+
+    def sync_clock(self, rounds=5):
+        """Map pigpio ticks (us, wrapping at 2**32) onto perf_counter,
+        keeping the exchange with the shortest round trip."""
+        best = None
+        for _ in range(rounds):
+            before = time.perf_counter()
+            tick = self.pi.get_current_tick()
+            after = time.perf_counter()
+            if best is None or after - before < best[0]:
+                best = (after - before, tick, (before + after) / 2)
+        _, self.tick0, self.t0 = best
+
+    def tick_to_time(self, tick):
+        delta = (tick - self.tick0) & 0xFFFFFFFF
+        if delta >= 1 << 31:
+            delta -= 1 << 32
+        return self.t0 + delta / 1e6
+
+    def start(self):
+        self.n = 0
+        self.missed = 0
+        self.sync_clock()
+        self.start_time = time.perf_counter()
+        self.deadline = self.start_time
+        return self.start_time
+
+    def wait(self):
+        """Sleep until the next deadline and return the current time.
+        Deadlines that have already passed are skipped, not bunched up."""
+        self.deadline += self.period
+        now = time.perf_counter()
+        if now > self.deadline:
+            skipped = int((now - self.deadline) / self.period) + 1
+            self.missed += skipped
+            self.deadline += skipped * self.period
+        time.sleep(max(0, self.deadline - time.perf_counter()))
+        return time.perf_counter()
+
+    def record(self, control_input, cmd_time):
+        count, tick = self.encoder.snapshot()
+        i = self.n
+        self.cmd_times[i] = cmd_time
+        self.inputs[i] = control_input
+        self.counts[i] = count
+        self.edge_times[i] = cmd_time if tick is None else self.tick_to_time(tick)
+        self.n += 1
+
+    def input_series(self):
+        """Commanded input and the times it took effect, relative to start."""
+        return self.cmd_times[:self.n] - self.start_time, self.inputs[:self.n].copy()
+
+    def position_series(self):
+        """Encoder count at each distinct edge time, relative to start."""
+        times = self.edge_times[:self.n]
+        counts = self.counts[:self.n]
+        _, first = np.unique(times, return_index=True)
+        return times[first] - self.start_time, counts[first]
+
+    def uniform(self, fs, n):
+        """Input (zero-order hold) and position (linear between edges)
+        resampled onto a uniform grid of n samples at fs."""
+        grid = np.arange(n) / fs
+        t_u, u = self.input_series()
+        t_y, y = self.position_series()
+        held = np.clip(np.searchsorted(t_u, grid, side="right") - 1, 0, len(u) - 1)
+        return grid, u[held], np.interp(grid, t_y, y)
+
+
+def fit_sine(t, y, freq):
+    """Least-squares gain and phase (deg) of y at freq.
+
+    Works on arbitrary, non-uniform sample times. A constant and a linear
+    term are fitted alongside, which replaces detrending (detrend assumes
+    uniformly spaced samples).
+    """
+    omega = 2 * np.pi * freq
+    A = np.vstack([np.sin(omega * t), np.cos(omega * t), np.ones_like(t), t]).T
+    coeffs, _, _, _ = np.linalg.lstsq(A, y, rcond=None)
+    a, b = coeffs[:2]
+    return np.sqrt(a**2 + b**2), np.rad2deg(np.arctan2(b, a))
+
+
+def fit_response(sampler, freq):
+    """Gain and phase of position relative to the input as applied,
+    each fitted on its own timestamps."""
+    t_u, u = sampler.input_series()
+    t_y, y = sampler.position_series()
+    gain_u, phase_u = fit_sine(t_u, u, freq)
+    gain_y, phase_y = fit_sine(t_y, y, freq)
+    phase = (phase_y - phase_u + 180) % 360 - 180
+    return gain_y / gain_u * amplitude, phase
+
+
+def stepped_sine(mc, pi, encoder):
+    """Original test: one frequency at a time with warm-up and rest."""
+    gain_phase_data = []
+
+    for freq in frequencies:
+        print(f"Testing frequency: {freq:.2f} Hz")
+        encoder.set(0)
+        warmup_time = warmup_cycles / freq
+        test_time = duration_per_freq / freq
+
+        # Warm-up phase
+        start_time = time.perf_counter()
+        while time.perf_counter() - start_time < warmup_time:
+            t = time.perf_counter() - start_time
+            control_input = int(amplitude * np.sin(2 * np.pi * freq * t))
+            mc.set_speed(1, control_input)
+            time.sleep(sample_interval)
+
+        # Measurement phase
+        sampler = Sampler(pi, encoder, int(test_time / sample_interval) + 2, sample_interval)
+        start_time = sampler.start()
+        now = start_time
+        while now - start_time < test_time:
+            control_input = int(amplitude * np.sin(2 * np.pi * freq * (now - start_time)))
+            mc.set_speed(1, control_input)
+            sampler.record(control_input, time.perf_counter())
+            now = sampler.wait()
+
+        mc.set_speed(1, 0)
+        time.sleep(1)
+
+        gain, phase = fit_response(sampler, freq)
+        if sampler.missed:
+            print(f"  {sampler.missed} sample deadlines missed")
+        gain_phase_data.append((freq, gain, phase))
+
+    return gain_phase_data
 
-    # Measurement phase
-    local_times = []
-    local_positions = []
-    local_inputs = []
-    start_time = time.time()
 
-    while time.time() - start_time < test_time:
-        t = time.time() - start_time
-        control_input = int(amplitude * np.sin(2 * np.pi * freq * t))
+def chirp_signal(fs, duration, f0, f1):
+    """Logarithmic swept sine from f0 to f1, unit amplitude."""
+    t = np.arange(int(fs * duration)) / fs
+    return chirp(t, f0, duration, f1, method="logarithmic", phi=-90)
+
+
+def multisine_signal(fs, period, f0, f1, periods, iterations=50):
+    """Periodic multisine exciting every FFT bin of one period in [f0, f1].
+
+    Starts from Schroeder phases and lowers the crest factor further by
+    iterative clipping, keeping only the phases of the clipped spectrum.
+    Returns `periods` repetitions of one unit-peak period.
+    """
+    n = int(period)
+    bins = np.arange(n // 2 + 1)
+    freqs = bins * fs / n
+    excited = bins[(freqs >= f0) & (freqs <= f1)]
+    k = np.arange(1, len(excited) + 1)
+
+    spectrum = np.zeros(n // 2 + 1, dtype=complex)
+    spectrum[excited] = np.exp(-1j * np.pi * k * (k - 1) / len(excited))
+    x = np.fft.irfft(spectrum, n)
+
+    for _ in range(iterations):
+        limit = 0.9 * np.max(np.abs(x))
+        clipped = np.fft.rfft(np.clip(x, -limit, limit))
+        spectrum[excited] = np.exp(1j * np.angle(clipped[excited]))
+        candidate = np.fft.irfft(spectrum, n)
+        if crest_factor(candidate) >= crest_factor(x):
+            break
+        x = candidate
+
+    x /= np.max(np.abs(x))
+    return np.tile(x, periods)
+
+
+def crest_factor(x):
+    return np.max(np.abs(x)) / np.sqrt(np.mean(x**2))
+
+
+def run_excitation(mc, pi, encoder, signal, fs):
+    """Play `signal` (unit peak) on motor 1 and record input and position.
+
+    Returns the signal time base and the applied input and encoder count
+    resampled onto it from their actual timestamps.
+    """
+    n = len(signal)
+    sampler = Sampler(pi, encoder, n, 1.0 / fs)
+
+    encoder.set(0)
+    start_time = sampler.start()
+    now = start_time
+    while sampler.n < n:
+        idx = min(int((now - start_time) * fs), n - 1)
+        control_input = int(amplitude * signal[idx])
         mc.set_speed(1, control_input)
-        local_times.append(t)
-        local_positions.append(position)
-        local_inputs.append(control_input)
-        time.sleep(sample_interval)
+        sampler.record(control_input, time.perf_counter())
+        now = sampler.wait()
 
     mc.set_speed(1, 0)
-    time.sleep(1)
+    if sampler.missed:
+        print(f"{sampler.missed} sample deadlines missed")
 
-    # Convert to numpy arrays and detrend
-    t_arr = np.array(local_times)
-    u_arr = detrend(np.array(local_inputs))
-    y_arr = detrend(np.array(local_positions))
+    return sampler.uniform(fs, n)
 
-    # Fit sine and cosine terms to output
-    omega = 2 * np.pi * freq
-    sin_component = np.sin(omega * t_arr)
-    cos_component = np.cos(omega * t_arr)
-    A = np.vstack([sin_component, cos_component]).T
-    coeffs, _, _, _ = np.linalg.lstsq(A, y_arr, rcond=None)
-    a, b = coeffs
-
-    gain = np.sqrt(a**2 + b**2)
-    phase = np.rad2deg(np.arctan2(b, a))
-
-    gain_phase_data.append((freq, gain, phase))
-
-# Save results
-with open("frequency_response_gain_phase.csv", "w") as f:
-    f.write("frequency_hz,gain,phase_deg\n")
-    for freq, gain, phase in gain_phase_data:
-        f.write(f"{freq:.4f},{gain:.4f},{phase:.2f}\n")
-
-# Cleanup
-decoder.cancel()
-pi.stop()
-print("Frequency response gain and phase calculation complete. Results saved to frequency_response_gain_phase.csv")
+
+def estimate_frf(u, y, fs, nperseg, f0, f1, window="hann"):
+    """H1 estimate Pxy/Pxx with coherence over every bin in [f0, f1]."""
+    f, Puu = welch(u, fs, window=window, nperseg=nperseg, detrend="linear")
+    _, Puy = csd(u, y, fs, window=window, nperseg=nperseg, detrend="linear")
+    _, Cuy = coherence(u, y, fs, window=window, nperseg=nperseg, detrend="linear")
+
+    band = (f >= f0) & (f <= f1) & (Puu > 0)
+    H = Puy[band] / Puu[band]
+    return f[band], np.abs(H), np.rad2deg(np.angle(H)), Cuy[band]
+
+
+def broadband(mc, pi, encoder, mode, fs, duration, f0, f1, nperseg, capture=None):
+    if mode == "chirp":
+        signal = chirp_signal(fs, duration, f0, f1)
+        window = "hann"
+        skip = 0
+    else:
+        periods = max(2, int(round(duration * fs / nperseg)))
+        signal = multisine_signal(fs, nperseg, f0, f1, periods + 1)
+        window = "boxcar"  # periodic excitation, one period per segment
+        skip = nperseg  # first period lets transients die out
+
+    print(f"Running {mode} excitation, {len(signal) / fs:.1f} s "
+          f"(crest factor {crest_factor(signal):.2f})")
+    _, u, y = run_excitation(mc, pi, encoder, signal, fs)
+
+    freqs, gain, phase, coh = estimate_frf(u[skip:], y[skip:], fs, nperseg, f0, f1, window)
+    good = coh >= min_coherence
+    print(f"{np.count_nonzero(good)}/{len(freqs)} bins above coherence {min_coherence}")
+    if capture:
+        np.savez(capture, fs=fs, u=u[skip:], y=y[skip:])
+    # Same scale as the stepped test: counts per full-amplitude input.
+    gain = gain * amplitude
+    return list(zip(freqs[good], gain[good], phase[good], coh[good]))
+
+
+def save_results(path, gain_phase_data):
+    with open(path, "w") as f:
+        if gain_phase_data and len(gain_phase_data[0]) == 4:
+            f.write("frequency_hz,gain,phase_deg,coherence\n")
+            for freq, gain, phase, coh in gain_phase_data:
+                f.write(f"{freq:.4f},{gain:.4f},{phase:.2f},{coh:.3f}\n")
+        else:
+            f.write("frequency_hz,gain,phase_deg\n")
+            for freq, gain, phase in gain_phase_data:
+                f.write(f"{freq:.4f},{gain:.4f},{phase:.2f}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Motor 1 frequency response test")
+    parser.add_argument("mode", nargs="?", default="stepped", choices=["stepped", "chirp", "multisine"])
+    parser.add_argument("--fs", type=float, default=broadband_fs)
+    parser.add_argument("--duration", type=float, default=broadband_duration)
+    parser.add_argument("--f0", type=float, default=broadband_f0)
+    parser.add_argument("--f1", type=float, default=broadband_f1)
+    parser.add_argument("--nperseg", type=int, default=broadband_nperseg)
+    parser.add_argument("--capture", help="also save the raw input/position series (.npz) for plant_model.py")
+    args = parser.parse_args()
+
+    mc = init_motor()
+    pi = hal.gpio()
+    decoder = rotary_encoder.decoder(pi, ENCODER_A, ENCODER_B)
+
+    print("Starting frequency response test...")
+    try:
+        if args.mode == "stepped":
+            gain_phase_data = stepped_sine(mc, pi, decoder.counter)
+        else:
+            gain_phase_data = broadband(mc, pi, decoder.counter, args.mode, args.fs,
+                                        args.duration, args.f0, args.f1, args.nperseg,
+                                        args.capture)
+        save_results(OUTPUT_FILE, gain_phase_data)
+    finally:
+        mc.set_speed(1, 0)
+        decoder.cancel()
+        pi.stop()
+
+    print(f"Frequency response gain and phase calculation complete. Results saved to {OUTPUT_FILE}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,9 @@ from tkcalendar import Calendar
 import os
 import csv
 from datetime import datetime
+import racks
+import schedule_compiler
+import Scheduler
 
 SCHEDULE_FILE = "automation_schedule.csv"
 offset = (800-530)/2 - 20 ##sorry for magic numbers, im
@@ -104,7 +107,7 @@ class SchedulerGUI:
             tk.Label(form_frame, text=label, bg="#2e7d32", fg="white").grid(row=i, column=0, sticky="e", padx=5, pady=5)
 
         self.device_var = tk.StringVar()
-        self.device_menu = ttk.Combobox(form_frame, textvariable=self.device_var, values=["motor1", "motor2", "valve1", "valve2"], state="readonly")
+        self.device_menu = ttk.Combobox(form_frame, textvariable=self.device_var, values=racks.load_racks().device_names(), state="readonly")
         self.device_menu.grid(row=0, column=1, padx=5, pady=5)
 
         self.action_var = tk.StringVar()
@@ -145,26 +148,21 @@ class SchedulerGUI:
     def refresh_schedule_table(self):
         for row in self.tree.get_children():
             self.tree.delete(row)
-        if os.path.exists(SCHEDULE_FILE):
-            with open(SCHEDULE_FILE, newline='') as f:
-                reader = csv.DictReader(f)
-                sorted_tasks = sorted(reader, key=lambda row: row["timestamp"])
-                for row in sorted_tasks:
-                    self.tree.insert("", tk.END, values=(row["timestamp"], row["device"], row["action"], row["value"]))
+        schedule = schedule_compiler.load(SCHEDULE_FILE, write=False)
+        for task in schedule.pending(schedule_compiler.read_cursor(SCHEDULE_FILE)):
+            self.tree.insert("", tk.END, values=(task["time"].strftime("%Y-%m-%d %H:%M:%S"), task["device"], task["action"], task["value"]))
 
     def refresh_batch_list(self):
         self.batch_listbox.delete(0, tk.END)
-        if os.path.exists(SCHEDULE_FILE):
-            with open(SCHEDULE_FILE, newline='') as f:
-                reader = csv.DictReader(f)
-                # Filter for batch complete markers only
-                batch_dates = sorted(set(
-                    row["timestamp"].split()[0]
-                    for row in reader
-                    if row["device"] == "system" and row["action"] == "batch_complete"
-                ))
-                for date_str in batch_dates:
-                    self.batch_listbox.insert(tk.END, datetime.strptime(date_str, "%Y-%m-%d").strftime("%B %d"))
+        schedule = schedule_compiler.load(SCHEDULE_FILE, write=False)
+        # Filter for pending batch complete markers only
+        batch_dates = sorted(set(
+            task["time"].date()
+            for task in schedule.pending(schedule_compiler.read_cursor(SCHEDULE_FILE))
+            if task["device"] == "system" and task["action"] == "batch_complete"
+        ))
+        for date in batch_dates:
+            self.batch_listbox.insert(tk.END, date.strftime("%B %d"))
 
     def schedule_batch(self):
         selected_date = self.calendar.get_date()
@@ -176,6 +174,14 @@ class SchedulerGUI:
             messagebox.showerror("Invalid Date", str(e))
             return
 
+        entries = Scheduler.batch_entries(Scheduler.batch_base_date(specifier, dt.month, dt.day))
+        passed = Scheduler.passed_entries(entries, SCHEDULE_FILE)
+        if passed:
+            first = passed[0][0].strftime("%B %d %H:%M")
+            messagebox.showerror("Invalid Date", f"{len(passed)} of the batch's tasks, from {first} on, are at or "
+                                 "before the last task the runner dispatched and would never run.")
+            return
+
         os.system(f"python3 Scheduler.py {specifier} {dt.month} {dt.day}")
         self.refresh_batch_list()
         self.refresh_schedule_table()
@@ -199,6 +205,11 @@ class SchedulerGUI:
             messagebox.showerror("Missing Data", "Please fill in all fields.")
             return
 
+        # The runner only dispatches tasks later than the last one it ran
+        if timestamp.timestamp() <= schedule_compiler.read_cursor(SCHEDULE_FILE):
+            messagebox.showerror("Invalid Time", "The runner has already passed that time.")
+            return
+
         new_task = {"timestamp": timestamp_str, "device": device, "action": action, "value": value}
         file_exists = os.path.exists(SCHEDULE_FILE)
 
@@ -1,158 +1,436 @@
+import itertools
+import logging
 import time
-import csv
-import pigpio
+import hal
 import subprocess
 import psutil
 import os
+import queue
+import threading
+import heartbeat
+import automation_logging
+import metrics
+import motion_queue
+import history
+import persistence
+import racks
+import resources
+import runner_journal
+import sampling_profiler
+import schedule_compiler
 from datetime import datetime
 
-# Setup pigpio and devices
-pi = pigpio.pi()
-
-# Valve (relay) pins
-VALVE_1 = 17
-VALVE_2 = 27
-FAN = 18
-pi.set_mode(FAN, pigpio.OUTPUT)
-pi.set_mode(VALVE_1, pigpio.OUTPUT)
-pi.set_mode(VALVE_2, pigpio.OUTPUT)
-pi.write(FAN, 1)
+log = logging.getLogger("runner")
+
+MOVE_TIMEOUT = 300  # s a controller may take for one move before failing it
+MIN_RESUME = 1.0  # s of watering left below which an interrupted watering is not resumed
+PREPARE_LEAD = float(os.environ.get("WHEATGRASS_PREPARE_LEAD", 10.0))  # s a motor is woken before its task
+
+registry = metrics.Registry()
+dispatch_lateness = registry.histogram("runner_dispatch_lateness_seconds",
+                                       "Delay between a task's scheduled time and its dispatch",
+                                       metrics.LATENESS_BUCKETS, labels=("device",))
+tasks_run = registry.counter("runner_tasks_total", "Tasks dispatched", labels=("device",))
+relay_switches = registry.counter("runner_relay_switches_total", "Relay output switches", labels=("pin",))
+schedule_size = registry.gauge("runner_pending_tasks", "Tasks left in the schedule")
+move_lateness = registry.histogram("runner_move_start_lateness_seconds",
+                                   "Delay between a move's scheduled time and the controller starting it",
+                                   metrics.LATENESS_BUCKETS, labels=("device",))
+loop_timer = metrics.LoopTimer(registry, "runner", 0.05)
+registry.counter("runner_bytes_written_total", "Bytes written to the SD card",
+                 fn=lambda: persistence.STATS.total)
+registry.gauge("runner_bytes_written_per_hour", "Average bytes written per hour",
+               fn=lambda: sum(persistence.STATS.per_hour().values()))
+
 # Check if motor control process is running
-def is_process_running(name):
+def axis_processes(axis):
+    procs = []
     for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
         try:
-            if name in ' '.join(proc.info['cmdline']):
-                return True
+            if axis.matches(proc.info['cmdline'] or []):
+                procs.append(proc)
         except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
             pass
-    return False
-
-def start_motor_control_if_not_running():
-    if not is_process_running("motor1_control.py"):
-        print("Starting Motor1 Controller")
-        subprocess.Popen(["python3", "motor1_control.py"])
-    if not is_process_running("motor2_control.py"):
-        print("Starting Motor2 Controller")
-        subprocess.Popen(["python3", "motor2_control.py"])
-
-# Load all tasks from schedule
-def load_schedule(path):
-    tasks = []
-    if not os.path.exists(path):
-        return tasks
-
-    valid_rows = []
-    updated = False
-
-    with open(path, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            try:
-                task_time = datetime.strptime(row["timestamp"], "%Y-%m-%d %H:%M:%S")
-                value = float(row["value"])
-                tasks.append({
-                    "time": task_time,
-                    "device": row["device"],
-                    "action": row["action"],
-                    "value": value
-                })
-                valid_rows.append(row)
-            except ValueError:
-                print(f"[WARNING] Skipping invalid task: {row}")
-                updated = True
-
-    # If invalid tasks were found, overwrite with cleaned list
-    if updated:
-        with open(path, "w", newline='') as csvfile:
-            fieldnames = ["timestamp", "device", "action", "value"]
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(valid_rows)
-
-    return tasks
-
-
-def save_schedule(path, tasks):
-    with open(path, "w", newline="") as csvfile:
-        fieldnames = ["timestamp", "device", "action", "value"]
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        for task in tasks:
-            writer.writerow({
-                "timestamp": task["time"].strftime("%Y-%m-%d %H:%M:%S"),
-                "device": task["device"],
-                "action": task["action"],
-                "value": task["value"]
-            })
+    return procs
 
-import psutil
-import signal
+def start_motor_control_if_not_running(config):
+    if os.environ.get("WHEATGRASS_SUPERVISED"):
+        return  # supervisor.py owns the motor controllers
+    for axis in config.axes():
+        if not axis_processes(axis):
+            log.info("Starting %s controller", axis.device)
+            subprocess.Popen(["python3", axis.script] + axis.args)
 
-def pause_process_by_name(name):
-    for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
+
+def task_id(task):
+    return f"{task['time']:%Y%m%dT%H%M%S}-{task['device']}"
+
+
+def pause_axis(axis):
+    for proc in axis_processes(axis):
         try:
-            if name in ' '.join(proc.info['cmdline']):
-                proc.suspend()
+            proc.suspend()
         except psutil.Error:
             pass
 
-def resume_process_by_name(name):
-    for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
+def resume_axis(axis):
+    for proc in axis_processes(axis):
         try:
-            if name in ' '.join(proc.info['cmdline']):
-                proc.resume()
+            proc.resume()
         except psutil.Error:
             pass
 
 
-# Run continuously and execute tasks
-try:
-    start_motor_control_if_not_running()
-    schedule_path = "automation_schedule.csv"
-
-    while True:
-        now = datetime.now()
-        tasks = load_schedule(schedule_path)
-        tasks.sort(key=lambda t: t["time"])
-
-        if tasks and tasks[0]["time"] <= now:
-            task = tasks.pop(0)
-            print(f"Running: {task}")
-            if task["device"] == "motor1":
-                resume_process_by_name("motor1_control.py")
-                pause_process_by_name("motor2_control.py")
-                print(f"{now} Moving Motor 1")
-                with open("motor1_target.txt", "w") as f:
-                    f.write(str(task["value"]))
-            elif task["device"] == "motor2":
-                resume_process_by_name("motor2_control.py")
-                pause_process_by_name("motor1_control.py")
-                print(f"{now} Moving Motor 2")
-                with open("motor2_target.txt", "w") as f:
-                    f.write(str(task["value"]))
-            elif task["device"] == "valve1":
-                print(f"{now} Turning Valve 1 on")
-                pi.write(FAN, 0)
-                pi.write(VALVE_1, 1)
-                time.sleep(task["value"])
-                print(f"{now} Turning Valve 1 off")
-                pi.write(VALVE_1, 0)
-                pi.write(FAN, 1)
-            elif task["device"] == "valve2":
-                print(f"{now} Turning Valve 2 on")
-                pi.write(FAN, 0)
-                pi.write(VALVE_2, 1)
-                time.sleep(task["value"])
-                print(f"{now} Turning Valve 2 off")
-                pi.write(VALVE_2, 0)
-                pi.write(FAN, 1)
-
-            save_schedule(schedule_path, tasks)
-
-        time.sleep(0.05)
-
-except KeyboardInterrupt:
-    print("Stopping")
-    pi.write(VALVE_1, 0)
-    pi.write(VALVE_2, 0)
-    pi.stop()
+class RackWorker(threading.Thread):
+    """Runs one rack's tasks in order.
+
+    Every rack has its own worker and queue, so a long watering or move
+    on one rack never delays another. Waterings are handed to the
+    resource manager and may overlap; a move waits until the rack's
+    valves are closed. The rack's motors move at the same time and
+    share its supply through power_budget.py, unless the rack's power
+    config sets concurrent_moves to false; then one motor moves at a
+    time and the others are paused. Moves are queued with the
+    controller and reported when they settle; moves of the same motor
+    run back to back, and a watering waits until the rack's motors
+    have settled. prepare() wakes a motor's controller and checks its
+    driver shortly before a move is due, so the move itself only has
+    to be queued.
+    """
+
+    def __init__(self, rack, stop, outputs, on_done=None, on_start=None):
+        super().__init__(name=f"{rack.name}-worker", daemon=True)
+        self.rack = rack
+        self.stop = stop
+        self.outputs = outputs
+        self.on_done = on_done  # called as on_done(task, status, error) after each task
+        self.on_start = on_start  # called as on_start(task) just before a task actuates anything
+        self.queue = queue.Queue()
+        self.clients = {}  # axis id -> MotorClient
+        self.clients_lock = threading.Lock()
+        self.running = {}  # axis id -> True once resumed, False once paused by this worker
+        self.moving = {}  # axis id -> ids of moves sent and not finished
+        self.moves_done = threading.Condition()
+        self.move_ids = itertools.count(1)
+        # The fan is off (pin low) while any of its valves is open
+        outputs.register(rack.fan, active=0, linger=resources.FAN_LINGER)
+        # Valves switch at once: a deferred opening would shorten the watering
+        for pin in rack.valves.values():
+            outputs.register(pin, active=1, min_dwell=0.0)
+
+    def run(self):
+        while not self.stop.is_set():
+            item = self.queue.get()
+            if item is None:
+                break
+            task, device = item
+            try:
+                pending = self.execute(task, device)
+            except Exception as e:
+                log.exception("Task failed", extra={"task_id": task_id(task)})
+                self.report(task, "failed", str(e))
+            else:
+                if not pending:
+                    self.report(task, "done", None)
+        for client in self.clients.values():
+            client.close()
+
+    def started(self, task):
+        if self.on_start is not None:
+            self.on_start(task)
+
+    def report(self, task, status, error):
+        if self.on_done is not None:
+            self.on_done(task, status, error)
+
+    def client(self, axis):
+        with self.clients_lock:
+            client = self.clients.get(axis.id)
+            if client is None or client.closed:
+                client = self.clients[axis.id] = motion_queue.MotorClient(axis.command_socket)
+            return client
+
+    def set_running(self, axis, running):
+        """Resume or pause axis' controller, skipping the process scan if
+        this worker already left it in that state."""
+        with self.clients_lock:
+            if self.running.get(axis.id) == running:
+                return
+            self.running[axis.id] = running
+        (resume_axis if running else pause_axis)(axis)
+
+    def prepare(self, axis, task):
+        """Wake axis' controller ahead of task and have it check its driver."""
+        threading.Thread(target=self._prepare, args=(axis, task), name=f"{axis.id}-prepare",
+                         daemon=True).start()
+
+    def _prepare(self, axis, task):
+        ctx = {"task_id": task_id(task)}
+        with self.moves_done:
+            busy = [o.device for o in self.rack.motors.values() if o is not axis and self.moving.get(o.id)]
+        if busy and not self.rack.power["concurrent_moves"]:
+            log.debug("Not preparing %s while %s moves", axis.device, ", ".join(busy), extra=ctx)
+            return
+        try:
+            self.set_running(axis, True)
+            reply = self.client(axis).prepare()
+        except (OSError, RuntimeError) as e:
+            log.warning("%s is not ready for its next move: %s", axis.device, e, extra=ctx)
+            return
+        log.info("Prepared %s: VIN %s mV", axis.device, reply.get("vin_mv"), extra=ctx)
+
+    def wait_moves(self, axis):
+        """Block until every move sent to axis has settled or failed."""
+        with self.moves_done:
+            while self.moving.get(axis.id):
+                if self.stop.is_set():
+                    return False
+                self.moves_done.wait(0.5)
+        return True
+
+    def move_events(self, axis, task, move_id, ctx):
+        """The callback that reports task from the events of its move."""
+
+        def on_event(event):
+            if event["event"] == "started":
+                task["started"] = event["started"]
+                move_lateness.observe(event["started"] - task["time"].timestamp(), device=task["device"])
+                log.info("Moving %s to %s", axis.device, event["target"], extra=ctx)
+                return
+            with self.moves_done:
+                self.moving[axis.id].discard(move_id)
+                self.moves_done.notify_all()
+            if event["event"] == "settled":
+                log.info("%s settled at %s", axis.device, event.get("position"), extra=ctx)
+                self.report(task, "done", None)
+            else:
+                self.report(task, "failed", event.get("error"))
+
+        return on_event
+
+    def move(self, axis, task, ctx):
+        move_id = task["move_id"]
+        on_event = self.move_events(axis, task, move_id, ctx)
+        with self.moves_done:
+            self.moving.setdefault(axis.id, set()).add(move_id)
+        try:
+            self.client(axis).move(task["value"], move_id, timeout=MOVE_TIMEOUT, on_event=on_event)
+        except Exception:
+            with self.moves_done:
+                self.moving[axis.id].discard(move_id)
+                self.moves_done.notify_all()
+            raise
+
+    def follow(self, axis, task, ctx):
+        """Report task when its move, sent before the runner restarted,
+        finishes. Returns False if axis' controller no longer has the move:
+        it settled or failed meanwhile, or the controller restarted and
+        resumed it from its checkpoint."""
+        move_id = task.get("move_id")
+        if move_id is None:
+            return False
+        with self.moves_done:
+            self.moving.setdefault(axis.id, set()).add(move_id)
+        client, status = None, None
+        try:
+            self.set_running(axis, True)
+            client = self.client(axis)
+            client.follow(move_id, self.move_events(axis, task, move_id, ctx))
+            status = client.status()
+        except (OSError, RuntimeError) as e:
+            log.warning("Cannot ask %s about move %s: %s", axis.device, move_id, e, extra=ctx)
+        if status and (move_id == status["active"] or move_id in status["queued"]):
+            return True
+        if client is not None and not client.forget(move_id):
+            return True  # finished between follow() and status(), and already reported
+        with self.moves_done:
+            self.moving[axis.id].discard(move_id)
+            self.moves_done.notify_all()
+        return False
+
+    def execute(self, task, device):
+        """Start a task. Returns True if it completes later (a watering or
+        a move), in which case it is reported when the valve closes or the
+        move settles."""
+        ctx = {"task_id": task_id(task)}
+        task["started"] = time.time()
+        log.info("Running: %s", task, extra=ctx)
+        dispatch_lateness.observe((datetime.now() - task["time"]).total_seconds(), device=task["device"])
+        tasks_run.inc(device=task["device"])
+        if device in self.rack.motors:
+            axis = self.rack.motors[device]
+            if not self.outputs.wait_idle(self.rack.valves.values(), self.stop):
+                raise RuntimeError("stopped while waiting for the valves to close")
+            self.set_running(axis, True)
+            if not self.rack.power["concurrent_moves"]:
+                for other in self.rack.motors.values():
+                    if other is not axis and not self.wait_moves(other):
+                        raise RuntimeError(f"stopped while waiting for {other.device}")
+                for other in self.rack.motors.values():
+                    if other is not axis:
+                        self.set_running(other, False)
+            task["move_id"] = f"{task_id(task)}.{next(self.move_ids)}"  # unique even for duplicate rows
+            self.started(task)
+            self.move(axis, task, ctx)
+            return True
+
+        for axis in self.rack.motors.values():
+            if not self.wait_moves(axis):
+                raise RuntimeError(f"stopped while waiting for {axis.device}")
+        pin = self.rack.valves[device]
+        log.info("Turning %s/%s on", self.rack.name, device, extra=ctx)
+
+        def closed():
+            log.info("Turning %s/%s off", self.rack.name, device, extra=ctx)
+            self.report(task, "done", None)
+
+        self.started(task)
+        self.outputs.hold([pin, self.rack.fan], task["value"], closed)
+        return True
+
+    def shutdown(self):
+        self.queue.put(None)
+
+
+def recover(entries, config, workers, journal, archive):
+    """Finish the tasks the last runner left open in its journal. The
+    workers have already switched every output off, closing any valve
+    left open by a crash; waterings with time left are reopened for the
+    remainder and tasks that never started run. A move that started is
+    never sent again, since its target is relative to where the motor
+    was: it is reported when it finishes if its controller is still
+    running it, and recorded as interrupted otherwise."""
+    now = time.time()
+    for task, started in entries:
+        ctx = {"task_id": task_id(task)}
+        try:
+            rack, device = config.resolve(task["device"])
+        except KeyError:
+            journal.end(task, "skipped")
+            continue
+        if started is None:
+            log.warning("Running %s: dispatched before the restart, never started", task, extra=ctx)
+        elif device in rack.valves:
+            remaining = task["value"] - (now - started)
+            if remaining < MIN_RESUME:
+                log.warning("Watering %s was interrupted and is over", task, extra=ctx)
+                journal.end(task, "interrupted")
+                archive.record(task, "interrupted", started, now)
+                continue
+            log.warning("Resuming watering %s for the remaining %.0f s", task, remaining, extra=ctx)
+            task = dict(task, value=remaining)
+        else:
+            task = dict(task, started=started)
+            if workers[rack.name].follow(rack.motors[device], task, ctx):
+                log.warning("Move %s is still running after the restart", task, extra=ctx)
+            else:
+                log.warning("Move %s started before the restart and is no longer queued; "
+                            "not sending it again", task, extra=ctx)
+                journal.end(task, "interrupted")
+                archive.record(task, "interrupted", started, now)
+            continue
+        workers[rack.name].queue.put((task, device))
+
+
+def main():
+    automation_logging.setup_logging("runner")
+    sampling_profiler.install("runner")
+
+    config = racks.load_racks()
+    pi = hal.gpio()
+    stop = threading.Event()
+    outputs = resources.ResourceManager(pi, on_switch=lambda pin, on: relay_switches.inc(pin=pin))
+    archive = history.HistoryStore()
+    journal = runner_journal.Journal()
+    state = persistence.WriteCoalescer(category="schedule")
+    start = time.perf_counter()
+    unfinished = journal.replay()
+    journal.compact()
+
+    def finished(task, status, error):
+        journal.end(task, status)
+        archive.record(task, status)
+
+    workers = {name: RackWorker(rack, stop, outputs, finished, journal.start)
+               for name, rack in config.racks.items()}
+    for worker in workers.values():
+        worker.start()
+    recover(unfinished, config, workers, journal, archive)
+    if unfinished:
+        log.info("Recovered %d unfinished task(s) in %.1f ms", len(unfinished),
+                 (time.perf_counter() - start) * 1000)
+
+    # Run continuously and dispatch due tasks to their rack's worker
+    try:
+        start_motor_control_if_not_running(config)
+        schedule_path = "automation_schedule.csv"
+        alive = heartbeat.Heartbeat("runner")
+        metrics.serve(registry, metrics.PORTS["runner"])
+
+        # The CSV is compiled once per edit; finished tasks stay in it and
+        # the cursor records how far the schedule has been dispatched. The
+        # journal is the durable copy of the cursor, so the file may lag.
+        schedule = schedule_compiler.load(schedule_path, config)
+        cursor = max(schedule_compiler.read_cursor(schedule_path), journal.last_scheduled or -2**63)
+        prepared = cursor  # moves due up to here have been prepared
+        today = datetime.now().date()
+        while True:
+            alive.beat()
+            loop_timer.tick(time.perf_counter())
+            now = datetime.now()
+            if now.date() != today:
+                today = now.date()
+                archive.compact()
+                journal.compact()
+            if not schedule.current(schedule_path):
+                schedule = schedule_compiler.load(schedule_path, config)
+            first = schedule.after(cursor)
+            due = schedule.after(int(now.timestamp()))
+            schedule_size.set(len(schedule) - first)
+
+            if due > first:
+                batch = []
+                for i in range(first, due):
+                    task = schedule.task(i)
+                    try:
+                        rack, device = config.resolve(task["device"])
+                    except KeyError:
+                        log.info("No device for task: %s", task, extra={"task_id": task_id(task)})
+                        archive.record(task, "skipped")  # e.g. batch_complete markers
+                        continue
+                    batch.append((task, rack, device))
+                cursor = int(schedule.times[due - 1])
+                journal.intent([task for task, _, _ in batch], through=cursor)
+                for task, rack, device in batch:
+                    workers[rack.name].queue.put((task, device))
+                schedule_compiler.write_cursor(cursor, schedule_path, state)
+
+            # Wake the controllers of moves coming up within the lead time
+            horizon = int(now.timestamp() + PREPARE_LEAD)
+            if horizon > prepared:
+                for i in range(schedule.after(max(prepared, cursor)), schedule.after(horizon)):
+                    task = schedule.task(i)
+                    try:
+                        rack, device = config.resolve(task["device"])
+                    except KeyError:
+                        continue
+                    if device in rack.motors:
+                        workers[rack.name].prepare(rack.motors[device], task)
+                prepared = horizon
+
+            time.sleep(0.05)
+
+    except KeyboardInterrupt:
+        log.info("Stopping")
+        stop.set()
+        for worker in workers.values():
+            worker.shutdown()
+        outputs.close()
+        archive.close()
+        state.close()
+        journal.close()
+        pi.stop()
+
+
+if __name__ == "__main__":
+    main()
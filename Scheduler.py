@@ -3,93 +3,148 @@ from datetime import datetime, timedelta
 import os
 import sys
 
+import schedule_compiler
+
 FILENAME = "automation_schedule.csv"
+HEADER = ["timestamp", "device", "action", "value"]
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def read_schedule(path):
+    """Read existing schedule into a list and a set for duplicate detection and merging."""
+    # Ensure file has header if missing or empty
+    if not os.path.exists(path) or os.stat(path).st_size == 0:
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(HEADER)
+
+    existing_tasks = set()
+    schedule_rows = []
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        next(reader, None)  # Skip header if present
+        for row in reader:
+            if row:
+                task = (row[0], row[1], row[2], row[3])
+                existing_tasks.add(task)
+                schedule_rows.append(task)
+    return schedule_rows, existing_tasks
+
+
+def batch_entries(base_date, rack=None):
+    """All (timestamp, device, action, value) entries of one grow batch,
+    with the devices namespaced as rack/device if a rack is given."""
+    entries = []
+
+    # Day 1
+    day1 = base_date
+    entries.append((day1.replace(hour=8, minute=45), "motor2", "move", 90))
+    entries.append((day1.replace(hour=8, minute=50), "motor1", "move", 140))
+    entries.append((day1.replace(hour=9, minute=0), "valve2", "on", 60))
+
+    # Valve2 every hour for 48 hours
+    for h in range(1, 48):
+        ts = day1 + timedelta(hours=9 + h)
+        entries.append((ts, "valve2", "on", 60))
+
+    # Motor1 moves 140 every 24 hours at 8:50 AM for 10 days
+    for d in range(1, 10):
+        ts = day1 + timedelta(days=d)
+        entries.append((ts.replace(hour=8, minute=50), "motor1", "move", 140))
+
+    # Day 3 onward: Valve1 on every 3 hours for 7 days (starting from day 3), ending at 9am on day 10
+    day3 = day1 + timedelta(days=2)
+    valve1_end_time = day1 + timedelta(days=9, hours=9)
+    current = day3.replace(hour=0, minute=0)
+    while current < valve1_end_time:
+        entries.append((current, "valve1", "on", 60))
+        current += timedelta(hours=3)
+
+    # Add a batch finished flag at the end of the last day
+    completion_time = day1 + timedelta(days=9, hours=10)
+    entries.append((completion_time, "system", "batch_complete", 1))
+
+    if rack:
+        entries = [(ts, device if device == "system" else f"{rack}/{device}", action, value)
+                   for ts, device, action, value in entries]
+    return entries
+
+
+def batch_base_date(specifier, month, day):
+    """Day 1 of a batch that starts or ends on month/day this year."""
+    base_date = datetime(datetime.now().year, month, day, 0, 0)
+    if specifier == "end":
+        base_date = base_date - timedelta(days=9)
+    return base_date
+
+
+def passed_entries(entries, path=FILENAME):
+    """The entries at or before the runner's dispatch cursor. The runner
+    never goes back, so they would sit in the CSV and never run."""
+    cursor = schedule_compiler.read_cursor(path)
+    return [entry for entry in entries if entry[0].timestamp() <= cursor]
+
+
+def merge_entries(schedule_rows, existing_tasks, entries):
+    """Queue each entry that is not a duplicate, then sort by time."""
+    for timestamp, device, action, value in entries:
+        task = (timestamp.strftime(TIME_FORMAT), device, action, str(value))
+        if task not in existing_tasks:
+            schedule_rows.append(task)
+            existing_tasks.add(task)
+    # The timestamp format sorts chronologically as a string
+    schedule_rows.sort(key=lambda x: x[0])
+    return schedule_rows
 
-# Ensure file has header if missing or empty
-if not os.path.exists(FILENAME) or os.stat(FILENAME).st_size == 0:
-    with open(FILENAME, "w", newline="") as f:
+
+def write_schedule(path, schedule_rows):
+    with open(path, "w", newline="") as f:
         writer = csv.writer(f)
-        writer.writerow(["timestamp", "device", "action", "value"])
-
-# Read existing schedule into a set and list for duplicate detection and merging
-existing_tasks = set()
-schedule_rows = []
-with open(FILENAME, newline="") as f:
-    reader = csv.reader(f)
-    next(reader, None)  # Skip header if present
-    for row in reader:
-        if row:
-            task = (row[0], row[1], row[2], row[3])
-            existing_tasks.add(task)
-            schedule_rows.append(task)
+        writer.writerow(HEADER)
+        writer.writerows(schedule_rows)
+
+
+def main():
+    print("Grass Growing Batch Scheduler")
+
+    if len(sys.argv) not in (4, 5):
+        print("Usage: python3 Scheduler.py <start|end> <month> <day> [rack]")
+        sys.exit(1)
+
+    specifier = sys.argv[1].strip().lower()
+    month = int(sys.argv[2])
+    day = int(sys.argv[3])
+    rack = sys.argv[4] if len(sys.argv) == 5 else None
+
+    if specifier not in ["start", "end"]:
+        print("Invalid specifier. Must be 'start' or 'end'.")
+        sys.exit(1)
+
+    base_date = batch_base_date(specifier, month, day)
+    entries = batch_entries(base_date, rack)
+
+    passed = passed_entries(entries)
+    if passed:
+        print(f"{len(passed)} of the batch's tasks are at or before the last task the runner dispatched,")
+        print("so they would never run:")
+        for timestamp, device, action, value in passed:
+            print(f"  {timestamp.strftime(TIME_FORMAT)} {device} {action} {value}")
+        print("Aborting schedule creation; pick a later date.")
+        sys.exit(2)
+
+    # Warn if base date is in the past
+    if base_date < datetime.now():
+        confirm = input("This schedule starts in the past. Continue? (y/n): ").strip().lower()
+        if confirm != 'y':
+            print("Aborting schedule creation.")
+            sys.exit(0)
+
+    schedule_rows, existing_tasks = read_schedule(FILENAME)
+    merge_entries(schedule_rows, existing_tasks, entries)
+    write_schedule(FILENAME, schedule_rows)
+
+    print("Schedule updated and saved to automation_schedule.csv")
+
 
-# Helper to queue a row if it's not a duplicate
-def add_schedule_entry(timestamp, device, action, value):
-    task = (timestamp.strftime("%Y-%m-%d %H:%M:%S"), device, action, str(value))
-    if task not in existing_tasks:
-        schedule_rows.append(task)
-        existing_tasks.add(task)
-
-print("Grass Growing Batch Scheduler")
-
-if len(sys.argv) != 4:
-    print("Usage: python3 Scheduler.py <start|end> <month> <day>")
-    sys.exit(1)
-
-specifier = sys.argv[1].strip().lower()
-month = int(sys.argv[2])
-day = int(sys.argv[3])
-
-if specifier not in ["start", "end"]:
-    print("Invalid specifier. Must be 'start' or 'end'.")
-    exit(1)
-
-base_date = datetime(datetime.now().year, month, day, 0, 0)
-
-if specifier == "end":
-    base_date = base_date - timedelta(days=9)
-
-# Warn if base date is in the past
-if base_date < datetime.now():
-    confirm = input("This schedule starts in the past. Continue? (y/n): ").strip().lower()
-    if confirm != 'y':
-        print("Aborting schedule creation.")
-        exit(0)
-
-# Day 1
-day1 = base_date
-add_schedule_entry(day1.replace(hour=8, minute=45), "motor2", "move", 90)
-add_schedule_entry(day1.replace(hour=8, minute=50), "motor1", "move", 140)
-add_schedule_entry(day1.replace(hour=9, minute=0), "valve2", "on", 60)
-
-# Valve2 every hour for 48 hours
-for h in range(1, 48):
-    ts = day1 + timedelta(hours=9 + h)
-    add_schedule_entry(ts, "valve2", "on", 60)
-
-# Motor1 moves 140 every 24 hours at 8:50 AM for 10 days
-for d in range(1, 10):
-    ts = day1 + timedelta(days=d)
-    add_schedule_entry(ts.replace(hour=8, minute=50), "motor1", "move", 140)
-
-# Day 3 onward: Valve1 on every 3 hours for 7 days (starting from day 3), ending at 9am on day 10
-day3 = day1 + timedelta(days=2)
-valve1_end_time = day1 + timedelta(days=9, hours=9)
-current = day3.replace(hour=0, minute=0)
-while current < valve1_end_time:
-    add_schedule_entry(current, "valve1", "on", 60)
-    current += timedelta(hours=3)
-
-# Add a batch finished flag at the end of the last day
-completion_time = day1 + timedelta(days=9, hours=10)
-add_schedule_entry(completion_time, "system", "batch_complete", 1)
-
-# Sort all tasks and write full CSV
-schedule_rows.sort(key=lambda x: datetime.strptime(x[0], "%Y-%m-%d %H:%M:%S"))
-with open(FILENAME, "w", newline="") as f:
-    writer = csv.writer(f)
-    writer.writerow(["timestamp", "device", "action", "value"])
-    for task in schedule_rows:
-        writer.writerow(task)
-
-print("Schedule updated and saved to automation_schedule.csv")
+if __name__ == "__main__":
+    main()
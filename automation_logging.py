@@ -0,0 +1,255 @@
+import atexit
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import time
+
+import persistence
+
+LOG_DIR = os.environ.get("WHEATGRASS_LOG_DIR",
+                         os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs"))
+MAX_BYTES = 5 * 1024 * 1024
+MAX_AGE = 24 * 3600  # s, rotate daily even if the size limit is not reached
+BACKUP_COUNT = 10
+QUEUE_SIZE = 10000
+RATE_LIMIT = 1.0  # records per second per rate_key or message template
+RATE_BURST = 5
+WRITE_BUFFER = 64 * 1024  # bytes of records held between flushes
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the component context."""
+
+    FIELDS = ("component", "axis", "task_id")
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "component": getattr(record, "component", None),
+            "msg": record.getMessage(),
+        }
+        for field in self.FIELDS[1:]:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        dropped = getattr(record, "dropped", 0)
+        if dropped:
+            entry["dropped"] = dropped
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, separators=(",", ":"), default=str)
+
+
+class ContextFilter(logging.Filter):
+    """Stamps every record with the component and axis of this process."""
+
+    def __init__(self, component, axis=None):
+        super().__init__()
+        self.component = component
+        self.axis = axis
+
+    def filter(self, record):
+        if not hasattr(record, "component"):
+            record.component = self.component
+        if self.axis is not None and not hasattr(record, "axis"):
+            record.axis = self.axis
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per (component, rate_key).
+
+    Records logged without extra={"rate_key": ...} share a bucket per
+    (component, logger, message template), so a warning repeated in a
+    loop, such as an I2C retry, is limited too. Errors are limited only
+    if they carry a rate_key. The number of dropped records is attached
+    to the next one let through.
+    """
+
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+
+    def filter(self, record):
+        key = getattr(record, "rate_key", None)
+        if key is None:
+            if record.levelno >= logging.ERROR:
+                return True
+            key = (record.name, record.msg)
+        key = (getattr(record, "component", None), key)
+        now = time.monotonic()
+        tokens, last, dropped = self.buckets.get(key, (self.burst, now, 0))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now, dropped + 1)
+            return False
+        record.suppressed = dropped
+        self.buckets[key] = (tokens - 1, now, 0)
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Drops records instead of blocking when the writer falls behind.
+    The number dropped is attached to the next record that is queued."""
+
+    dropped = 0  # since the process started
+    reported = 0
+
+    def enqueue(self, record):
+        pending = self.dropped - self.reported
+        if pending:
+            record.dropped = pending
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        else:
+            self.reported += pending
+
+    def prepare(self, record):
+        # The formatter runs in the listener thread; only freeze the message here.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Rotates on size or age and gzips the rotated files.
+
+    Records are buffered and written out once per flush_interval, or at
+    once for warnings and errors, instead of after every record.
+    """
+
+    def __init__(self, filename, max_bytes=MAX_BYTES, max_age=MAX_AGE, backup_count=BACKUP_COUNT,
+                 flush_interval=persistence.FLUSH_INTERVAL):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+        self.max_age = max_age
+        self.flush_interval = flush_interval
+        self.flushed_at = time.monotonic()
+        self.synced_size = 0
+        try:
+            self.opened_at = os.stat(filename).st_mtime
+        except FileNotFoundError:
+            self.opened_at = time.time()
+        self.namer = lambda name: name + ".gz"
+        self.rotator = self._compress
+
+    @staticmethod
+    def _compress(source, dest):
+        with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+    def _open(self):
+        stream = open(self.baseFilename, self.mode, buffering=WRITE_BUFFER, encoding=self.encoding,
+                      errors=self.errors)
+        self.synced_size = stream.tell()
+        return stream
+
+    def emit(self, record):
+        super().emit(record)
+        if record.levelno >= logging.WARNING:
+            self.sync()
+
+    def flush(self):
+        # Called after every record; only write out once per interval
+        if time.monotonic() - self.flushed_at >= self.flush_interval:
+            self.sync()
+
+    def sync(self):
+        self.acquire()
+        try:
+            super().flush()
+            self.flushed_at = time.monotonic()
+            if self.stream:
+                size = self.stream.tell()
+                if size > self.synced_size:
+                    persistence.STATS.add("logs", size - self.synced_size)
+                self.synced_size = size
+        finally:
+            self.release()
+
+    def close(self):
+        self.sync()
+        super().close()
+
+    def shouldRollover(self, record):
+        if time.time() - self.opened_at >= self.max_age:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        self.sync()
+        super().doRollover()
+        self.opened_at = time.time()
+
+
+class BufferedQueueListener(logging.handlers.QueueListener):
+    """Flushes the handlers whenever the queue has been idle for
+    flush_interval, so buffered records do not wait for the next one."""
+
+    def __init__(self, queue, *handlers, flush_interval=persistence.FLUSH_INTERVAL, **kwargs):
+        super().__init__(queue, *handlers, **kwargs)
+        self.flush_interval = flush_interval
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, self.flush_interval)
+            except queue.Empty:
+                for handler in self.handlers:
+                    getattr(handler, "sync", handler.flush)()
+
+
+_listener = None
+
+
+def setup_logging(component, axis=None, level=logging.INFO, console=False):
+    """Route all logging of this process through a queue to
+    logs/<component>.log and return the component's logger.
+
+    The calling thread only pays for filtering and a put_nowait(); JSON
+    formatting, file writes, rotation and compression happen in a
+    background listener thread.
+    """
+    global _listener
+    if _listener is not None:
+        return logging.getLogger(component)
+
+    os.makedirs(LOG_DIR, exist_ok=True)
+    file_handler = CompressingRotatingFileHandler(os.path.join(LOG_DIR, f"{component}.log"))
+    file_handler.setFormatter(JsonFormatter())
+    handlers = [file_handler]
+    if console:
+        stream = logging.StreamHandler()
+        stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+        handlers.append(stream)
+
+    q = queue.Queue(QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(q)
+    queue_handler.addFilter(ContextFilter(component, axis))
+    queue_handler.addFilter(RateLimitFilter())
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers[:] = [queue_handler]
+
+    _listener = BufferedQueueListener(q, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return logging.getLogger(component)
@@ -1,101 +1,183 @@
+import argparse
 import time
-import pigpio
-import motoron
+import numpy as np
+import hal
+import plant_model
 import rotary_encoder
 
-ENCODER_A = 25
-ENCODER_B = 24
-ENCODER_GAIN = 0.01
-
-position = 0
-def callback(way):
-    global position
-    position += way
-
-# Init pigpio and encoder
-pi = pigpio.pi()
-pi.set_mode(ENCODER_A, pigpio.INPUT)
-pi.set_mode(ENCODER_B, pigpio.INPUT)
-pi.set_pull_up_down(ENCODER_A, pigpio.PUD_UP)
-pi.set_pull_up_down(ENCODER_B, pigpio.PUD_UP)
-decoder = rotary_encoder.decoder(pi, ENCODER_A, ENCODER_B, callback)
-
-# Init motor
-mc = motoron.MotoronI2C(bus=3)
-mc.reinitialize()
-mc.clear_reset_flag()
-mc.set_error_response(motoron.ERROR_RESPONSE_COAST)
-mc.set_command_timeout_milliseconds(500)
-mc.set_max_acceleration(1, 150)
-mc.set_max_deceleration(1, 300)
-mc.clear_motor_fault()
-
-# PID test target
-target_position = 50  # mm
-
-# Tuning parameters
-Ku = 0.0
-Pu = None
-P = 200.0  # start from low P
-step = 100.0
-max_P = 1000
-oscillation_threshold = 1.0  # mm
-sample_interval = 0.01
-
-print("Starting autotune...")
-
-try:
-    while P <= max_P:
-        print(f"Testing P={P:.2f}")
-        position = 0
-        history = []
-        start_time = time.time()
-        last_error_sign = None
-        zero_crossings = []
-        period_detected = False
-
-        while time.time() - start_time < 15:  # 10 second test
-            current_position = position * ENCODER_GAIN
-            error = target_position - current_position
-            control = -P * error
-            control = max(min(int(control), 800), -800)
-            mc.set_speed(1, control)
-            print(f"current position {current_position}, target: {target_position}, speed: {control}")
-            history.append((time.time() - start_time, current_position))
-
-            sign = error > 0
-            if last_error_sign is not None and sign != last_error_sign:
-                zero_crossings.append(time.time())
-                if len(zero_crossings) >= 6:
-                    period = (zero_crossings[-1] - zero_crossings[-5]) / 5
-                    Pu = period
-                    Ku = P
-                    period_detected = True
-                    break
-            last_error_sign = sign
-
+# Per-axis hardware, matching motor1_control.py and motor2_control.py.
+# sign is the direction of the speed command that increases the count.
+AXES = {
+    "motor1": {"channel": 1, "encoder_a": 24, "encoder_b": 25, "encoder_gain": 0.01127088464,
+               "sign": -1, "max_acceleration": 150, "max_deceleration": 300},
+    "motor2": {"channel": 2, "encoder_a": 26, "encoder_b": 21, "encoder_gain": 0.45,
+               "sign": 1, "max_acceleration": 20, "max_deceleration": 500},
+}
+
+# Relay experiment parameters
+relay_amplitude = 400  # speed units
+hysteresis = 0.5  # position units (mm or deg)
+travel_limit = 20  # abort if the axis strays this far from the start position
+timeout = 20  # s
+warmup_switches = 2
+measure_cycles = 3
+sample_interval = 0.005
+
+# Model-based tuning parameters
+target_position = 50  # simulated step, position units
+settle_tolerance = 1.0
+
+
+def suggest_gains(Ku, Pu):
+    Kp = 0.6 * Ku
+    Ki = 2 * Kp / Pu
+    Kd = Kp * Pu / 8
+    return Kp, Ki, Kd
+
+
+def print_gains(Kp, Ki, Kd):
+    print("Suggested PID gains:")
+    print(f"Kp = {Kp:.3f}, Ki = {Ki:.3f}, Kd = {Kd:.3f}")
+
+
+def tick_diff(later, earlier):
+    """Seconds between two pigpio ticks, which wrap at 2**32 us."""
+    return ((later - earlier) & 0xFFFFFFFF) / 1e6
+
+
+def relay_experiment(mc, encoder, axis):
+    """Astrom-Hagglund relay test around the current position.
+
+    The motor is driven at +/- relay_amplitude, switching when the error
+    crosses +/- hysteresis. Once the limit cycle has settled, the period
+    is measured between upward switches, timed by the encoder edge ticks,
+    and the amplitude from the position peaks. Returns (Ku, Pu), or
+    (None, None) if the safety envelope or timeout was hit.
+    """
+    channel = axis["channel"]
+    gain = axis["encoder_gain"]
+
+    count, _ = encoder.snapshot()
+    setpoint = count * gain
+    relay = 1
+    switches = []  # (tick, direction)
+    peaks = []
+    low = high = setpoint
+
+    start_time = time.time()
+    try:
+        while time.time() - start_time < timeout:
+            count, tick = encoder.snapshot()
+            position = count * gain
+            error = setpoint - position
+
+            if abs(position - setpoint) > travel_limit:
+                print(f"Aborting: position {position:.2f} outside safety envelope")
+                return None, None
+
+            low = min(low, position)
+            high = max(high, position)
+
+            if relay > 0 and error < -hysteresis:
+                relay = -1
+                switches.append((tick, relay))
+                peaks.append(high)
+                high = position
+            elif relay < 0 and error > hysteresis:
+                relay = 1
+                switches.append((tick, relay))
+                peaks.append(low)
+                low = position
+
+            ups = [t for t, d in switches[warmup_switches:] if d > 0 and t is not None]
+            if len(ups) > measure_cycles:
+                break
+
+            mc.set_speed(channel, axis["sign"] * relay * relay_amplitude)
             time.sleep(sample_interval)
-
-        mc.set_speed(1, 0)
-        time.sleep(2)
-
-        if period_detected:
-            print(f"Oscillation detected. Ku={Ku:.2f}, Pu={Pu:.2f}")
-            break
-
-        P += step
-
-    if Ku and Pu:
-        Kp = 0.6 * Ku
-        Ki = 2 * Kp / Pu
-        Kd = Kp * Pu / 8
-        print("Suggested PID gains:")
-        print(f"Kp = {Kp:.3f}, Ki = {Ki:.3f}, Kd = {Kd:.3f}")
+        else:
+            print("Aborting: no sustained oscillation before timeout")
+            return None, None
+    finally:
+        mc.set_speed(channel, 0)
+
+    periods = [tick_diff(b, a) for a, b in zip(ups, ups[1:])]
+    Pu = float(np.mean(periods))
+    recent = np.array(peaks[-2 * measure_cycles:])
+    a = (np.mean(recent[recent >= setpoint]) - np.mean(recent[recent < setpoint])) / 2
+    if a <= hysteresis:
+        print("Oscillation amplitude within hysteresis, increase relay_amplitude")
+        return None, None
+    Ku = 4 * relay_amplitude / (np.pi * np.sqrt(a ** 2 - hysteresis ** 2))
+    print(f"Limit cycle: amplitude {a:.3f}, period {Pu:.3f} s ({len(periods)} cycles)")
+    return Ku, Pu
+
+
+def relay_tune(axis_name):
+    axis = AXES[axis_name]
+
+    # Init GPIO and encoder
+    pi = hal.gpio()
+    decoder = rotary_encoder.decoder(pi, axis["encoder_a"], axis["encoder_b"])
+
+    # Init motor
+    mc = hal.motor_driver(bus=3)
+    mc.reinitialize()
+    mc.clear_reset_flag()
+    mc.set_error_response(hal.ERROR_RESPONSE_COAST)
+    mc.set_command_timeout_milliseconds(500)
+    mc.set_max_acceleration(axis["channel"], axis["max_acceleration"])
+    mc.set_max_deceleration(axis["channel"], axis["max_deceleration"])
+    mc.clear_motor_fault()
+
+    print(f"Starting relay autotune on {axis_name}...")
+    try:
+        Ku, Pu = relay_experiment(mc, decoder.counter, axis)
+        if Ku:
+            print(f"Ku={Ku:.2f}, Pu={Pu:.3f} s")
+            print_gains(*suggest_gains(Ku, Pu))
+    except KeyboardInterrupt:
+        print("Autotune aborted.")
+    finally:
+        mc.set_speed(axis["channel"], 0)
+        decoder.cancel()
+        pi.stop()
+
+
+def model_tune(axis_name):
+    """Derive gains from the cached plant model without touching hardware."""
+    encoder_gain = AXES[axis_name]["encoder_gain"]
+    model = plant_model.load_model(axis_name)
+    print(model)
+    Ku, Pu = model.ultimate()
+    if not Ku:
+        print("Model has no phase crossover, cannot derive ultimate gain")
+        return
+    Ku /= encoder_gain  # per count -> per position unit, as the controllers see the error
+    print(f"Model ultimate gain Ku={Ku:.2f}, Pu={Pu:.3f} s")
+
+    Kp, Ki, Kd = suggest_gains(Ku, Pu)
+    print_gains(Kp, Ki, Kd)
+
+    trace = model.simulate_pid(Kp, Ki, Kd, target_position, encoder_gain=encoder_gain)
+    overshoot = max(0.0, (np.max(trace) - target_position) / target_position * 100)
+    outside = np.flatnonzero(np.abs(trace - target_position) > settle_tolerance)
+    settle = (outside[-1] + 1) * 0.05 if len(outside) else 0.0
+    print(f"Simulated {target_position} step: overshoot {overshoot:.1f}%, settles in {settle:.2f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PID autotune")
+    parser.add_argument("--model", action="store_true",
+                        help="tune from the cached plant model (see plant_model.py) instead of the hardware")
+    parser.add_argument("--axis", default="motor1", choices=sorted(AXES))
+    args = parser.parse_args()
+
+    if args.model:
+        model_tune(args.axis)
     else:
-        print("Failed to find sustained oscillation within P range")
+        relay_tune(args.axis)
+
 
-except KeyboardInterrupt:
-    mc.set_speed(1, 0)
-    decoder.cancel()
-    pi.stop()
-    print("Autotune aborted.")
+if __name__ == "__main__":
+    main()
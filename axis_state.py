@@ -0,0 +1,96 @@
+import fcntl
+import mmap
+import os
+import struct
+import time
+import zlib
+
+# magic, version, seq, count, target, integral, last_error, active, saved_at, board_epoch, crc
+_LAYOUT = struct.Struct("<4sHIddddBddI")
+_MAGIC = b"WGAX"
+_VERSION = 2
+MAX_AGE = 600.0  # s; an older checkpoint is not resumed, the axis may have been moved by hand
+
+
+def board_epoch(path, power_lost, reset):
+    """The power cycle of a driver board shared by several controllers.
+
+    path (in the run directory) holds the epoch of the board's current
+    power cycle. With the file locked, power_lost() is asked whether the
+    board lost power; if it did, or no epoch is recorded since the Pi
+    booted, reset() reinitializes the board and a new epoch starts. So
+    only the first controller to start after a power loss sees the
+    board's reset flags, and the others still learn of it. Returns the
+    epoch.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            epoch = float(os.read(fd, 64))
+        except ValueError:
+            epoch = None
+        if epoch is None or power_lost():
+            reset()
+            epoch = time.time()
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, repr(epoch).encode(), 0)
+        return epoch
+    finally:
+        os.close(fd)  # releases the lock
+
+
+class AxisCheckpoint:
+    """Controller state in a small memory-mapped file.
+
+    save() packs the encoder count, the active target and the PID state
+    straight into the mapping, so checkpointing every control cycle costs
+    no system calls; the page cache keeps it across a process crash or
+    restart. A CRC over the record guards against torn or stale data.
+    The file is only synced to the card on close(). Each record carries
+    board_epoch, so a checkpoint from before the board last lost power
+    is never resumed (see board_epoch()).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < _LAYOUT.size:
+                os.ftruncate(fd, _LAYOUT.size)
+            self.map = mmap.mmap(fd, _LAYOUT.size)
+        finally:
+            os.close(fd)
+        self.seq = 0
+        self.board_epoch = 0.0
+
+    def load(self):
+        """Return the last saved state as a dict, or None if there is none."""
+        fields = _LAYOUT.unpack_from(self.map)
+        magic, version, seq, count, target, integral, last_error, active, saved_at, board, crc = fields
+        if magic != _MAGIC or version != _VERSION:
+            return None
+        if zlib.crc32(self.map[:_LAYOUT.size - 4]) != crc:
+            return None
+        self.seq = seq
+        return {
+            "count": count,
+            "target": target,
+            "integral": integral,
+            "last_error": last_error,
+            "active": bool(active),
+            "saved_at": saved_at,
+            "board_epoch": board,
+        }
+
+    def save(self, count, target, integral, last_error, active):
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        record = _LAYOUT.pack(_MAGIC, _VERSION, self.seq, count, target, integral,
+                              last_error, int(active), time.time(), self.board_epoch, 0)[:-4]
+        self.map[:len(record)] = record
+        self.map[len(record):_LAYOUT.size] = struct.pack("<I", zlib.crc32(record))
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
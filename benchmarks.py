@@ -0,0 +1,258 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks_baseline.json")
+REGRESSION_THRESHOLD = 0.20  # a rate this much below baseline is a regression
+MIN_TIME = 0.2  # s per timing run
+REPEATS = 5
+
+BENCHMARKS = {}
+
+
+def benchmark(name, unit):
+    """Register a setup function. It returns (fn, ops): fn() is timed and
+    performs ops units of work per call."""
+    def register(setup):
+        BENCHMARKS[name] = (setup, unit)
+        return setup
+    return register
+
+
+def measure(fn, ops, min_time=MIN_TIME, repeats=REPEATS):
+    """Best rate in ops per second over several timing runs."""
+    fn()  # warm up caches and lazy imports
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        loops *= 2 if elapsed == 0 else max(2, int(min_time / elapsed * 1.2))
+    best = elapsed
+    for _ in range(repeats - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        best = min(best, time.perf_counter() - start)
+    return ops * loops / best
+
+
+_tmp = None
+
+
+def _tmpdir():
+    global _tmp
+    if _tmp is None:
+        _tmp = tempfile.TemporaryDirectory(prefix="wheatgrass-bench-")
+    return _tmp.name
+
+
+def _schedule_tasks(n):
+    start = datetime(2025, 1, 1)
+    devices = ["valve1", "valve2", "motor1", "motor2"]
+    return [{"time": start + timedelta(minutes=i), "device": devices[i % 4],
+             "action": "on" if i % 4 < 2 else "move", "value": 60.0}
+            for i in range(n)]
+
+
+def _schedule_benchmarks(rows):
+    @benchmark(f"schedule_load_{rows // 1000}k", "rows/s")
+    def load():
+        import schedule_compiler
+        path = os.path.join(_tmpdir(), f"load_{rows}.csv")
+        schedule_compiler.save_schedule(path, _schedule_tasks(rows))
+        return lambda: schedule_compiler.load_schedule(path), rows
+
+    @benchmark(f"schedule_save_{rows // 1000}k", "rows/s")
+    def save():
+        import schedule_compiler
+        path = os.path.join(_tmpdir(), f"save_{rows}.csv")
+        tasks = _schedule_tasks(rows)
+        return lambda: schedule_compiler.save_schedule(path, tasks), rows
+
+    @benchmark(f"schedule_compile_{rows // 1000}k", "rows/s")
+    def compile():
+        import schedule_compiler
+        path = os.path.join(_tmpdir(), f"compile_{rows}.csv")
+        schedule_compiler.save_schedule(path, _schedule_tasks(rows))
+        return lambda: schedule_compiler.compile_schedule(path), rows
+
+    @benchmark(f"schedule_due_{rows // 1000}k", "lookups/s")
+    def due():
+        import schedule_compiler
+        path = os.path.join(_tmpdir(), f"due_{rows}.csv")
+        schedule_compiler.save_schedule(path, _schedule_tasks(rows))
+        schedule = schedule_compiler.load(path)
+        now = int(datetime(2025, 1, 1).timestamp()) + rows * 30
+        # What the runner does per loop: stat the CSV, find the due range
+        return lambda: (schedule.current(path), schedule.after(now)), 1
+
+
+for _rows in (1000, 10000, 100000):
+    _schedule_benchmarks(_rows)
+
+
+@benchmark("scheduler_batch", "entries/s")
+def scheduler_batch():
+    import Scheduler
+    base = datetime(2025, 1, 1)
+    n = len(Scheduler.batch_entries(base))
+    return lambda: Scheduler.batch_entries(base), n
+
+
+@benchmark("scheduler_merge", "entries/s")
+def scheduler_merge():
+    import Scheduler
+    # Merge one batch into a schedule already holding 20 batches
+    rows, existing = [], set()
+    for b in range(20):
+        Scheduler.merge_entries(rows, existing, Scheduler.batch_entries(datetime(2025, 1, 1) + timedelta(days=b)))
+    entries = Scheduler.batch_entries(datetime(2025, 1, 21))
+
+    def run():
+        Scheduler.merge_entries(list(rows), set(existing), entries)
+    return run, len(entries)
+
+
+@benchmark("encoder_pulse", "edges/s")
+def encoder_pulse():
+    import encoder_replay
+    import rotary_encoder
+    edges = encoder_replay.synthesize(25000, 5000).tolist()
+    dec = rotary_encoder.decoder(encoder_replay.ReplayPi(), encoder_replay.ENCODER_A, encoder_replay.ENCODER_B)
+    pulse = dec._pulse
+
+    def run():
+        for gpio, level, tick in edges:
+            pulse(gpio, level, tick)
+    return run, len(edges)
+
+
+@benchmark("encoder_batch_decode", "edges/s")
+def encoder_batch_decode():
+    import encoder_replay
+    import rotary_encoder
+    edges = encoder_replay.synthesize(25000, 5000)
+    reports = encoder_replay.to_reports(edges, encoder_replay.ENCODER_A, encoder_replay.ENCODER_B)
+    dec = rotary_encoder.batch_decoder(encoder_replay.ReplayPi(), encoder_replay.ENCODER_A,
+                                       encoder_replay.ENCODER_B, start=False)
+
+    def run():
+        for i in range(0, len(reports), 4096):
+            dec.decode(reports[i:i + 4096])
+    return run, len(edges)
+
+
+def _pid_benchmark(module):
+    @benchmark(f"pid_compute_{module.split('_')[0]}", "calls/s")
+    def pid_compute():
+        controller = __import__(module)
+        p = controller.DEFAULT_PARAMS
+        pid = controller.FilteredPID(p["Kp"], p["Ki"], p["Kd"], p["alpha"])
+        pid.setpoint = 100.0
+        measurements = np.linspace(0, 100, 1000).tolist()
+
+        def run():
+            for m in measurements:
+                pid.compute(m)
+        return run, len(measurements)
+
+
+for _module in ("motor1_control", "motor2_control"):
+    _pid_benchmark(_module)
+
+
+@benchmark("frf_fit_sine", "fits/s")
+def frf_fit_sine():
+    import FRF
+    rng = np.random.default_rng(0)
+    freq = 2.0
+    t = np.sort(rng.uniform(0, 4 / freq + 1, 400))
+    y = 3 * np.sin(2 * np.pi * freq * t + 0.5) + 0.1 * t + 0.05 * rng.standard_normal(len(t))
+    return lambda: FRF.fit_sine(t, y, freq), 1
+
+
+@benchmark("plant_fit_model", "fits/s")
+def plant_fit_model():
+    import plant_model
+    true = plant_model.PlantModel(0.002, 0.05, 0.01, "motor1")
+    freqs = np.logspace(-1, 1.3, 15)
+    response = true.response(freqs) * plant_model.FRF_AMPLITUDE
+    gain, phase = np.abs(response), np.rad2deg(np.angle(response))
+    return lambda: plant_model.fit_model(freqs, gain, phase), 1
+
+
+def load_baseline(path=BASELINE_FILE):
+    """Baselines are kept per host; numbers from different machines are not comparable."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(results, path=BASELINE_FILE):
+    baselines = load_baseline(path)
+    host = baselines.setdefault(socket.gethostname(), {})
+    host.update({name: round(rate, 1) for name, rate in results.items()})
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write("\n")
+    os.replace(tmp, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the automation hot paths")
+    parser.add_argument("names", nargs="*", help="benchmarks to run (substring match, default all)")
+    parser.add_argument("--save", action="store_true", help="store the results as this host's baseline")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument("--min-time", type=float, default=MIN_TIME)
+    parser.add_argument("--list", action="store_true")
+    args = parser.parse_args()
+
+    selected = [n for n in BENCHMARKS if not args.names or any(s in n for s in args.names)]
+    if args.list:
+        print("\n".join(selected))
+        return
+
+    baseline = load_baseline(args.baseline).get(socket.gethostname(), {})
+    results = {}
+    regressions = []
+    print(f"{'benchmark':<24} {'rate':>14} {'unit':<10} {'baseline':>14} {'change':>8}")
+    for name in selected:
+        setup, unit = BENCHMARKS[name]
+        fn, ops = setup()
+        rate = results[name] = measure(fn, ops, args.min_time)
+        line = f"{name:<24} {rate:>14,.0f} {unit:<10}"
+        if name in baseline:
+            change = rate / baseline[name] - 1
+            line += f" {baseline[name]:>14,.0f} {change:>+7.1%}"
+            if change < -args.threshold:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line, flush=True)
+
+    if args.save:
+        save_baseline(results, args.baseline)
+        print(f"Saved baseline for {socket.gethostname()} to {args.baseline}")
+    elif not baseline:
+        print(f"No baseline for {socket.gethostname()}; run with --save to record one")
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import json
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+# name: (type, minimum, maximum)
+SCHEMA = {
+    "Kp": (float, 0, 100000),
+    "Ki": (float, 0, 100000),
+    "Kd": (float, 0, 100000),
+    "alpha": (float, 0, 1),
+    "static_feedforward": (float, 0, 800),
+    "integral_limit": (float, 0, 100000),
+    "output_limit": (int, 0, 800),
+    "slowdown_distance": (float, 0, 100000),
+    "deadband": (int, 0, 800),
+    "settle_tolerance": (float, 0, 1000),
+    "settle_threshold": (int, 1, 10000),
+    "encoder_gain": (float, 1e-9, 1000),
+}
+
+
+def validate(params, required=()):
+    """Return a cleaned copy of params or raise ValueError."""
+    clean = {}
+    for name, value in params.items():
+        if name not in SCHEMA:
+            raise ValueError(f"unknown parameter {name!r}")
+        kind, lo, hi = SCHEMA[name]
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"{name} must be a number, got {value!r}")
+        if kind is int and value != int(value):
+            raise ValueError(f"{name} must be an integer, got {value!r}")
+        value = kind(value)
+        if not lo <= value <= hi:
+            raise ValueError(f"{name}={value} outside [{lo}, {hi}]")
+        clean[name] = value
+    missing = [name for name in required if name not in clean]
+    if missing:
+        raise ValueError(f"missing parameters: {', '.join(missing)}")
+    return clean
+
+
+class ParamWatcher:
+    """Per-axis controller parameters, reloaded when the file changes.
+
+    The file is a JSON object of parameters that override the defaults.
+    poll() is cheap (one stat every check_interval seconds) and is meant
+    to be called once per control cycle; a changed file is parsed,
+    validated and handed to apply() between cycles. If parsing,
+    validation or apply() fails, the last good parameters are kept (and
+    re-applied if apply() had partially run).
+    """
+
+    def __init__(self, path, defaults, check_interval=0.25):
+        self.path = path
+        self.defaults = validate(defaults)
+        self.values = dict(self.defaults)
+        self.check_interval = check_interval
+        self.last_check = 0
+        self.stamp = None
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _read(self):
+        with open(self.path) as f:
+            overrides = json.load(f)
+        if not isinstance(overrides, dict):
+            raise ValueError("parameter file must contain a JSON object")
+        merged = dict(self.defaults)
+        merged.update(validate(overrides))
+        return merged
+
+    def poll(self, apply):
+        """Apply changed parameters via apply(values). Returns True if new
+        parameters took effect."""
+        now = time.monotonic()
+        if now - self.last_check < self.check_interval:
+            return False
+        self.last_check = now
+
+        stamp = self._stat()
+        if stamp == self.stamp:
+            return False
+        self.stamp = stamp
+        if stamp is None:
+            return False
+
+        try:
+            new = self._read()
+        except (OSError, ValueError) as e:
+            log.warning("Ignoring %s: %s", self.path, e)
+            return False
+        if new == self.values:
+            return False
+
+        try:
+            apply(new)
+        except Exception as e:
+            log.warning("Failed to apply %s, rolling back: %s", self.path, e)
+            apply(self.values)
+            return False
+
+        changed = {k: v for k, v in new.items() if self.values.get(k) != v}
+        self.values = new
+        log.info("Parameters updated from %s: %s", self.path, changed)
+        return True
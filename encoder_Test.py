@@ -1,5 +1,7 @@
-import pigpio
+import hal
+import sys
 import time
+from encoder_replay import EdgeRecorder
 
 # GPIO pins (BCM numbering)
 ENCODER_A = 26
@@ -12,20 +14,26 @@ def callback_B(gpio, level, tick):
     print(f"Interrupt on B! Level: {level}, Time: {tick}")
 
 # Connect to pigpiod
-pi = pigpio.pi()
+pi = hal.gpio()
 if not pi.connected:
     print("Failed to connect to pigpiod.")
     exit(1)
 
 # Set up pins
-pi.set_mode(ENCODER_A, pigpio.INPUT)
-pi.set_pull_up_down(ENCODER_A, pigpio.PUD_UP)
-pi.set_mode(ENCODER_B, pigpio.INPUT)
-pi.set_pull_up_down(ENCODER_B, pigpio.PUD_UP)
+pi.set_mode(ENCODER_A, hal.INPUT)
+pi.set_pull_up_down(ENCODER_A, hal.PUD_UP)
+pi.set_mode(ENCODER_B, hal.INPUT)
+pi.set_pull_up_down(ENCODER_B, hal.PUD_UP)
 
-# Register callbacks
-cb_A = pi.callback(ENCODER_A, pigpio.EITHER_EDGE, callback_A)
-cb_B = pi.callback(ENCODER_B, pigpio.EITHER_EDGE, callback_B)
+# Register callbacks, or record raw edges if a file is given
+recorder = None
+if len(sys.argv) > 1:
+    recorder = EdgeRecorder(sys.argv[1])
+    callback_A = callback_B = recorder.callback
+    print(f"Recording edges to {sys.argv[1]}")
+
+cb_A = pi.callback(ENCODER_A, hal.EITHER_EDGE, callback_A)
+cb_B = pi.callback(ENCODER_B, hal.EITHER_EDGE, callback_B)
 
 print("Listening for interrupts on GPIO 5 (A) and GPIO 6 (B)...")
 print("Rotate your encoder now. Press Ctrl+C to stop.")
@@ -38,4 +46,7 @@ except KeyboardInterrupt:
     print("Exiting.")
     cb_A.cancel()
     cb_B.cancel()
+    if recorder:
+        recorder.close()
+        print(f"Recorded {recorder.total} edges.")
     pi.stop()
@@ -0,0 +1,297 @@
+import argparse
+import importlib
+import queue
+import threading
+import time
+
+import numpy as np
+
+import rotary_encoder
+
+# Recorded edge streams are a short header followed by packed
+# (gpio, level, tick) records, 6 bytes per edge.
+MAGIC = b"WGEDGE1\0"
+EDGE = np.dtype([("gpio", "u1"), ("level", "u1"), ("tick", "<u4")])
+
+ENCODER_A = 24
+ENCODER_B = 25
+
+
+class EdgeRecorder:
+    """Collects raw edges from pigpio callbacks into a binary file.
+
+    Pass recorder.callback as the pigpio callback function. Edges are
+    buffered in a preallocated array; full blocks are handed to a writer
+    thread, so the callback thread never waits on the SD card.
+    """
+
+    def __init__(self, path, block_size=4096):
+        self.path = path
+        self.buffer = np.zeros(block_size, dtype=EDGE)
+        self.used = 0
+        self.total = 0
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.blocks = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self._write, name="edge-writer", daemon=True)
+        self.writer.start()
+
+    def callback(self, gpio, level, tick):
+        self.buffer[self.used] = (gpio, level, tick)
+        self.used += 1
+        if self.used == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        """Hand the buffered edges to the writer thread."""
+        self.blocks.put(self.buffer[:self.used])
+        self.total += self.used
+        self.buffer = np.zeros(len(self.buffer), dtype=EDGE)
+        self.used = 0
+
+    def _write(self):
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                return
+            self.file.write(block.tobytes())
+
+    def close(self):
+        self.flush()
+        self.blocks.put(None)
+        self.writer.join()
+        self.file.close()
+
+
+def save_edges(path, edges):
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.ascontiguousarray(edges, dtype=EDGE).tobytes())
+
+
+def load_edges(path):
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an edge recording")
+        return np.frombuffer(f.read(), dtype=EDGE)
+
+
+def synthesize(counts, speed, gpioA=ENCODER_A, gpioB=ENCODER_B,
+               bounce=0.0, drop=0.0, jitter=0.0, seed=None):
+    """Generate the edge stream of an encoder turning `counts` cycles.
+
+    speed is in counts per second; a negative count turns the other way.
+    bounce is the probability that an edge is followed by a contact
+    bounce (two extra toggles on the same gpio 2 us later), drop the
+    probability that an edge is lost and jitter the relative timing
+    noise of each edge interval.
+    """
+    rng = np.random.default_rng(seed)
+    n = 4 * abs(int(counts))
+
+    # Forward: B rises, A rises (+1), B falls, A falls.
+    if counts >= 0:
+        gpio_cycle = np.array([gpioB, gpioA, gpioB, gpioA], dtype=np.uint8)
+    else:
+        gpio_cycle = np.array([gpioA, gpioB, gpioA, gpioB], dtype=np.uint8)
+    level_cycle = np.array([1, 1, 0, 0], dtype=np.uint8)
+
+    gpio = np.tile(gpio_cycle, n // 4)
+    level = np.tile(level_cycle, n // 4)
+
+    interval = 1e6 / (4 * abs(speed))
+    steps = np.full(n, interval)
+    if jitter:
+        steps *= np.clip(1 + jitter * rng.standard_normal(n), 0.1, None)
+    ticks = np.cumsum(steps)
+
+    if bounce:
+        bounced = np.flatnonzero(rng.random(n) < bounce)
+        extra_gpio = np.repeat(gpio[bounced], 2)
+        extra_level = np.empty(2 * len(bounced), dtype=np.uint8)
+        extra_level[0::2] = 1 - level[bounced]
+        extra_level[1::2] = level[bounced]
+        extra_ticks = np.repeat(ticks[bounced], 2) + np.tile([2.0, 4.0], len(bounced))
+        gpio = np.concatenate([gpio, extra_gpio])
+        level = np.concatenate([level, extra_level])
+        ticks = np.concatenate([ticks, extra_ticks])
+        order = np.argsort(ticks, kind="stable")
+        gpio, level, ticks = gpio[order], level[order], ticks[order]
+
+    if drop:
+        keep = rng.random(len(gpio)) >= drop
+        gpio, level, ticks = gpio[keep], level[keep], ticks[keep]
+
+    edges = np.empty(len(gpio), dtype=EDGE)
+    edges["gpio"] = gpio
+    edges["level"] = level
+    edges["tick"] = (ticks.astype(np.uint64) & 0xFFFFFFFF).astype(np.uint32)
+    return edges
+
+
+def illegal_transitions(edges):
+    """Count edges that do not change their gpio's level, i.e. points where
+    an edge was missed and the quadrature sequence skipped a state."""
+    illegal = 0
+    for gpio in np.unique(edges["gpio"]):
+        levels = edges["level"][edges["gpio"] == gpio]
+        illegal += int(np.count_nonzero(levels[1:] == levels[:-1]))
+    return illegal
+
+
+def _forward_fill(edges, gpio, initial=0):
+    """Level of gpio after every edge in the stream."""
+    mine = edges["gpio"] == gpio
+    last = np.where(mine, np.arange(len(edges)), -1)
+    np.maximum.accumulate(last, out=last)
+    levels = edges["level"][np.maximum(last, 0)].astype(np.uint32)
+    levels[last < 0] = initial
+    return levels
+
+
+def to_reports(edges, gpioA, gpioB):
+    """Convert an edge stream to pigpio notification reports."""
+    reports = np.zeros(len(edges), dtype=rotary_encoder.batch_decoder.REPORT)
+    reports["seq"] = np.arange(len(edges), dtype=np.uint16)
+    reports["tick"] = edges["tick"]
+    reports["level"] = ((_forward_fill(edges, gpioA) << gpioA) |
+                        (_forward_fill(edges, gpioB) << gpioB))
+    return reports
+
+
+class ReplayPi:
+    """Stands in for hal.gpio() when a decoder is fed from a recording."""
+
+    class _Callback:
+        def __init__(self, owner, gpio, func):
+            self.owner, self.gpio, self.func = owner, gpio, func
+
+        def cancel(self):
+            self.owner.callbacks[self.gpio].remove(self.func)
+
+    def __init__(self):
+        self.callbacks = {}
+
+    def set_mode(self, gpio, mode):
+        pass
+
+    def set_pull_up_down(self, gpio, pud):
+        pass
+
+    def set_glitch_filter(self, gpio, steady):
+        pass
+
+    def read_bank_1(self):
+        return 0
+
+    def callback(self, gpio, edge=0, func=None):
+        self.callbacks.setdefault(gpio, []).append(func)
+        return self._Callback(self, gpio, func)
+
+    def dispatch(self, edges):
+        callbacks = self.callbacks
+        for gpio, level, tick in edges.tolist():
+            for func in callbacks.get(gpio, ()):
+                func(gpio, level, tick)
+
+
+def _callback_decoder(pi, gpioA, gpioB):
+    return rotary_encoder.decoder(pi, gpioA, gpioB)
+
+
+def _batch_decoder(pi, gpioA, gpioB):
+    return rotary_encoder.batch_decoder(pi, gpioA, gpioB, start=False)
+
+
+DECODERS = {
+    "callback": _callback_decoder,
+    "batch": _batch_decoder,
+}
+
+
+def resolve_decoder(name):
+    """Return a decoder factory by name or as "module:callable"."""
+    if name in DECODERS:
+        return DECODERS[name]
+    module, _, attr = name.partition(":")
+    return getattr(importlib.import_module(module), attr)
+
+
+def replay(edges, factory, gpioA=ENCODER_A, gpioB=ENCODER_B, block=4096):
+    """Feed an edge stream through a decoder as fast as possible.
+
+    Decoders with a decode() method are fed notification reports in
+    blocks, anything else through its pigpio callbacks edge by edge.
+    Returns a dict with the throughput, final count and number of
+    illegal transitions in the stream.
+    """
+    pi = ReplayPi()
+    dec = factory(pi, gpioA, gpioB)
+
+    if hasattr(dec, "decode"):
+        reports = to_reports(edges, gpioA, gpioB)
+        start = time.perf_counter()
+        for i in range(0, len(reports), block):
+            dec.decode(reports[i:i + block])
+        elapsed = time.perf_counter() - start
+    else:
+        start = time.perf_counter()
+        pi.dispatch(edges)
+        elapsed = time.perf_counter() - start
+
+    count, _ = dec.counter.snapshot()
+    dec.cancel()
+
+    return {
+        "edges": len(edges),
+        "seconds": elapsed,
+        "edges_per_sec": len(edges) / elapsed if elapsed > 0 else float("inf"),
+        "count": count,
+        "illegal": illegal_transitions(edges),
+    }
+
+
+def print_result(name, result):
+    print(f"{name:>10}: {result['edges']} edges in {result['seconds']*1000:.1f} ms "
+          f"({result['edges_per_sec']:,.0f} edges/s), count={result['count']}, "
+          f"illegal={result['illegal']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Encoder edge recorder and replay benchmark")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    synth = sub.add_parser("synth", help="synthesize an edge stream")
+    synth.add_argument("output")
+    synth.add_argument("--counts", type=int, default=100000)
+    synth.add_argument("--speed", type=float, default=5000, help="counts per second")
+    synth.add_argument("--bounce", type=float, default=0.0)
+    synth.add_argument("--drop", type=float, default=0.0)
+    synth.add_argument("--jitter", type=float, default=0.0)
+    synth.add_argument("--seed", type=int, default=None)
+
+    rep = sub.add_parser("replay", help="replay a recorded edge stream")
+    rep.add_argument("input")
+    rep.add_argument("--decoder", action="append",
+                     help="callback, batch or module:callable (repeatable)")
+
+    for p in (synth, rep):
+        p.add_argument("--gpio-a", type=int, default=ENCODER_A)
+        p.add_argument("--gpio-b", type=int, default=ENCODER_B)
+
+    args = parser.parse_args()
+
+    if args.command == "synth":
+        edges = synthesize(args.counts, args.speed, args.gpio_a, args.gpio_b,
+                           args.bounce, args.drop, args.jitter, args.seed)
+        save_edges(args.output, edges)
+        print(f"Wrote {len(edges)} edges to {args.output}")
+    else:
+        edges = load_edges(args.input)
+        for name in args.decoder or list(DECODERS):
+            result = replay(edges, resolve_decoder(name), args.gpio_a, args.gpio_b)
+            print_result(name, result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+"""Hardware abstraction for GPIO (pigpio) and the Motoron motor driver.
+
+Scripts get their devices from gpio() and motor_driver() instead of
+pigpio.pi() and motoron.MotoronI2C(), and use the constants below
+instead of the pigpio/motoron ones. The backend is chosen with the
+WHEATGRASS_HAL environment variable (or configure()):
+
+    real         pigpio and motoron, the default on the Pi
+    mock         in-memory devices, no hardware or libraries needed
+    record       real devices, every call logged to WHEATGRASS_HAL_RECORD
+    record:mock  mock devices, every call logged
+"""
+
+import json
+import os
+import threading
+import time
+
+BACKEND = os.environ.get("WHEATGRASS_HAL", "real")
+RECORD_PATH = os.environ.get("WHEATGRASS_HAL_RECORD", "hal_record.jsonl")
+
+# GPIO constants, same values as pigpio
+INPUT = 0
+OUTPUT = 1
+PUD_OFF = 0
+PUD_DOWN = 1
+PUD_UP = 2
+RISING_EDGE = 0
+FALLING_EDGE = 1
+EITHER_EDGE = 2
+
+# Motoron constants, same values as the motoron library
+STATUS_FLAG_PROTOCOL_ERROR = 0
+STATUS_FLAG_CRC_ERROR = 1
+STATUS_FLAG_COMMAND_TIMEOUT_LATCHED = 2
+STATUS_FLAG_MOTOR_FAULT_LATCHED = 3
+STATUS_FLAG_NO_POWER_LATCHED = 4
+STATUS_FLAG_RESET = 5
+STATUS_FLAG_COMMAND_TIMEOUT = 6
+STATUS_FLAG_MOTOR_FAULTING = 7
+STATUS_FLAG_NO_POWER = 8
+STATUS_FLAG_ERROR_ACTIVE = 9
+STATUS_FLAG_MOTOR_OUTPUT_ENABLED = 10
+STATUS_FLAG_MOTOR_DRIVING = 11
+ERROR_RESPONSE_COAST = 0
+ERROR_RESPONSE_BRAKE = 1
+ERROR_RESPONSE_COAST_NOW = 2
+ERROR_RESPONSE_BRAKE_NOW = 3
+VIN_SENSE_MOTORON_256 = 0
+VIN_SENSE_MOTORON_HP = 2
+VIN_SENSE_MOTORON_550 = 3
+
+
+def configure(backend):
+    """Select the backend for subsequent gpio()/motor_driver() calls."""
+    global BACKEND
+    BACKEND = backend
+
+
+def _split(backend):
+    backend = backend or BACKEND
+    if backend == "record":
+        return True, "real"
+    if backend.startswith("record:"):
+        return True, backend.split(":", 1)[1]
+    return False, backend
+
+
+def gpio(backend=None):
+    """GPIO outputs and edge inputs, with the pigpio.pi interface."""
+    record, base = _split(backend)
+    if base == "real":
+        import pigpio
+        device = pigpio.pi()
+    elif base == "mock":
+        device = MockPi()
+    else:
+        raise ValueError(f"Unknown HAL backend {base!r}")
+    return Recorder(device, "gpio") if record else device
+
+
+def motor_driver(bus=3, address=16, backend=None):
+    """Motor driver with the motoron.MotoronI2C interface."""
+    record, base = _split(backend)
+    if base == "real":
+        import motoron
+        device = motoron.MotoronI2C(bus=bus, address=address)
+    elif base == "mock":
+        device = MockMotoron()
+    else:
+        raise ValueError(f"Unknown HAL backend {base!r}")
+    return Recorder(device, f"motoron{bus}-{address}") if record else device
+
+
+class MockPi:
+    """In-memory stand-in for pigpio.pi.
+
+    Outputs are kept in a dict. Edge inputs are produced with inject(),
+    which updates the level and runs the registered callbacks just like
+    pigpio's callback thread would. There is no notification pipe, so
+    rotary_encoder.batch_decoder is not available.
+    """
+
+    connected = True
+
+    class _Callback:
+        def __init__(self, owner, gpio, edge, func):
+            self.owner, self.gpio, self.edge, self.func = owner, gpio, edge, func
+
+        def cancel(self):
+            with self.owner.lock:
+                if self in self.owner.callbacks:
+                    self.owner.callbacks.remove(self)
+
+    def __init__(self):
+        self.levels = {}
+        self.modes = {}
+        self.pulls = {}
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+
+    def set_mode(self, gpio, mode):
+        self.modes[gpio] = mode
+
+    def get_mode(self, gpio):
+        return self.modes.get(gpio, INPUT)
+
+    def set_pull_up_down(self, gpio, pud):
+        self.pulls[gpio] = pud
+        if self.modes.get(gpio, INPUT) == INPUT and gpio not in self.levels:
+            self.levels[gpio] = 1 if pud == PUD_UP else 0
+
+    def set_glitch_filter(self, gpio, steady):
+        pass
+
+    def write(self, gpio, level):
+        self.levels[gpio] = level
+
+    def read(self, gpio):
+        return self.levels.get(gpio, 0)
+
+    def read_bank_1(self):
+        bits = 0
+        for gpio, level in self.levels.items():
+            if level and gpio < 32:
+                bits |= 1 << gpio
+        return bits
+
+    def get_current_tick(self):
+        return int((time.monotonic() - self.start) * 1e6) & 0xFFFFFFFF
+
+    def callback(self, gpio, edge=RISING_EDGE, func=None):
+        cb = self._Callback(self, gpio, edge, func)
+        with self.lock:
+            self.callbacks.append(cb)
+        return cb
+
+    def inject(self, gpio, level, tick=None):
+        """Drive an input to level and fire the matching callbacks."""
+        self.levels[gpio] = level
+        if tick is None:
+            tick = self.get_current_tick()
+        with self.lock:
+            callbacks = [cb for cb in self.callbacks if cb.gpio == gpio]
+        for cb in callbacks:
+            if cb.edge == EITHER_EDGE or cb.edge == (RISING_EDGE if level else FALLING_EDGE):
+                cb.func(gpio, level, tick)
+
+    def stop(self):
+        with self.lock:
+            self.callbacks.clear()
+
+
+class MockMotoron:
+    """In-memory stand-in for motoron.MotoronI2C.
+
+    Speeds and settings are stored per channel. status_flags and
+    vin_voltage_mv can be set to exercise error handling.
+    """
+
+    def __init__(self):
+        self.speeds = {}
+        self.settings = {}
+        self.status_flags = 1 << STATUS_FLAG_RESET  # like a freshly powered board
+        self.vin_voltage_mv = 12000
+        self.current_ma = {}
+
+    def _set(self, name, *args):
+        self.settings[name] = args
+
+    def reinitialize(self):
+        self.speeds.clear()
+        self.status_flags |= 1 << STATUS_FLAG_RESET
+
+    def reset(self):
+        self.reinitialize()
+
+    def clear_reset_flag(self):
+        self.status_flags &= ~(1 << STATUS_FLAG_RESET)
+
+    def clear_latched_status_flags(self, flags):
+        self.status_flags &= ~flags
+
+    def clear_motor_fault(self, flags=0):
+        self.status_flags &= ~(1 << STATUS_FLAG_MOTOR_FAULT_LATCHED)
+
+    def get_status_flags(self):
+        return self.status_flags
+
+    def get_motor_driving_flag(self):
+        return any(self.speeds.values())
+
+    def get_vin_voltage_mv(self, reference_mv, vin_type=VIN_SENSE_MOTORON_256):
+        return self.vin_voltage_mv
+
+    def get_current_sense_processed(self, motor):
+        return self.current_ma.get(motor, 0)
+
+    def set_speed(self, motor, speed):
+        self.speeds[motor] = speed
+
+    def set_error_response(self, response):
+        self._set("error_response", response)
+
+    def set_error_mask(self, mask):
+        self._set("error_mask", mask)
+
+    def set_command_timeout_milliseconds(self, ms):
+        self._set("command_timeout_ms", ms)
+
+    def set_max_acceleration(self, motor, accel):
+        self._set(f"max_acceleration_{motor}", accel)
+
+    def set_max_deceleration(self, motor, decel):
+        self._set(f"max_deceleration_{motor}", decel)
+
+
+class Recorder:
+    """Wraps a device and logs every method call as a JSON line.
+
+    Lines are buffered and appended in blocks; flush() or stop() writes
+    out the rest. Callback functions passed to the device are logged by
+    name only.
+    """
+
+    _lock = threading.Lock()
+    _buffer = []
+
+    def __init__(self, device, name, path=None):
+        self._device = device
+        self._name = name
+        self._path = path or RECORD_PATH
+
+    def __getattr__(self, attr):
+        value = getattr(self._device, attr)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            start = time.time()
+            result = value(*args, **kwargs)
+            self._log({"t": round(start, 6), "dev": self._name, "call": attr,
+                       "args": [_plain(a) for a in args],
+                       "kwargs": {k: _plain(v) for k, v in kwargs.items()},
+                       "result": _plain(result)})
+            if attr == "stop":
+                self.flush()
+            return result
+
+        return call
+
+    def _log(self, entry):
+        with self._lock:
+            self._buffer.append(json.dumps(entry, default=str))
+            full = len(self._buffer) >= 1000
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            lines, Recorder._buffer = Recorder._buffer, []
+        if lines:
+            with open(self._path, "a") as f:
+                f.write("\n".join(lines) + "\n")
+
+
+def _plain(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    if callable(value):
+        return getattr(value, "__qualname__", repr(value))
+    return repr(value)
+
+
+def _load_real_constants():
+    """Take the constants from the real libraries when they are installed,
+    so the values above can never drift from them on the Pi."""
+    g = globals()
+    try:
+        import pigpio
+    except ImportError:
+        pass
+    else:
+        for name in ("INPUT", "OUTPUT", "PUD_OFF", "PUD_DOWN", "PUD_UP",
+                     "RISING_EDGE", "FALLING_EDGE", "EITHER_EDGE"):
+            g[name] = getattr(pigpio, name)
+    try:
+        import motoron
+    except ImportError:
+        pass
+    else:
+        for name in list(g):
+            if name.startswith(("STATUS_FLAG_", "ERROR_RESPONSE_")) and hasattr(motoron, name):
+                g[name] = getattr(motoron, name)
+        for name in ("MOTORON_256", "MOTORON_HP", "MOTORON_550"):
+            g["VIN_SENSE_" + name] = getattr(motoron.VinSenseType, name)
+
+
+if _split(None)[1] == "real":
+    _load_real_constants()
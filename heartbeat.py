@@ -0,0 +1,58 @@
+import os
+import time
+
+# tmpfs, so heartbeats never touch the SD card
+HEARTBEAT_DIR = os.environ.get("WHEATGRASS_HEARTBEAT_DIR", "/dev/shm/wheatgrass")
+
+
+def heartbeat_path(name):
+    return os.path.join(HEARTBEAT_DIR, f"{name}.hb")
+
+
+class Heartbeat:
+    """Liveness signal for the supervisor: the mtime of a file in tmpfs.
+
+    beat() can be called every loop iteration; it only touches the file
+    once per interval.
+    """
+
+    def __init__(self, name, interval=1.0):
+        self.path = heartbeat_path(name)
+        self.interval = interval
+        self.last = 0
+        os.makedirs(HEARTBEAT_DIR, exist_ok=True)
+
+    def beat(self):
+        now = time.monotonic()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            open(self.path, "w").close()
+
+    def sleep(self, seconds):
+        """time.sleep() that keeps beating during long waits."""
+        end = time.monotonic() + seconds
+        while True:
+            self.beat()
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, self.interval))
+
+
+def last_beat(name):
+    """Wall-clock time of the last beat, or None if there never was one."""
+    try:
+        return os.stat(heartbeat_path(name)).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def clear(name):
+    try:
+        os.remove(heartbeat_path(name))
+    except FileNotFoundError:
+        pass
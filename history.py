@@ -0,0 +1,243 @@
+"""Archive of executed tasks for time-range queries.
+
+Every finished task is appended as a fixed-width row to the current
+day's row file (history/YYYY-MM-DD.rows). Once a day is over its rows
+are sorted by start time and merged into that month's columnar chunk
+(history/YYYY-MM.npz, one array per column), so a year of history is
+twelve small files and a query only loads the columns it uses.
+Device, action and status names are stored as ids into
+history/names.json.
+
+    python history.py valve-seconds valve2
+    python history.py late motor --since 2025-01-01 --threshold 60
+"""
+
+import argparse
+import glob
+import io
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+import persistence
+
+HISTORY_DIR = os.environ.get("WHEATGRASS_HISTORY_DIR",
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), "history"))
+
+ROW = np.dtype([
+    ("scheduled", "<i8"),  # epoch seconds
+    ("started", "<f8"),  # epoch seconds
+    ("finished", "<f8"),
+    ("value", "<f8"),
+    ("device", "<u2"),
+    ("action", "<u2"),
+    ("status", "<u1"),
+])
+COLUMNS = ROW.names
+NAME_FIELDS = ("device", "action", "status")
+
+
+class HistoryStore:
+    """Rows are buffered and appended once per persistence.FLUSH_INTERVAL;
+    queries and compaction flush first, so they always see every row."""
+
+    def __init__(self, directory=HISTORY_DIR, flush_interval=persistence.FLUSH_INTERVAL):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.writer = persistence.WriteCoalescer(flush_interval, category="history")
+        os.makedirs(directory, exist_ok=True)
+        self.names_path = os.path.join(directory, "names.json")
+        try:
+            with open(self.names_path) as f:
+                self.names = json.load(f)
+        except FileNotFoundError:
+            self.names = {field: [] for field in NAME_FIELDS}
+        self.ids = {field: {n: i for i, n in enumerate(self.names[field])} for field in NAME_FIELDS}
+        self.cache = {}  # chunk path -> (mtime, columns)
+        self.compact()
+
+    def _id(self, field, name):
+        ids = self.ids[field]
+        if name not in ids:
+            ids[name] = len(self.names[field])
+            self.names[field].append(name)
+            persistence.atomic_write(self.names_path, json.dumps(self.names), category="history")
+        return ids[name]
+
+    def record(self, task, status, started=None, finished=None):
+        """Append one executed task (a Schedule_Runner task dict)."""
+        finished = time.time() if finished is None else finished
+        started = task.get("started", finished) if started is None else started
+        with self.lock:
+            row = np.zeros(1, dtype=ROW)
+            row["scheduled"] = int(task["time"].timestamp())
+            row["started"] = started
+            row["finished"] = finished
+            row["value"] = float(task["value"])
+            row["device"] = self._id("device", task["device"])
+            row["action"] = self._id("action", task["action"])
+            row["status"] = self._id("status", status)
+            day = datetime.fromtimestamp(started).strftime("%Y-%m-%d")
+            self.writer.append(os.path.join(self.directory, f"{day}.rows"), row.tobytes())
+
+    def compact(self, today=None):
+        """Merge the row files of finished days into their month chunks."""
+        today = today or datetime.now().strftime("%Y-%m-%d")
+        self.writer.flush()
+        with self.lock:
+            for path in sorted(glob.glob(os.path.join(self.directory, "*.rows"))):
+                day = os.path.basename(path)[:-len(".rows")]
+                if day >= today:
+                    continue
+                rows = np.fromfile(path, dtype=ROW)
+                chunk = os.path.join(self.directory, f"{day[:7]}.npz")
+                if os.path.exists(chunk):
+                    with np.load(chunk) as old:
+                        merged = np.zeros(len(old["started"]) + len(rows), dtype=ROW)
+                        for name in COLUMNS:
+                            merged[name][:len(old[name])] = old[name]
+                    merged[len(merged) - len(rows):] = rows
+                    rows = merged
+                rows = rows[np.argsort(rows["started"], kind="stable")]
+                data = io.BytesIO()
+                np.savez(data, **{name: rows[name] for name in COLUMNS})
+                persistence.atomic_write(chunk, data.getvalue(), category="history")
+                os.remove(path)
+
+    def _chunk(self, path, columns):
+        mtime = os.stat(path).st_mtime_ns
+        cached = self.cache.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = self.cache[path] = (mtime, {})
+        data = cached[1]
+        missing = [c for c in columns if c not in data]
+        if missing:
+            if path.endswith(".npz"):
+                with np.load(path) as f:
+                    for c in missing:
+                        data[c] = f[c]
+            else:
+                rows = np.fromfile(path, dtype=ROW)
+                rows = rows[np.argsort(rows["started"], kind="stable")]
+                for c in COLUMNS:
+                    data[c] = rows[c]
+        return {c: data[c] for c in columns}
+
+    def query(self, start=None, end=None, columns=COLUMNS):
+        """Columns of all tasks started in [start, end) (epoch seconds or
+        datetimes), concatenated over the chunks covering that range."""
+        start = _epoch(start, float("-inf"))
+        end = _epoch(end, float("inf"))
+        self.writer.flush()
+        columns = list(dict.fromkeys(("started",) + tuple(columns)))
+        paths = sorted(glob.glob(os.path.join(self.directory, "*.npz")) +
+                       glob.glob(os.path.join(self.directory, "*.rows")))
+        parts = []
+        for path in paths:
+            name = os.path.basename(path).split(".")[0]
+            first, last = _period(name)
+            if last <= start or first >= end:
+                continue
+            chunk = self._chunk(path, columns)
+            lo, hi = np.searchsorted(chunk["started"], [start, end])
+            if hi > lo:
+                parts.append({c: chunk[c][lo:hi] for c in columns})
+        return {c: (np.concatenate([p[c] for p in parts]) if parts else np.zeros(0, ROW[c]))
+                for c in columns}
+
+    def name_ids(self, field, match):
+        """Ids of the names in field equal to match or whose last path
+        component starts with it, so "valve2" also matches "rack2/valve2"
+        and "motor" matches every motor."""
+        return np.array([i for i, n in enumerate(self.names[field])
+                         if n == match or n.replace(":", "/").split("/")[-1].startswith(match)],
+                        dtype=np.int64)
+
+    def close(self):
+        self.writer.close()
+
+    def batch_ends(self, start=None, end=None):
+        """Start times of the batch_complete markers."""
+        marker = self.ids["action"].get("batch_complete")
+        if marker is None:
+            return np.zeros(0)
+        cols = self.query(start, end, ("action",))
+        return cols["started"][cols["action"] == marker]
+
+    def seconds_per_batch(self, device, start=None, end=None):
+        """Total open time of device per batch. Returns (batch end times,
+        seconds); tasks after the last marker form a final open batch."""
+        cols = self.query(start, end, ("finished", "device", "status"))
+        done = self.ids["status"].get("done", -1)
+        mask = np.isin(cols["device"], self.name_ids("device", device)) & (cols["status"] == done)
+        ends = self.batch_ends(start, end)
+        batch = np.searchsorted(ends, cols["started"][mask])
+        seconds = np.bincount(batch, weights=cols["finished"][mask] - cols["started"][mask],
+                              minlength=len(ends) + 1)
+        return np.append(ends, np.nan), seconds
+
+    def late(self, device, threshold, start=None, end=None):
+        """Tasks on matching devices that started more than threshold s late."""
+        cols = self.query(start, end, ("scheduled", "device", "action", "value"))
+        lateness = cols["started"] - cols["scheduled"]
+        mask = np.isin(cols["device"], self.name_ids("device", device)) & (lateness > threshold)
+        result = {c: v[mask] for c, v in cols.items()}
+        result["lateness"] = lateness[mask]
+        return result
+
+
+def _epoch(value, default):
+    if value is None:
+        return default
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return float(value)
+
+
+def _period(name):
+    """Epoch range covered by a YYYY-MM chunk or a YYYY-MM-DD row file."""
+    if len(name) == 7:
+        first = datetime.strptime(name, "%Y-%m")
+        last = first.replace(year=first.year + first.month // 12, month=first.month % 12 + 1)
+    else:
+        first = datetime.strptime(name, "%Y-%m-%d")
+        last = datetime.fromordinal(first.toordinal() + 1)
+    return first.timestamp(), last.timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the execution history")
+    sub = parser.add_subparsers(dest="command", required=True)
+    seconds = sub.add_parser("valve-seconds", help="open time of a valve per batch")
+    seconds.add_argument("device")
+    late = sub.add_parser("late", help="tasks that started late")
+    late.add_argument("device", help="device name or prefix, e.g. motor")
+    late.add_argument("--threshold", type=float, default=60.0, help="seconds")
+    sub.add_parser("compact", help="merge finished days into month chunks")
+    for p in (seconds, late):
+        p.add_argument("--since", type=lambda s: datetime.strptime(s, "%Y-%m-%d"))
+        p.add_argument("--until", type=lambda s: datetime.strptime(s, "%Y-%m-%d"))
+    args = parser.parse_args()
+
+    store = HistoryStore()
+    start = time.perf_counter()
+    if args.command == "valve-seconds":
+        ends, totals = store.seconds_per_batch(args.device, args.since, args.until)
+        for end, total in zip(ends, totals):
+            label = "open batch" if np.isnan(end) else f"batch ending {datetime.fromtimestamp(end):%Y-%m-%d}"
+            print(f"{label}: {total:.0f} s")
+    elif args.command == "late":
+        result = store.late(args.device, args.threshold, args.since, args.until)
+        names = store.names["device"]
+        for t, d, lateness in zip(result["scheduled"], result["device"], result["lateness"]):
+            print(f"{datetime.fromtimestamp(t):%Y-%m-%d %H:%M:%S} {names[d]} {lateness:.1f} s late")
+        print(f"{len(result['lateness'])} late task(s)")
+    print(f"({(time.perf_counter() - start) * 1000:.1f} ms)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,399 @@
+"""Move queue between the runner and a motor controller.
+
+Each controller listens on a Unix socket (Axis.command_socket) and runs
+the moves it receives one after another; the next move starts in the
+same control cycle the previous one settles in. The protocol is one
+JSON object per line, like schedule_server.py:
+
+    {"op": "move", "id": "t1", "target": 120.0, "timeout": 120}
+        -> {"ok": true, "id": "t1", "queued": 1}
+    {"op": "status"} -> {"ok": true, "active": "t1", "queued": ["t2"]}
+    {"op": "prepare"} -> {"ok": true, "vin_mv": 12100, "status": 0, "cleared": 0}
+    {"op": "watch"} -> {"ok": true}, then every event of every move
+
+followed, on the connection that submitted the move, by events:
+
+    {"event": "started", "id": "t1", "target": 120.0, "queued_at": ..., "started": ...}
+    {"event": "settled", "id": "t1", ..., "finished": ..., "position": 119.9}
+    {"event": "failed", "id": "t1", ..., "error": "I2C error"}
+
+    python motion_queue.py motor1 move 120 --wait
+    python motion_queue.py motor1 watch
+
+Targets are relative: the controller moves its origin to the target
+every time a move settles, like a target-file move, so each target is
+the distance from where the previous move settled.
+"""
+
+import argparse
+import collections
+import itertools
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT = 10.0  # s to wait for a controller that is still starting
+PREPARE_WAIT = 2.0  # s the server waits for the control loop to answer a prepare
+FINAL_EVENTS = ("settled", "failed")
+
+
+class Move:
+    def __init__(self, move_id, target, timeout=None):
+        self.id = move_id
+        self.target = float(target)  # from where the previous move settled
+        self.timeout = timeout
+        self.queued_at = time.time()
+        self.started = None
+        self.deadline = None
+
+    def event(self, name, **fields):
+        return dict({"event": name, "id": self.id, "target": self.target,
+                     "queued_at": self.queued_at, "started": self.started}, **fields)
+
+
+class Prepare:
+    """A prepare request, answered by the control loop."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.reply = None
+
+    def answer(self, reply):
+        self.reply = reply
+        self.done.set()
+
+
+class MoveQueue:
+    """Moves waiting for a controller, and the listeners of their events.
+
+    The control loop calls start(), settled() and failed(); events are
+    handed to per-connection queues and never block the loop. Prepare
+    requests are collected here and answered by the loop through
+    take_prepares(), since only it may talk to the driver.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = collections.deque()
+        self.active = None
+        self.listeners = {}  # move id -> event queue of the submitting connection
+        self.watchers = set()
+        self.prepares = []
+        self.ids = itertools.count(1)
+
+    def submit(self, target, move_id=None, timeout=None, listener=None):
+        with self.lock:
+            move = Move(move_id or f"move-{next(self.ids)}", target, timeout)
+            self.pending.append(move)
+            if listener is not None:
+                self.listeners[move.id] = listener
+            return move, len(self.pending)
+
+    def start(self):
+        """Take the next move, if any, and mark it active."""
+        with self.lock:
+            if self.active is not None or not self.pending:
+                return None
+            move = self.active = self.pending.popleft()
+        move.started = time.time()
+        if move.timeout:
+            move.deadline = time.monotonic() + move.timeout
+        self._publish(move, move.event("started"))
+        return move
+
+    def expired(self):
+        move = self.active
+        return move is not None and move.deadline is not None and time.monotonic() > move.deadline
+
+    def settled(self, position):
+        self._finish(self.active, "settled", position=position)
+
+    def failed(self, error, position=None):
+        self._finish(self.active, "failed", error=str(error), position=position)
+
+    def fail_all(self, error):
+        """Fail the active move and everything queued behind it."""
+        with self.lock:
+            moves = ([self.active] if self.active else []) + list(self.pending)
+            self.pending.clear()
+        for move in moves:
+            self._finish(move, "failed", error=str(error))
+
+    def _finish(self, move, name, **fields):
+        if move is None:
+            return
+        self._publish(move, move.event(name, finished=time.time(), **fields), final=True)
+        with self.lock:
+            if self.active is move:
+                self.active = None
+
+    def _publish(self, move, event, final=False):
+        log.info("Move %s %s", move.id, event["event"])
+        with self.lock:
+            listener = self.listeners.pop(move.id, None) if final else self.listeners.get(move.id)
+            targets = set(self.watchers)
+            if listener is not None:
+                targets.add(listener)
+        for target in targets:
+            target.put(event)
+
+    def prepare(self, timeout=PREPARE_WAIT):
+        """Ask the control loop to get ready for a move and wait for it."""
+        request = Prepare()
+        with self.lock:
+            self.prepares.append(request)
+        if not request.done.wait(timeout):
+            return {"ok": False, "error": "control loop did not answer"}
+        return request.reply
+
+    def take_prepares(self):
+        with self.lock:
+            requests, self.prepares = self.prepares, []
+        return requests
+
+    def status(self):
+        with self.lock:
+            return {"active": self.active.id if self.active else None,
+                    "queued": [m.id for m in self.pending]}
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        moves = self.server.moves
+        events = queue.Queue()
+        writer = threading.Thread(target=self._send_events, args=(events,), daemon=True)
+        writer.start()
+        try:
+            for line in self.rfile:
+                try:
+                    message = json.loads(line)
+                    op = message.get("op")
+                    if op == "move":
+                        move, queued = moves.submit(message["target"], message.get("id"),
+                                                    message.get("timeout"), events)
+                        reply = {"ok": True, "id": move.id, "queued": queued}
+                    elif op == "status":
+                        reply = dict(moves.status(), ok=True)
+                    elif op == "prepare":
+                        reply = moves.prepare()
+                    elif op == "watch":
+                        with moves.lock:
+                            moves.watchers.add(events)
+                        reply = {"ok": True}
+                    else:
+                        reply = {"ok": False, "error": f"unknown op {op!r}"}
+                except (ValueError, KeyError, TypeError) as e:
+                    reply = {"ok": False, "error": str(e)}
+                events.put(reply)
+        finally:
+            with moves.lock:
+                moves.watchers.discard(events)
+            events.put(None)
+            writer.join(1.0)
+
+    def _send_events(self, events):
+        while True:
+            message = events.get()
+            if message is None:
+                return
+            try:
+                self.wfile.write(json.dumps(message).encode() + b"\n")
+                self.wfile.flush()
+            except OSError:
+                return
+
+
+class CommandServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path, moves):
+    """Listen for moves on the Unix socket path in a background thread."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.remove(path)
+    server = CommandServer(path, Handler)
+    server.moves = moves
+    threading.Thread(target=server.serve_forever, name="motion-queue", daemon=True).start()
+    return server
+
+
+class MotorClient:
+    """Runner side of the protocol. Events arrive on a reader thread and
+    are passed to the callbacks given to move()."""
+
+    def __init__(self, path, connect_timeout=CONNECT_TIMEOUT):
+        deadline = time.monotonic() + connect_timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+                break
+            except OSError:
+                sock.close()
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.2)
+        self.sock = sock
+        self.file = sock.makefile("rwb")
+        self.lock = threading.Lock()
+        self.replies = queue.Queue()
+        self.callbacks = {}  # move id -> (on_event, done Event, final event holder)
+        self.on_watch = None
+        self.watching = False
+        self.closed = False
+        self.reader = threading.Thread(target=self._read, name="motor-client", daemon=True)
+        self.reader.start()
+
+    def _read(self):
+        try:
+            for line in self.file:
+                message = json.loads(line)
+                if "event" not in message:
+                    self.replies.put(message)
+                    continue
+                if self.on_watch is not None:
+                    self.on_watch(message)
+                entry = self.callbacks.get(message["id"])
+                if entry is None:
+                    continue
+                on_event, done, result = entry
+                if message["event"] in FINAL_EVENTS:
+                    result.append(message)
+                    self.callbacks.pop(message["id"], None)
+                if on_event is not None:
+                    try:
+                        on_event(message)
+                    except Exception:
+                        log.exception("Move event callback failed")
+                if result:
+                    done.set()
+        except (OSError, ValueError):
+            pass
+        self.closed = True
+        self.replies.put({"ok": False, "error": "controller closed the connection"})
+        # Moves in flight will never report; fail them here
+        for move_id, (on_event, done, result) in list(self.callbacks.items()):
+            event = {"event": "failed", "id": move_id, "error": "controller connection lost",
+                     "finished": time.time()}
+            result.append(event)
+            if on_event is not None:
+                on_event(event)
+            done.set()
+        self.callbacks.clear()
+
+    def request(self, message, timeout=5.0):
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("controller connection is closed")
+            self.file.write(json.dumps(message).encode() + b"\n")
+            self.file.flush()
+            try:
+                reply = self.replies.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError(f"no reply to {message['op']} in {timeout} s") from None
+        if not reply.get("ok"):
+            raise RuntimeError(reply.get("error", "request failed"))
+        return reply
+
+    def move(self, target, move_id=None, timeout=None, on_event=None):
+        """Queue a move; returns its id. on_event(event) is called for its
+        started and settled/failed events."""
+        done, result = threading.Event(), []
+        if move_id is not None:
+            self.callbacks[move_id] = (on_event, done, result)
+        reply = self.request({"op": "move", "id": move_id, "target": target, "timeout": timeout})
+        if move_id is None:
+            self.callbacks[reply["id"]] = (on_event, done, result)
+        return reply["id"]
+
+    def wait(self, move_id, timeout=None):
+        """Block until move_id settles or fails and return the final event."""
+        entry = self.callbacks.get(move_id)
+        if entry is None:
+            raise KeyError(move_id)
+        _, done, result = entry
+        if not done.wait(timeout):
+            raise TimeoutError(f"move {move_id} did not finish in {timeout} s")
+        return result[0]
+
+    def follow(self, move_id, on_event=None):
+        """Receive the events of a move queued by another connection, e.g.
+        one sent before the runner restarted."""
+        self.callbacks[move_id] = (on_event, threading.Event(), [])
+        if not self.watching:
+            self.request({"op": "watch"})
+            self.watching = True
+
+    def forget(self, move_id):
+        """Stop following move_id. Returns False if it already finished."""
+        return self.callbacks.pop(move_id, None) is not None
+
+    def status(self):
+        return self.request({"op": "status"})
+
+    def prepare(self):
+        """Have the controller clear latched faults and check its driver;
+        raises RuntimeError if it is not fit to move."""
+        return self.request({"op": "prepare"}, timeout=PREPARE_WAIT + 3.0)
+
+    def watch(self, on_event):
+        """Receive the events of every move, including other clients'."""
+        self.on_watch = on_event
+        self.request({"op": "watch"})
+        self.watching = True
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.file.close()
+        self.sock.close()
+
+
+def main():
+    import racks
+
+    parser = argparse.ArgumentParser(description="Send moves to a motor controller")
+    parser.add_argument("axis", help="axis name, e.g. motor1 or rack2/motor1")
+    sub = parser.add_subparsers(dest="command", required=True)
+    move = sub.add_parser("move")
+    move.add_argument("target", type=float)
+    move.add_argument("--wait", action="store_true")
+    sub.add_parser("status")
+    sub.add_parser("prepare")
+    sub.add_parser("watch")
+    args = parser.parse_args()
+
+    rack_name, _, name = args.axis.rpartition("/")
+    axis = racks.load_racks().axis(rack_name or None, name)
+    client = MotorClient(axis.command_socket, connect_timeout=0)
+    if args.command == "move":
+        move_id = client.move(args.target, on_event=print)
+        print(f"queued {move_id}")
+        if args.wait:
+            client.wait(move_id)
+    elif args.command == "status":
+        print(client.status())
+    elif args.command == "prepare":
+        print(client.prepare())
+    else:
+        client.watch(print)
+        try:
+            client.reader.join()
+        except KeyboardInterrupt:
+            pass
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,28 @@
+import argparse
+import logging
+import sys
 import time
-import pigpio
-import motoron
+import hal
 import rotary_encoder
-import os
-import sys
+import controller_params
+import axis_state
+import heartbeat
+import automation_logging
+import metrics
+import motion_queue
+import power_budget
+import racks
+import sampling_profiler
+
+log = logging.getLogger("motor2")
+
+registry = metrics.Registry()
+i2c_retries = registry.counter("axis_i2c_retries_total", "I2C reads retried after CRC errors", labels=("op",))
+i2c_errors = registry.counter("axis_i2c_errors_total", "I2C operations that failed after retries", labels=("op",))
+vin_voltage = registry.gauge("axis_vin_voltage_mv", "Motoron VIN voltage")
+motor_current = registry.gauge("axis_current_sense", "Motoron processed current sense while moving")
+loop_timer = metrics.LoopTimer(registry, "axis", 0.05)
+VIN_SAMPLE_INTERVAL = 2.0  # s
 
 class FilteredPID:
     def __init__(self, Kp, Ki, Kd, d_filter_alpha=0.3, static_feedforward=0):
@@ -51,7 +70,8 @@ class FilteredPID:
 
         self.last_error = error
 
-        print(f"P: {P_term:.2f}, I: {I_term:.2f}, D: {D_term:.2f}, FF: {FF_term:.2f}, Output: {output:.2f}, {self.output_max}")
+        log.debug("P: %.2f, I: %.2f, D: %.2f, FF: %.2f, Output: %.2f, %s", P_term, I_term, D_term, FF_term, output,
+                  self.output_max, extra={"rate_key": "pid"})
         return max(min(output, self.output_max), self.output_min)
 
 def safe_get_status_flags(mc, retries=3, delay=0.05):
@@ -59,141 +79,321 @@ def safe_get_status_flags(mc, retries=3, delay=0.05):
         try:
             return mc.get_status_flags()
         except RuntimeError as e:
-            print(f"[WARN] CRC error (attempt {i+1}/{retries}): {e}")
+            log.warning("CRC error (attempt %d/%d): %s", i + 1, retries, e)
+            i2c_retries.inc(op="status")
             time.sleep(delay)
+    i2c_errors.inc(op="status")
     raise RuntimeError("Failed to get status flags after retries.")
 
 # Initialize Motoron
 reference_mv = 3300
-vin_type = motoron.VinSenseType.MOTORON_256
+vin_type = hal.VIN_SENSE_MOTORON_256
 min_vin_voltage_mv = 4500
 
-mc = motoron.MotoronI2C(bus=3)
-mc.reinitialize()
-mc.clear_reset_flag()
-mc.set_error_response(motoron.ERROR_RESPONSE_COAST)
-mc.set_command_timeout_milliseconds(500)
-mc.set_max_acceleration(2, 20)
-mc.set_max_deceleration(2, 500)
-mc.clear_motor_fault()
+def init_motor(axis, checkpoint):
+    """Set up the Motoron. Returns (mc, saved), saved being the checkpoint
+    to warm start from, or None if the board lost power since it was
+    written or it is too old."""
+    mc = hal.motor_driver(bus=axis.i2c_bus, address=axis.address)
+    power_lost_mask = (1 << hal.STATUS_FLAG_RESET) | (1 << hal.STATUS_FLAG_NO_POWER_LATCHED)
+
+    def reset():
+        mc.reinitialize()
+        mc.clear_reset_flag()
+
+    # Both axes share the board, so the power-loss verdict is made once per board
+    epoch = axis_state.board_epoch(axis.board_file, lambda: bool(safe_get_status_flags(mc) & power_lost_mask),
+                                   reset)
+    checkpoint.board_epoch = epoch
+    saved = checkpoint.load()
+    if saved is not None and saved["board_epoch"] == epoch and time.time() - saved["saved_at"] < axis_state.MAX_AGE:
+        # Warm restart: the checkpointed position is still valid.
+        mc.clear_latched_status_flags(1 << hal.STATUS_FLAG_COMMAND_TIMEOUT_LATCHED)
+    else:
+        if saved is not None:
+            log.info("Cold start: checkpoint from %s is stale", time.ctime(saved["saved_at"]))
+        saved = None
+    mc.set_error_response(hal.ERROR_RESPONSE_COAST)
+    mc.set_command_timeout_milliseconds(500)
+    mc.set_max_acceleration(axis.channel, 20)
+    mc.set_max_deceleration(axis.channel, 500)
+    mc.clear_motor_fault()
+    return mc, saved
 
 error_mask = (
-  (1 << motoron.STATUS_FLAG_PROTOCOL_ERROR) |
-  (1 << motoron.STATUS_FLAG_CRC_ERROR) |
-  (1 << motoron.STATUS_FLAG_COMMAND_TIMEOUT_LATCHED) |
-  (1 << motoron.STATUS_FLAG_MOTOR_FAULT_LATCHED) |
-  (1 << motoron.STATUS_FLAG_NO_POWER_LATCHED) |
-  (1 << motoron.STATUS_FLAG_RESET) |
-  (1 << motoron.STATUS_FLAG_COMMAND_TIMEOUT))
+  (1 << hal.STATUS_FLAG_PROTOCOL_ERROR) |
+  (1 << hal.STATUS_FLAG_CRC_ERROR) |
+  (1 << hal.STATUS_FLAG_COMMAND_TIMEOUT_LATCHED) |
+  (1 << hal.STATUS_FLAG_MOTOR_FAULT_LATCHED) |
+  (1 << hal.STATUS_FLAG_NO_POWER_LATCHED) |
+  (1 << hal.STATUS_FLAG_RESET) |
+  (1 << hal.STATUS_FLAG_COMMAND_TIMEOUT))
 
 def safe_get_vin_voltage_mv(mc, reference_mv, vin_type, retries=3, delay=0.05):
     for i in range(retries):
         try:
             return mc.get_vin_voltage_mv(reference_mv, vin_type)
         except RuntimeError as e:
-            print(f"[WARN] CRC error on VIN read (attempt {i+1}/{retries}): {e}")
+            log.warning("CRC error on VIN read (attempt %d/%d): %s", i + 1, retries, e)
+            i2c_retries.inc(op="vin")
             time.sleep(delay)
+    i2c_errors.inc(op="vin")
     raise RuntimeError("Failed to read VIN voltage after retries.")
 
 
-def check_for_problems():
+def safe_get_current_sense(mc, channel, retries=3, delay=0.05):
+    for i in range(retries):
+        try:
+            return mc.get_current_sense_processed(channel)
+        except RuntimeError as e:
+            log.warning("CRC error on current sense read (attempt %d/%d): %s", i + 1, retries, e)
+            i2c_retries.inc(op="current")
+            time.sleep(delay)
+    i2c_errors.inc(op="current")
+    raise RuntimeError("Failed to read current sense after retries.")
+
+
+def check_for_problems(mc):
     status = safe_get_status_flags(mc)
     if (status & error_mask):
         mc.reset()
-        print("Controller error: 0x%x" % status, file=sys.stderr)
+        log.error("Controller error: 0x%x", status)
         sys.exit(1)
 
     voltage_mv = mc.get_vin_voltage_mv(reference_mv, vin_type)
     if voltage_mv < min_vin_voltage_mv:
         mc.reset()
-        print("VIN voltage too low:", voltage_mv, file=sys.stderr)
+        log.error("VIN voltage too low: %s", voltage_mv)
         sys.exit(1)
 
-# Rotary Encoder Setup
-ENCODER_A = 26
-ENCODER_B = 21
-position = 0
-ENCODER_GAIN = 0.45
-
-def callback(way):
-    global position
-    position += way
-
-pi = pigpio.pi()
-decoder = rotary_encoder.decoder(pi, ENCODER_A, ENCODER_B, callback)
-
-# PID Controller Setup
-Kp, Ki, Kd, alpha, static_feedforward = 6, 4, 1, 0.2, 118
-pid = FilteredPID(Kp, Ki, Kd, alpha, static_feedforward)
-pid.setpoint = 0
-
-last_setpoint = 0
-setpoint_active = False
-settle_counter = 0
-settle_threshold = 20
-last_position = None
-
-try:
-    while True:
-        try:
-            with open("motor2_target.txt", "r") as f:
-                file_value = float(f.read().strip())
-        except Exception:
-            file_value = 0
-
-        current_position = position * ENCODER_GAIN
+# Latched flags a prepare request may clear; a reset or power loss is not
+# cleared, since the position is no longer known
+clearable_mask = (
+  (1 << hal.STATUS_FLAG_COMMAND_TIMEOUT_LATCHED) |
+  (1 << hal.STATUS_FLAG_MOTOR_FAULT_LATCHED))
+
+def prepare_driver(mc):
+    """Get the driver ready for a move: clear latched faults, then check
+    the status flags and VIN. Returns the reply to a prepare request."""
+    try:
+        status = safe_get_status_flags(mc)
+        cleared = status & clearable_mask
+        if cleared:
+            mc.clear_latched_status_flags(cleared)
+            mc.clear_motor_fault()
+            status = safe_get_status_flags(mc)
+        voltage_mv = safe_get_vin_voltage_mv(mc, reference_mv, vin_type)
+    except RuntimeError as e:
+        return {"ok": False, "error": str(e)}
+    vin_voltage.set(voltage_mv)
+    if status & error_mask:
+        return {"ok": False, "error": f"driver error flags 0x{status:x}"}
+    if voltage_mv < min_vin_voltage_mv:
+        return {"ok": False, "error": f"VIN {voltage_mv} mV below {min_vin_voltage_mv} mV"}
+    return {"ok": True, "status": status, "cleared": cleared, "vin_mv": voltage_mv}
 
-        if file_value != 0 and not setpoint_active:
-            target_position = file_value
+# Rotary Encoder Setup
+BATCHED_ENCODER = False  # decode edges in blocks from the pigpio notification pipe
+
+# Tunable parameters, hot-reloaded from motor2_params.json (rackN-motor2_params.json on other racks)
+DEFAULT_PARAMS = {
+    "Kp": 6, "Ki": 4, "Kd": 1, "alpha": 0.2, "static_feedforward": 118,
+    "integral_limit": 20, "output_limit": 600, "slowdown_distance": 10,
+    "deadband": 5, "settle_tolerance": 1, "settle_threshold": 20,
+    "encoder_gain": 0.45,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Motor 2 position controller")
+    parser.add_argument("--rack", help="rack in racks.json (default: the first)")
+    args = parser.parse_args()
+    axis = racks.load_racks().axis(args.rack, "motor2")
+
+    automation_logging.setup_logging(axis.id, axis=axis.id)
+    sampling_profiler.install(axis.id)
+
+    checkpoint = axis_state.AxisCheckpoint(axis.state_file)
+    mc, saved = init_motor(axis, checkpoint)
+
+    pi = hal.gpio()
+    if BATCHED_ENCODER and hasattr(pi, "notify_open"):
+        decoder = rotary_encoder.batch_decoder(pi, axis.encoder_a, axis.encoder_b)
+    else:
+        decoder = rotary_encoder.decoder(pi, axis.encoder_a, axis.encoder_b)
+    encoder = decoder.counter
+    registry.counter("axis_encoder_edges_total", "Counted encoder edges", fn=lambda: encoder.edges)
+    registry.gauge("axis_encoder_count", "Current encoder count", fn=lambda: encoder.snapshot()[0])
+    # Shares the rack's supply with the other motors, which move at the same time
+    budget = power_budget.PowerShare(axis.rack.power_file, axis.index, axis.rack.power)
+    registry.gauge("axis_power_factor", "Share of the requested speed the power budget allows",
+                   fn=lambda: budget.commanded / budget.requested if budget.requested else 1.0)
+    metrics.serve(registry, axis.metrics_port)
+    if saved:
+        encoder.set(saved["count"])
+
+    params = controller_params.ParamWatcher(axis.params_file, DEFAULT_PARAMS)
+
+    # PID Controller Setup
+    pid = FilteredPID(DEFAULT_PARAMS["Kp"], DEFAULT_PARAMS["Ki"], DEFAULT_PARAMS["Kd"],
+                      DEFAULT_PARAMS["alpha"], DEFAULT_PARAMS["static_feedforward"])
+    pid.setpoint = 0
+
+    def apply_params(p):
+        pid.Kp, pid.Ki, pid.Kd = p["Kp"], p["Ki"], p["Kd"]
+        pid.d_filter_alpha = p["alpha"]
+        pid.static_feedforward = p["static_feedforward"]
+        pid.integral_limit = p["integral_limit"]
+        pid.output_max = p["output_limit"]
+        pid.output_min = -p["output_limit"]
+
+    last_setpoint = 0
+    setpoint_active = False
+    settle_counter = 0
+    last_position = None
+
+    if saved:
+        pid.integral = saved["integral"]
+        pid.last_error = saved["last_error"]
+        if saved["active"]:
+            target_position = saved["target"]
             pid.setpoint = target_position
             setpoint_active = True
+        log.info("Warm start: count %s, target %s, active %s", saved["count"], saved["target"], saved["active"])
+
+    # Moves from the runner; the target file still works for manual moves
+    moves = motion_queue.MoveQueue()
+    command_server = motion_queue.serve(axis.command_socket, moves)
+    move = None  # queued move being run, None for a target-file or resumed move
+
+    def begin_next():
+        nonlocal move, target_position, setpoint_active
+        move = moves.start()
+        if move is None:
+            return False
+        target_position = move.target
+        pid.setpoint = target_position
+        setpoint_active = True
+        return True
+
+    alive = heartbeat.Heartbeat(axis.id)
+    last_vin_sample = 0
+
+    try:
+        while True:
+            alive.beat()
+            cycle_start = time.perf_counter()
+            loop_timer.tick(cycle_start)
+            sample_interval = power_budget.SAMPLE_INTERVAL if setpoint_active else VIN_SAMPLE_INTERVAL
+            if cycle_start - last_vin_sample >= sample_interval:
+                last_vin_sample = cycle_start
+                voltage_mv, current = None, 0
+                try:
+                    voltage_mv = safe_get_vin_voltage_mv(mc, reference_mv, vin_type)
+                    vin_voltage.set(voltage_mv)
+                except (OSError, RuntimeError) as e:
+                    log.warning("%s", e)
+                if setpoint_active:
+                    try:
+                        current = safe_get_current_sense(mc, axis.channel)
+                        motor_current.set(current)
+                    except (OSError, RuntimeError) as e:
+                        log.warning("Current sense read failed: %s", e)
+                        current = None
+                budget.sample(current, voltage_mv)
+            params.poll(apply_params)
+            p = params.values
+
+            count, _ = encoder.snapshot()
+            current_position = count * p["encoder_gain"]
+
+            if not setpoint_active and not begin_next():
+                file_value = axis.read_target()
+                if file_value != 0:
+                    target_position = file_value
+                    pid.setpoint = target_position
+                    setpoint_active = True
+
+            if setpoint_active and moves.expired():
+                log.warning("Move %s timed out at %.3f", move.id, current_position)
+                moves.failed("timed out", current_position)
+                setpoint_active = False
+                pid.setpoint = 0
+                settle_counter = 0
 
-        if setpoint_active:
-            loop_start = time.time()
-            #check_for_problems()
-            current_position = position * ENCODER_GAIN
-            error = target_position - current_position
-
-            if abs(error) < 10:
-                max_speed = int(600 * (abs(error) / 10))
-                max_speed = max(600, max_speed)
-                pid.output_max = max_speed
-            else:
-                pid.output_max = 600
-
-            motor_speed = int(pid.compute(current_position))
-
-            if abs(motor_speed) < 5:
-                motor_speed = 0
-
-            try:
-                mc.set_speed(2, motor_speed)
-            except Exception as e:
-                print("I2C Error:", e)
-                mc.reset()
-                break
-
-            print(f"Position: {current_position}deg, Target: {target_position}deg, Speed: {motor_speed}")
-
-            if error < 1:
-                settle_counter += 1
-                if settle_counter >= settle_threshold:
-                    mc.set_speed(2, 0)
-                    setpoint_active = False
-                    pid.setpoint = 0
-                    with open("motor2_target.txt", "w") as f:
-                        f.write("0")
+            if setpoint_active:
+                loop_start = time.time()
+                #check_for_problems()
+                count, _ = encoder.snapshot()
+                current_position = count * p["encoder_gain"]
+                error = target_position - current_position
+
+                if abs(error) < p["slowdown_distance"]:
+                    max_speed = int(p["output_limit"] * (abs(error) / p["slowdown_distance"]))
+                    max_speed = max(p["output_limit"], max_speed)
+                    pid.output_max = max_speed
+                else:
+                    pid.output_max = p["output_limit"]
+
+                motor_speed = int(pid.compute(current_position))
+
+                if abs(motor_speed) < p["deadband"]:
+                    motor_speed = 0
+                motor_speed = budget.limit(motor_speed)
+
+                try:
+                    mc.set_speed(axis.channel, motor_speed)
+                except Exception as e:
+                    log.error("I2C Error: %s", e)
+                    i2c_errors.inc(op="set_speed")
+                    mc.reset()
+                    moves.fail_all(f"I2C error: {e}")
+                    break
+
+                log.debug("Position: %.3fdeg, Target: %sdeg, Speed: %d", current_position, target_position, motor_speed,
+                          extra={"rate_key": "position"})
+
+                if error < p["settle_tolerance"]:
+                    settle_counter += 1
+                    if settle_counter >= p["settle_threshold"]:
+                        mc.set_speed(axis.channel, 0)
+                        setpoint_active = False
+                        pid.setpoint = 0
+                        settle_counter = 0
+                        encoder.rebase(target_position/p["encoder_gain"])
+                        if move is not None:
+                            moves.settled(current_position)
+                        else:
+                            axis.write_target(0)
+                        begin_next()  # queued moves follow without an idle cycle
+                else:
                     settle_counter = 0
-                    position -= target_position/ENCODER_GAIN
+                    last_position = None
             else:
-                settle_counter = 0
-                last_position = None
-        else:
-            mc.set_speed(2, 0)
-
-        time.sleep(0.05)
-
-except KeyboardInterrupt:
-    mc.set_speed(2, 0)
-    decoder.cancel()
-    pi.stop()
\ No newline at end of file
+                mc.set_speed(axis.channel, 0)
+                budget.idle()
+
+            prepares = moves.take_prepares()
+            if prepares:
+                reply = prepare_driver(mc)
+                if not setpoint_active:
+                    # Start the next move with a fresh PID clock, not one from before a pause
+                    pid.last_time = None
+                    pid.last_derivative = 0
+                log.info("Prepared for a move: %s", reply)
+                for request in prepares:
+                    request.answer(reply)
+
+            checkpoint.save(encoder.snapshot()[0], pid.setpoint, pid.integral, pid.last_error, setpoint_active)
+            time.sleep(0.05)
+
+    except KeyboardInterrupt:
+        mc.set_speed(axis.channel, 0)
+        budget.close()
+        moves.fail_all("controller stopped")
+        command_server.server_close()
+        checkpoint.close()
+        decoder.cancel()
+        pi.stop()
+
+if __name__ == "__main__":
+    main()
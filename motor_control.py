@@ -1,6 +1,5 @@
 import time
-import pigpio
-import motoron
+import hal
 import sys
 import select
 from simple_pid import PID
@@ -59,25 +58,25 @@ class FilteredPID:
 
 
 
-mc = motoron.MotoronI2C(bus=3)
+mc = hal.motor_driver(bus=3)
 
 # Parameters for the VIN voltage measurement.
 reference_mv = 3300
-vin_type = motoron.VinSenseType.MOTORON_256
+vin_type = hal.VIN_SENSE_MOTORON_256
 min_vin_voltage_mv = 4500
 
 error_mask = (
-  (1 << motoron.STATUS_FLAG_PROTOCOL_ERROR) |
-  (1 << motoron.STATUS_FLAG_CRC_ERROR) |
-  (1 << motoron.STATUS_FLAG_COMMAND_TIMEOUT_LATCHED) |
-  (1 << motoron.STATUS_FLAG_MOTOR_FAULT_LATCHED) |
-  (1 << motoron.STATUS_FLAG_NO_POWER_LATCHED) |
-  (1 << motoron.STATUS_FLAG_RESET) |
-  (1 << motoron.STATUS_FLAG_COMMAND_TIMEOUT))
+  (1 << hal.STATUS_FLAG_PROTOCOL_ERROR) |
+  (1 << hal.STATUS_FLAG_CRC_ERROR) |
+  (1 << hal.STATUS_FLAG_COMMAND_TIMEOUT_LATCHED) |
+  (1 << hal.STATUS_FLAG_MOTOR_FAULT_LATCHED) |
+  (1 << hal.STATUS_FLAG_NO_POWER_LATCHED) |
+  (1 << hal.STATUS_FLAG_RESET) |
+  (1 << hal.STATUS_FLAG_COMMAND_TIMEOUT))
 
 mc.reinitialize()
 mc.clear_reset_flag()
-mc.set_error_response(motoron.ERROR_RESPONSE_COAST)
+mc.set_error_response(hal.ERROR_RESPONSE_COAST)
 mc.set_error_mask(error_mask)
 mc.set_command_timeout_milliseconds(500)
 mc.set_max_acceleration(1, 100)
@@ -105,22 +104,17 @@ def check_for_problems():
 # Rotary Encoder Setup
 ENCODER_A = 24
 ENCODER_B = 25
-position = 0
 ENCODER_GAIN = 0.01127088464 # NOT TUNED YET.
 
-
-def callback(way):
-    global position
-    position += way
-
-pi = pigpio.pi()
-pi.set_mode(ENCODER_A, pigpio.INPUT)
-pi.set_mode(ENCODER_B, pigpio.INPUT)
-pi.set_pull_up_down(ENCODER_A, pigpio.PUD_UP)
-pi.set_pull_up_down(ENCODER_B, pigpio.PUD_UP)
+pi = hal.gpio()
+pi.set_mode(ENCODER_A, hal.INPUT)
+pi.set_mode(ENCODER_B, hal.INPUT)
+pi.set_pull_up_down(ENCODER_A, hal.PUD_UP)
+pi.set_pull_up_down(ENCODER_B, hal.PUD_UP)
 pi.set_glitch_filter(ENCODER_A, 100)  # 100 μs
 pi.set_glitch_filter(ENCODER_B, 100)
-decoder = rotary_encoder.decoder(pi, ENCODER_A, ENCODER_B, callback)
+decoder = rotary_encoder.decoder(pi, ENCODER_A, ENCODER_B)
+encoder = decoder.counter
 
 
 # PID Controller Setup
@@ -166,7 +160,8 @@ try:
     while True:
         loop_start = time.time()
         check_for_problems()
-        current_position = position * ENCODER_GAIN
+        count, _ = encoder.snapshot()
+        current_position = count * ENCODER_GAIN
         error = abs(target_position - current_position)
         #print(f"Error: {error}")
 
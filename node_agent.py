@@ -0,0 +1,198 @@
+"""Runs one node's share of the central schedule (see schedule_server.py).
+
+Every sync the agent sends the results collected since the last sync in
+one batch and pulls the node's tasks for the next lookahead window. The
+window and unsent results are kept in a cache file, so the node keeps
+watering and moving through a server outage or an agent restart, and
+reports everything once the server is back.
+
+Several agents can run on one machine for testing, each in its own
+directory with its own --node, racks file and WHEATGRASS_HAL=mock.
+"""
+
+import argparse
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+import automation_logging
+import hal
+import heartbeat
+import persistence
+import racks
+import resources
+import sampling_profiler
+import schedule_server
+from Schedule_Runner import RackWorker
+
+log = logging.getLogger("node_agent")
+
+LOOKAHEAD = 6 * 3600  # s of upcoming tasks to keep cached
+SYNC_INTERVAL = 5.0  # s
+TIME_FORMAT = schedule_server.TIME_FORMAT
+
+
+class TaskCache:
+    """Upcoming tasks and unsent results. Saves are coalesced; only the
+    set of dispatched tasks is written through, so a crash never runs a
+    task twice."""
+
+    def __init__(self, path, flush_interval=persistence.FLUSH_INTERVAL):
+        self.path = path
+        self.lock = threading.Lock()
+        self.writer = persistence.WriteCoalescer(flush_interval, category="cache")
+        self.tasks = {}  # id -> task
+        self.dispatched = set()
+        self.results = []
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        self.tasks = {t["id"]: t for t in saved.get("tasks", [])}
+        self.dispatched = set(saved.get("dispatched", []))
+        self.results = saved.get("results", [])
+        # Tasks that were running when the agent stopped are reported, not rerun
+        reported = {r["id"] for r in self.results}
+        for task_id in sorted(self.dispatched - reported):
+            self.results.append({"id": task_id, "status": "interrupted", "error": None,
+                                 "started": None, "finished": time.time()})
+
+    def save(self, sync=False):
+        with self.lock:
+            state = {"tasks": list(self.tasks.values()), "dispatched": sorted(self.dispatched),
+                     "results": list(self.results)}
+            self.writer.write(self.path, json.dumps(state), sync)
+
+    def replace_window(self, tasks):
+        """Take the server's view of the window. Tasks already dispatched
+        here stay dispatched until the server acknowledges their result."""
+        with self.lock:
+            self.tasks = {t["id"]: t for t in tasks}
+            self.dispatched &= set(self.tasks) | {r["id"] for r in self.results}
+
+    def due(self, now):
+        stamp = now.strftime(TIME_FORMAT)
+        with self.lock:
+            due = [t for t in self.tasks.values() if t["time"] <= stamp and t["id"] not in self.dispatched]
+            self.dispatched.update(t["id"] for t in due)
+        due.sort(key=lambda t: t["time"])
+        return due
+
+    def add_result(self, result):
+        with self.lock:
+            self.results.append(result)
+
+    def take_results(self):
+        with self.lock:
+            return list(self.results)
+
+    def acknowledge(self, results):
+        sent = {r["id"] for r in results}
+        with self.lock:
+            self.results = [r for r in self.results if r["id"] not in sent]
+            for task_id in sent:
+                self.tasks.pop(task_id, None)
+
+
+class NodeAgent:
+    def __init__(self, node, server, config, cache, lookahead=LOOKAHEAD, sync_interval=SYNC_INTERVAL):
+        self.node = node
+        self.server = server
+        self.config = config
+        self.cache = cache
+        self.lookahead = lookahead
+        self.sync_interval = sync_interval
+        self.online = None
+        self.pi = hal.gpio()
+        self.stop = threading.Event()
+        self.outputs = resources.ResourceManager(self.pi)
+        self.workers = {name: RackWorker(rack, self.stop, self.outputs, self.task_done)
+                        for name, rack in config.racks.items()}
+
+    def task_done(self, task, status, error):
+        self.cache.add_result({"id": task["id"], "status": status, "error": error,
+                               "started": task.get("started"), "finished": time.time()})
+        self.cache.save()
+
+    def sync(self):
+        results = self.cache.take_results()
+        until = datetime.now() + timedelta(seconds=self.lookahead)
+        try:
+            with schedule_server.Connection(self.server) as conn:
+                if results:
+                    conn.request({"op": "results", "node": self.node, "results": results})
+                    self.cache.acknowledge(results)
+                reply = conn.request({"op": "pull", "node": self.node, "until": until.strftime(TIME_FORMAT)})
+        except (OSError, RuntimeError, ValueError) as e:
+            if self.online is not False:
+                log.warning("Schedule server %s unreachable, running from cache: %s", self.server, e)
+            self.online = False
+            return False
+        if self.online is False:
+            log.info("Schedule server %s reachable again", self.server)
+        self.online = True
+        self.cache.replace_window(reply["tasks"])
+        self.cache.save()
+        return True
+
+    def dispatch(self, now):
+        due = self.cache.due(now)
+        if due:
+            self.cache.save(sync=True)
+        for task in due:
+            task = dict(task, time=datetime.strptime(task["time"], TIME_FORMAT), started=time.time())
+            try:
+                rack, device = self.config.resolve(task["device"])
+            except KeyError:
+                log.info("No device for task: %s", task, extra={"task_id": task["id"]})
+                self.task_done(task, "skipped", "unknown device")
+                continue
+            self.workers[rack.name].queue.put((task, device))
+
+    def run(self):
+        for worker in self.workers.values():
+            worker.start()
+        alive = heartbeat.Heartbeat(f"agent-{self.node}")
+        next_sync = 0
+        try:
+            while True:
+                alive.beat()
+                if time.monotonic() >= next_sync:
+                    self.sync()
+                    next_sync = time.monotonic() + self.sync_interval
+                self.dispatch(datetime.now())
+                time.sleep(0.05)
+        except KeyboardInterrupt:
+            log.info("Stopping")
+            self.stop.set()
+            for worker in self.workers.values():
+                worker.shutdown()
+            self.outputs.close()
+            self.cache.save(sync=True)
+            self.pi.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Node agent for the central schedule server")
+    parser.add_argument("--node", required=True)
+    parser.add_argument("--server", default=schedule_server.DEFAULT_ADDRESS,
+                        help="host:port or Unix socket path")
+    parser.add_argument("--racks", default=None, help="rack configuration (default racks.json)")
+    parser.add_argument("--cache", default=None, help="cache file (default agent_<node>_cache.json)")
+    parser.add_argument("--lookahead", type=float, default=LOOKAHEAD, help="seconds")
+    parser.add_argument("--sync-interval", type=float, default=SYNC_INTERVAL, help="seconds")
+    args = parser.parse_args()
+
+    automation_logging.setup_logging(f"agent-{args.node}")
+    sampling_profiler.install(f"agent-{args.node}")
+    cache = TaskCache(args.cache or f"agent_{args.node}_cache.json")
+    agent = NodeAgent(args.node, args.server, racks.load_racks(args.racks), cache,
+                      args.lookahead, args.sync_interval)
+    agent.run()
+
+
+if __name__ == "__main__":
+    main()
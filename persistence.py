@@ -0,0 +1,180 @@
+"""Write policy for state kept on the SD card.
+
+Small files that change often (the node agent's cache, history rows)
+go through a WriteCoalescer: updates are kept in memory and written
+once per flush interval, and on close(). Whole-file writes always go to
+a temporary file that is fsynced and renamed over the old one, so a
+crash or power cut leaves either the previous or the new version, never
+a torn file. What a crash can lose is bounded by the interval; state
+that must not be lost is written with sync=True.
+
+STATS counts the bytes this process writes per category, so the write
+rate of a running install can be read from the metrics or the hourly
+log line.
+"""
+
+import atexit
+import logging
+import os
+import tempfile
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = float(os.environ.get("WHEATGRASS_FLUSH_INTERVAL", 30.0))  # s
+REPORT_INTERVAL = 3600.0  # s between write-rate log lines
+
+
+class WriteStats:
+    """Bytes and writes per category since the process started."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.bytes = {}
+        self.writes = {}
+
+    def add(self, category, nbytes):
+        with self.lock:
+            self.bytes[category] = self.bytes.get(category, 0) + nbytes
+            self.writes[category] = self.writes.get(category, 0) + 1
+
+    @property
+    def total(self):
+        with self.lock:
+            return sum(self.bytes.values())
+
+    def per_hour(self):
+        """Average bytes written per hour, by category."""
+        hours = max(time.monotonic() - self.started, 1.0) / 3600
+        with self.lock:
+            return {category: n / hours for category, n in self.bytes.items()}
+
+
+STATS = WriteStats()
+
+
+def _fsync_dir(path):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path, data, sync=True, category="other"):
+    """Replace path with data (str or bytes) via a temporary file. With
+    sync the data and the rename are on the card when this returns. The
+    temporary file has a unique name, so processes writing the same path
+    at once never share one; the last rename wins."""
+    if isinstance(data, str):
+        data = data.encode()
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=name + ".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            os.fchmod(f.fileno(), 0o644)
+            f.write(data)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    if sync:
+        _fsync_dir(path)
+    STATS.add(category, len(data))
+    return len(data)
+
+
+class WriteCoalescer:
+    """Batches whole-file writes and appends, flushed every interval.
+
+    write() keeps only the latest contents per path and skips a flush
+    if they equal what is already on disk; append() buffers until the
+    next flush and writes each file's pending data in one call.
+    """
+
+    def __init__(self, interval=FLUSH_INTERVAL, category="state"):
+        self.interval = interval
+        self.category = category
+        self.cond = threading.Condition()
+        self.flush_lock = threading.Lock()  # keeps flushes of the same path in order
+        self.files = {}  # path -> latest contents
+        self.appends = {}  # path -> bytearray
+        self.written = {}  # path -> contents last written
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="persistence", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, path, data, sync=False):
+        """Set the contents of path. sync writes it (and everything else
+        pending for it) before returning."""
+        if isinstance(data, str):
+            data = data.encode()
+        with self.cond:
+            self.files[path] = data
+        if sync:
+            self.flush(path)
+
+    def append(self, path, data):
+        if isinstance(data, str):
+            data = data.encode()
+        with self.cond:
+            self.appends.setdefault(path, bytearray()).extend(data)
+
+    def flush(self, path=None):
+        """Write everything pending (only path's if given)."""
+        with self.flush_lock:
+            with self.cond:
+                if path is None:
+                    files, self.files = self.files, {}
+                    appends, self.appends = self.appends, {}
+                else:
+                    files = {path: self.files.pop(path)} if path in self.files else {}
+                    appends = {path: self.appends.pop(path)} if path in self.appends else {}
+            for p, data in appends.items():
+                with open(p, "ab") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                STATS.add(self.category, len(data))
+            for p, data in files.items():
+                if self.written.get(p) == data:
+                    continue
+                atomic_write(p, data, category=self.category)
+                self.written[p] = data
+
+    def _run(self):
+        next_report = time.monotonic() + REPORT_INTERVAL
+        while True:
+            with self.cond:
+                if self.closed:
+                    return
+                self.cond.wait(self.interval)
+                if self.closed:
+                    return
+            try:
+                self.flush()
+            except OSError:
+                log.exception("Flush failed")
+            if time.monotonic() >= next_report:
+                next_report += REPORT_INTERVAL
+                rates = ", ".join(f"{c} {n / 1024:.1f}" for c, n in sorted(STATS.per_hour().items()))
+                log.info("KiB written per hour: %s", rates or "none")
+
+    def close(self):
+        """Stop the background thread and flush. Writes made after close()
+        are flushed by the next close(), which also runs at exit."""
+        with self.cond:
+            was_closed, self.closed = self.closed, True
+            self.cond.notify_all()
+        if not was_closed:
+            self.thread.join(1.0)
+        self.flush()
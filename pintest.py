@@ -1,14 +1,14 @@
 
 
-import pigpio
+import hal
 import time
 
 VALVE_1 = 18
 VALVE_2 = 27
-pi = pigpio.pi()
+pi = hal.gpio()
 
-pi.set_mode(VALVE_1, pigpio.OUTPUT)
-pi.set_mode(VALVE_2, pigpio.OUTPUT)
+pi.set_mode(VALVE_1, hal.OUTPUT)
+pi.set_mode(VALVE_2, hal.OUTPUT)
 
 # Turn them on/off
 try:
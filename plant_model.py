@@ -0,0 +1,244 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+
+import numpy as np
+from scipy.signal import coherence, csd, welch
+
+MODEL_DIR = "models"
+MODEL_VERSION = 1  # bump when the model structure or fit changes, invalidates the cache
+
+# FRF.py drives with this amplitude and reports gain per full-amplitude input.
+FRF_AMPLITUDE = 800
+
+
+class PlantModel:
+    """Motor + integrator + dead time: G(s) = K e^(-sT) / (s (tau s + 1)).
+
+    Input is the Motoron speed command, output is encoder counts.
+    """
+
+    def __init__(self, K, tau, delay, axis="motor1", source_hash=None, residual=None):
+        self.K = K
+        self.tau = tau
+        self.delay = delay
+        self.axis = axis
+        self.source_hash = source_hash
+        self.residual = residual
+
+    def __repr__(self):
+        return f"PlantModel(axis={self.axis}, K={self.K:.4g}, tau={self.tau:.4g} s, delay={self.delay * 1000:.1f} ms)"
+
+    def response(self, freqs):
+        s = 2j * np.pi * np.asarray(freqs, dtype=float)
+        return self.K * np.exp(-s * self.delay) / (s * (self.tau * s + 1))
+
+    def ultimate(self):
+        """Return (Ku, Pu) for proportional control in speed units per count,
+        from the frequency where the phase lag reaches 180 degrees."""
+        lag = lambda w: np.arctan(w * self.tau) + w * self.delay - np.pi / 2
+        lo, hi = 1e-3, 1e-3
+        while lag(hi) < 0:
+            hi *= 2
+            if hi > 1e6:
+                return None, None
+        for _ in range(60):
+            mid = np.sqrt(lo * hi)
+            if lag(mid) < 0:
+                lo = mid
+            else:
+                hi = mid
+        wu = np.sqrt(lo * hi)
+        Ku = 1 / abs(self.response(wu / (2 * np.pi)))
+        return Ku, 2 * np.pi / wu
+
+    def simulate(self, u, dt, y0=0.0):
+        """Encoder counts for the command sequence u held for dt each."""
+        u = np.asarray(u, dtype=float)
+        lag = int(round(self.delay / dt))
+        delayed = np.concatenate([np.zeros(lag), u])[:len(u)]
+        a = np.exp(-dt / self.tau)
+        v = 0.0
+        y = np.empty(len(u))
+        pos = y0
+        for k, uk in enumerate(delayed):
+            v = a * v + (1 - a) * self.K * uk
+            pos += v * dt
+            y[k] = pos
+        return y
+
+    def simulate_pid(self, Kp, Ki, Kd, target, dt=0.05, duration=10.0,
+                     output_limit=800, deadband=15, encoder_gain=1.0):
+        """Closed-loop step response with the controllers' PID structure.
+        Gains are positive and per unit of encoder_gain * counts, like the
+        controllers; the output is negated for a plant with negative K."""
+        sign = 1 if self.K > 0 else -1
+        n = int(duration / dt)
+        lag = int(round(self.delay / dt))
+        a = np.exp(-dt / self.tau)
+        pending = [0.0] * lag
+        v = pos = integral = last_error = 0.0
+        trace = np.empty(n)
+        for k in range(n):
+            error = target - pos * encoder_gain
+            integral += error * dt
+            out = sign * (Kp * error + Ki * integral + Kd * (error - last_error) / dt)
+            last_error = error
+            out = max(min(out, output_limit), -output_limit)
+            if abs(out) < deadband:
+                out = 0
+            pending.append(out)
+            v = a * v + (1 - a) * self.K * pending.pop(0)
+            pos += v * dt
+            trace[k] = pos * encoder_gain
+        return trace
+
+    def to_dict(self):
+        return {"version": MODEL_VERSION, "axis": self.axis, "K": self.K, "tau": self.tau,
+                "delay": self.delay, "source_hash": self.source_hash, "residual": self.residual}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["K"], d["tau"], d["delay"], d.get("axis", "motor1"),
+                   d.get("source_hash"), d.get("residual"))
+
+
+def read_frf_csv(path):
+    """Frequency, gain, phase (deg) and weight from FRF.py output.
+    The coherence column is used as the weight when present."""
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    freqs = np.array([float(r["frequency_hz"]) for r in rows])
+    gain = np.array([float(r["gain"]) for r in rows])
+    phase = np.array([float(r["phase_deg"]) for r in rows])
+    if rows and "coherence" in rows[0]:
+        weight = np.array([float(r["coherence"]) for r in rows])
+    else:
+        weight = np.ones(len(rows))
+    return freqs, gain, phase, weight
+
+
+def frf_from_capture(path, f0=0.2, f1=20.0, nperseg=1024):
+    """Frequency response from a raw capture saved by FRF.py --capture
+    (uniformly sampled input u and count y at rate fs)."""
+    data = np.load(path)
+    fs, u, y = float(data["fs"]), data["u"], data["y"]
+    nperseg = min(nperseg, len(u))
+    f, Puu = welch(u, fs, nperseg=nperseg, detrend="linear")
+    _, Puy = csd(u, y, fs, nperseg=nperseg, detrend="linear")
+    _, Cuy = coherence(u, y, fs, nperseg=nperseg, detrend="linear")
+    band = (f >= f0) & (f <= f1) & (Puu > 0)
+    H = Puy[band] / Puu[band]
+    return f[band], np.abs(H) * FRF_AMPLITUDE, np.rad2deg(np.angle(H)), Cuy[band]
+
+
+def fit_model(freqs, gain, phase_deg, weight=None, axis="motor1",
+              taus=np.logspace(-3, 1, 400)):
+    """Fit K, tau and delay by least squares on log gain and phase.
+
+    For every candidate tau at once, log K and the delay are linear least
+    squares problems with closed-form solutions, so the whole fit is a few
+    array operations. The tau with the lowest combined residual wins. The
+    sign of K is chosen from whichever phase branch fits better.
+    """
+    order = np.argsort(freqs)
+    f = np.asarray(freqs, dtype=float)[order]
+    g = np.asarray(gain, dtype=float)[order]
+    ph = np.unwrap(np.deg2rad(np.asarray(phase_deg, dtype=float)[order]))
+    W = np.ones_like(f) if weight is None else np.asarray(weight, dtype=float)[order]
+
+    w = 2 * np.pi * f
+    tw = taus[:, None] * w[None, :]
+
+    L = np.log(g) + np.log(w)
+    M = 0.5 * np.log1p(tw ** 2)
+    logK = (W * (L + M)).sum(axis=1) / W.sum()
+    mag_res = (W * (L + M - logK[:, None]) ** 2).sum(axis=1)
+
+    best = None
+    for sign, offset in ((1, 0.0), (-1, np.pi)):
+        r = ph[None, :] + np.pi / 2 + np.arctan(tw) - offset
+        r -= 2 * np.pi * np.round(r[:, :1] / (2 * np.pi))  # align the 2*pi branch
+        T = np.clip(-(W * w * r).sum(axis=1) / (W * w * w).sum(), 0, None)
+        ph_res = (W * (r + w[None, :] * T[:, None]) ** 2).sum(axis=1)
+        total = mag_res + ph_res
+        i = int(np.argmin(total))
+        if best is None or total[i] < best[0]:
+            best = (total[i], sign, i, T[i])
+
+    residual, sign, i, T = best
+    K = sign * np.exp(logK[i]) / FRF_AMPLITUDE
+    return PlantModel(float(K), float(taus[i]), float(T), axis, residual=float(residual))
+
+
+def source_hash(path, axis):
+    h = hashlib.sha256()
+    h.update(f"v{MODEL_VERSION}:{axis}:".encode())
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            h.update(block)
+    return h.hexdigest()[:16]
+
+
+def model_path(axis, digest=None):
+    name = f"{axis}-{digest}.json" if digest else f"{axis}.json"
+    return os.path.join(MODEL_DIR, name)
+
+
+def _write_model(path, model):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(model.to_dict(), f, indent=2)
+    os.replace(tmp, path)
+
+
+def identify(source, axis="motor1"):
+    """Fit (or load from cache) the model for a CSV or capture file.
+
+    Models are cached under models/ by a hash of the source contents, and
+    the most recent one per axis is also written to models/<axis>.json so
+    load_model() works without the source.
+    """
+    digest = source_hash(source, axis)
+    cached = model_path(axis, digest)
+    if os.path.exists(cached):
+        model = load_model(axis, digest)
+    else:
+        if source.endswith(".npz"):
+            freqs, gain, phase, weight = frf_from_capture(source)
+        else:
+            freqs, gain, phase, weight = read_frf_csv(source)
+        model = fit_model(freqs, gain, phase, weight, axis)
+        model.source_hash = digest
+        _write_model(cached, model)
+    _write_model(model_path(axis), model)
+    return model
+
+
+def load_model(axis="motor1", digest=None):
+    with open(model_path(axis, digest)) as f:
+        data = json.load(f)
+    if data.get("version") != MODEL_VERSION:
+        raise ValueError(f"Model for {axis} was fitted by an older version, re-run plant_model.py")
+    return PlantModel.from_dict(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit a plant model from FRF results")
+    parser.add_argument("source", nargs="?", default="frequency_response_gain_phase.csv",
+                        help="FRF.py CSV or raw .npz capture")
+    parser.add_argument("--axis", default="motor1")
+    args = parser.parse_args()
+
+    model = identify(args.source, args.axis)
+    print(model)
+    Ku, Pu = model.ultimate()
+    if Ku:
+        print(f"Ultimate gain {Ku:.4g} per count, period {Pu:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
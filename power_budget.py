@@ -0,0 +1,114 @@
+"""Shared power budget for the motors of one rack.
+
+The controllers of a rack's motors run their moves at the same time and
+share the supply through a small memory-mapped file in the run
+directory (Rack.power_file). Each controller owns one slot. Every
+control cycle it publishes the speed its PID asks for, then reads the
+other slots and scales its own command so the rack stays inside its
+budget (Rack.power):
+
+- speed_budget caps the sum of the commanded speeds. If the motors ask
+  for more, every motor gets the same fraction of what it asked for.
+- current_budget caps the sum of the measured motor currents, in
+  Motoron processed current-sense units. vin_sag_mv is a VIN below
+  which the supply is treated as overloaded. Both are sampled every
+  SAMPLE_INTERVAL. While either is exceeded the supply factor drops;
+  once both are clear it recovers gradually.
+
+Slots that have not been updated for STALE_AFTER seconds belong to a
+stopped or paused controller and are ignored.
+"""
+
+import mmap
+import os
+import struct
+import time
+
+# requested speed, commanded speed, current, VIN mV, updated (monotonic s)
+_SLOT = struct.Struct("<5d")
+SLOTS = 8
+STALE_AFTER = 1.0  # s
+SAMPLE_INTERVAL = 0.5  # s between current/VIN samples while moving
+MIN_FACTOR = 0.2  # the supply factor never throttles a move below this
+RECOVERY = 0.1  # supply factor regained per sample once the supply is clear
+
+
+class PowerShare:
+    def __init__(self, path, slot, budget):
+        if not 0 <= slot < SLOTS:
+            raise ValueError(f"power slot {slot} out of range")
+        self.slot = slot
+        self.speed_budget = budget.get("speed_budget") or 0
+        self.current_budget = budget.get("current_budget") or 0
+        self.vin_sag_mv = budget.get("vin_sag_mv") or 0
+        self.requested = 0.0
+        self.commanded = 0.0
+        self.current = 0.0
+        self.vin_mv = 0.0
+        self.supply_factor = 1.0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < _SLOT.size * SLOTS:
+                os.ftruncate(fd, _SLOT.size * SLOTS)
+            self.map = mmap.mmap(fd, _SLOT.size * SLOTS)
+        finally:
+            os.close(fd)
+
+    def _write(self):
+        _SLOT.pack_into(self.map, self.slot * _SLOT.size, self.requested, self.commanded,
+                        self.current, self.vin_mv, time.monotonic())
+
+    def others(self):
+        """(requested, commanded, current, VIN) of the other live slots."""
+        now = time.monotonic()
+        result = []
+        for i in range(SLOTS):
+            if i == self.slot:
+                continue
+            *fields, updated = _SLOT.unpack_from(self.map, i * _SLOT.size)
+            if updated and now - updated < STALE_AFTER:
+                result.append(fields)
+        return result
+
+    def sample(self, current=None, vin_mv=None):
+        """Record a supply reading and adjust the supply factor."""
+        if current is not None:
+            self.current = abs(current)
+        if vin_mv is not None:
+            self.vin_mv = vin_mv
+        others = self.others()
+        total_current = self.current + sum(o[2] for o in others)
+        vins = [v for v in [self.vin_mv] + [o[3] for o in others] if v]
+        over = 1.0
+        if self.current_budget and total_current > self.current_budget:
+            over = self.current_budget / total_current
+        if self.vin_sag_mv and vins and min(vins) < self.vin_sag_mv:
+            over = min(over, 0.8)
+        if over < 1.0:
+            self.supply_factor = max(MIN_FACTOR, self.supply_factor * over)
+        else:
+            self.supply_factor = min(1.0, self.supply_factor + RECOVERY)
+        self._write()
+
+    def limit(self, speed):
+        """The speed to command instead of speed, given the other motors."""
+        self.requested = abs(speed)
+        factor = self.supply_factor
+        if self.speed_budget:
+            demand = self.requested + sum(o[0] for o in self.others())
+            if demand > self.speed_budget:
+                factor *= self.speed_budget / demand
+        limited = int(speed * factor)
+        self.commanded = abs(limited)
+        self._write()
+        return limited
+
+    def idle(self):
+        """Publish that this motor is not moving (but still alive)."""
+        self.requested = self.commanded = self.current = 0.0
+        self._write()
+
+    def close(self):
+        self.idle()
+        self.map.close()
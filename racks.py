@@ -0,0 +1,189 @@
+import json
+import os
+
+import metrics
+
+RACKS_FILE = os.environ.get("WHEATGRASS_RACKS",
+                            os.path.join(os.path.dirname(os.path.abspath(__file__)), "racks.json"))
+
+# The original single-rack wiring, used when there is no racks.json.
+DEFAULT_CONFIG = {
+    "racks": {
+        "rack1": {
+            "fan": 18,
+            "valves": {"valve1": 17, "valve2": 27},
+            "motors": {
+                "motor1": {"i2c_bus": 3, "address": 16, "channel": 1,
+                           "encoder_a": 24, "encoder_b": 25, "script": "motor1_control.py"},
+                "motor2": {"i2c_bus": 3, "address": 16, "channel": 2,
+                           "encoder_a": 26, "encoder_b": 21, "script": "motor2_control.py"},
+            },
+        },
+    },
+}
+
+# Shared motor supply of a rack, see power_budget.py. A rack's "power"
+# entry overrides these.
+POWER_DEFAULTS = {
+    "concurrent_moves": True,  # False moves one motor of the rack at a time
+    "speed_budget": 1000,  # sum of the commanded speeds of the rack's motors
+    "current_budget": 0,  # sum of processed current-sense readings, 0 = no limit
+    "vin_sag_mv": 0,  # slow down while VIN is below this, 0 = no limit
+}
+
+# tmpfs, so the runner-to-controller target mailbox never touches the SD card
+RUN_DIR = os.environ.get("WHEATGRASS_RUN_DIR", "/dev/shm/wheatgrass")
+
+METRICS_PORT_BASE = 9100  # racks after the first get 9100 + 10 * index + axis number
+
+
+class Axis:
+    """One motor of a rack.
+
+    id names everything the controller process owns: its heartbeat,
+    target, parameter and checkpoint files, log and metrics port. For
+    the first rack it is the bare axis name, so a single-rack install
+    keeps its existing files.
+    """
+
+    def __init__(self, rack, name, index, spec):
+        self.rack = rack
+        self.name = name
+        self.index = index
+        self.device = f"{rack.name}/{name}"
+        self.id = name if rack.index == 0 else f"{rack.name}-{name}"
+        self.i2c_bus = spec.get("i2c_bus", 3)
+        self.address = spec.get("address", 16)
+        self.channel = spec["channel"]
+        self.encoder_a = spec["encoder_a"]
+        self.encoder_b = spec["encoder_b"]
+        self.script = spec["script"]
+        self.args = [] if rack.index == 0 else ["--rack", rack.name]
+        if "metrics_port" in spec:
+            self.metrics_port = spec["metrics_port"]
+        elif rack.index == 0 and name in metrics.PORTS:
+            self.metrics_port = metrics.PORTS[name]
+        else:
+            self.metrics_port = METRICS_PORT_BASE + 10 * rack.index + index + 1
+
+    @property
+    def target_file(self):
+        return os.path.join(RUN_DIR, f"{self.id}_target.txt")
+
+    def read_target(self):
+        """The pending target, or 0 when there is none."""
+        try:
+            with open(self.target_file) as f:
+                return float(f.read().strip())
+        except (OSError, ValueError):
+            return 0
+
+    def write_target(self, value):
+        os.makedirs(RUN_DIR, exist_ok=True)
+        tmp = self.target_file + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(str(value))
+        os.replace(tmp, self.target_file)  # the controller never reads a partial value
+
+    @property
+    def command_socket(self):
+        return os.path.join(RUN_DIR, f"{self.id}.sock")
+
+    @property
+    def board_file(self):
+        """Power-cycle epoch of the Motoron, shared by the axes on it."""
+        return os.path.join(RUN_DIR, f"motoron-{self.i2c_bus}-{self.address}.epoch")
+
+    @property
+    def params_file(self):
+        return f"{self.id}_params.json"
+
+    @property
+    def state_file(self):
+        return f"{self.id}_state.bin"
+
+    def matches(self, cmdline):
+        """True if cmdline is this axis' controller process."""
+        for i, arg in enumerate(cmdline):
+            if os.path.basename(arg) == self.script:
+                return cmdline[i + 1:] == self.args
+        return False
+
+
+class Rack:
+    def __init__(self, name, index, spec):
+        self.name = name
+        self.index = index
+        self.fan = spec["fan"]
+        self.valves = dict(spec.get("valves", {}))
+        self.power = dict(POWER_DEFAULTS, **spec.get("power", {}))
+        self.motors = {}
+        for i, (axis, motor) in enumerate(spec.get("motors", {}).items()):
+            self.motors[axis] = Axis(self, axis, i, motor)
+
+    @property
+    def power_file(self):
+        return os.path.join(RUN_DIR, f"{self.name}_power.bin")
+
+    def devices(self):
+        return list(self.motors) + list(self.valves)
+
+
+class RackConfig:
+    def __init__(self, config):
+        self.racks = {}
+        for i, (name, spec) in enumerate(config["racks"].items()):
+            if "/" in name:
+                raise ValueError(f"rack name {name!r} must not contain '/'")
+            self.racks[name] = Rack(name, i, spec)
+        if not self.racks:
+            raise ValueError("no racks configured")
+        self.default = next(iter(self.racks.values()))
+        self._check_pins()
+
+    def _check_pins(self):
+        used = {}
+        for rack in self.racks.values():
+            pins = [("fan", rack.fan)] + list(rack.valves.items())
+            pins += [(f"{a.name} encoder", p) for a in rack.motors.values() for p in (a.encoder_a, a.encoder_b)]
+            for device, pin in pins:
+                owner = f"{rack.name}/{device}"
+                # Racks may share a fan; the resource manager reference-counts it
+                if device == "fan" and used.get(pin, "").endswith("/fan"):
+                    continue
+                if pin in used:
+                    raise ValueError(f"GPIO {pin} used by both {used[pin]} and {owner}")
+                used[pin] = owner
+
+    def resolve(self, device):
+        """Split "rackN/device" into (Rack, device). Un-namespaced names
+        belong to the first rack. Raises KeyError for unknown devices."""
+        rack_name, sep, local = device.rpartition("/")
+        rack = self.racks[rack_name] if sep else self.default
+        if local not in rack.motors and local not in rack.valves:
+            raise KeyError(device)
+        return rack, local
+
+    def axes(self):
+        return [axis for rack in self.racks.values() for axis in rack.motors.values()]
+
+    def axis(self, rack_name, name):
+        rack = self.racks[rack_name] if rack_name else self.default
+        return rack.motors[name]
+
+    def device_names(self):
+        """Names for the schedule editor: bare names for a single rack,
+        rackN/device once there are several."""
+        if len(self.racks) == 1:
+            return self.default.devices()
+        return [f"{rack.name}/{d}" for rack in self.racks.values() for d in rack.devices()]
+
+
+def load_racks(path=None):
+    path = path or RACKS_FILE
+    try:
+        with open(path) as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        config = DEFAULT_CONFIG
+    return RackConfig(config)
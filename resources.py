@@ -0,0 +1,173 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import hal
+
+log = logging.getLogger(__name__)
+
+MIN_DWELL = 2.0  # s a relay stays in a state before it may switch back (the fan; valves use 0)
+FAN_LINGER = 5.0  # s the fan waits after its last user before switching back
+
+
+class Output:
+    """A GPIO output that is active while anyone holds it."""
+
+    def __init__(self, pin, active, linger, min_dwell):
+        self.pin = pin
+        self.active = active
+        self.linger = linger
+        self.min_dwell = min_dwell
+        self.holders = 0
+        self.on = False
+        self.last_switch = float("-inf")
+        self.due = None  # monotonic time of the next switch, if one is pending
+        self.switches = 0
+
+
+class ResourceManager:
+    """Reference-counted shared outputs such as the fan and valves.
+
+    acquire() and release() count users per pin; the pin is switched to
+    its active level when the first user arrives and back when the last
+    one leaves. A pin released and re-acquired within its linger time,
+    or held by overlapping users, stays on for one continuous span. No
+    relay switches again within min_dwell of its last switch; such
+    changes are deferred, not dropped. A hold's duration counts from the
+    call, not from the deferred switch, so outputs that time waterings
+    are registered with min_dwell 0. hold() acquires for a duration
+    and is released by the manager's timer thread, so callers never
+    sleep through a watering.
+    """
+
+    def __init__(self, pi, min_dwell=MIN_DWELL, on_switch=None):
+        self.pi = pi
+        self.min_dwell = min_dwell
+        self.on_switch = on_switch
+        self.outputs = {}
+        self.holds = []  # heap of (release time, seq, pins, callback)
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="resources", daemon=True)
+        self.thread.start()
+
+    def register(self, pin, active=1, linger=0.0, min_dwell=None):
+        with self.cond:
+            if pin in self.outputs:
+                return self.outputs[pin]
+            out = self.outputs[pin] = Output(pin, active, linger,
+                                             self.min_dwell if min_dwell is None else min_dwell)
+            self.pi.set_mode(pin, hal.OUTPUT)
+            self.pi.write(pin, 1 - active)
+            return out
+
+    def _schedule(self, out, now, delay=0.0):
+        want = out.holders > 0
+        if want == out.on:
+            out.due = None
+        else:
+            out.due = max(now + delay, out.last_switch + out.min_dwell)
+
+    def _apply(self, now):
+        """Switch every output whose change is due; returns the next due time."""
+        next_due = None
+        for out in self.outputs.values():
+            if out.due is None:
+                continue
+            if out.due <= now:
+                out.on = out.holders > 0
+                self.pi.write(out.pin, out.active if out.on else 1 - out.active)
+                out.last_switch = now
+                out.switches += 1
+                out.due = None
+                if self.on_switch is not None:
+                    self.on_switch(out.pin, out.on)
+                self.cond.notify_all()
+            elif next_due is None or out.due < next_due:
+                next_due = out.due
+        return next_due
+
+    def acquire(self, pins):
+        with self.cond:
+            now = time.monotonic()
+            for pin in pins:
+                out = self.outputs[pin]
+                out.holders += 1
+                self._schedule(out, now)
+            self._apply(now)
+            self.cond.notify_all()
+
+    def release(self, pins):
+        with self.cond:
+            now = time.monotonic()
+            for pin in pins:
+                out = self.outputs[pin]
+                out.holders -= 1
+                if out.holders < 0:
+                    raise RuntimeError(f"GPIO {pin} released more often than acquired")
+                self._schedule(out, now, out.linger)
+            self._apply(now)
+            self.cond.notify_all()
+
+    def hold(self, pins, seconds, on_release=None):
+        """Acquire pins now and release them after seconds."""
+        pins = list(pins)
+        self.acquire(pins)
+        with self.cond:
+            heapq.heappush(self.holds, (time.monotonic() + seconds, next(self.seq), pins, on_release))
+            self.cond.notify_all()
+
+    def busy(self, pins):
+        with self.cond:
+            return any(self.outputs[p].holders or self.outputs[p].on for p in pins)
+
+    def wait_idle(self, pins, stop=None):
+        """Block until pins are released and switched off (or stop is set)."""
+        with self.cond:
+            while any(self.outputs[p].holders or self.outputs[p].on for p in pins):
+                if self.closed or (stop is not None and stop.is_set()):
+                    return False
+                self.cond.wait(0.5)
+        return True
+
+    def _run(self):
+        while True:
+            callbacks = []
+            with self.cond:
+                if self.closed:
+                    return
+                now = time.monotonic()
+                while self.holds and self.holds[0][0] <= now:
+                    _, _, pins, callback = heapq.heappop(self.holds)
+                    for pin in pins:
+                        out = self.outputs[pin]
+                        out.holders -= 1
+                        self._schedule(out, now, out.linger)
+                    if callback is not None:
+                        callbacks.append(callback)
+                next_due = self._apply(now)
+                if self.holds and (next_due is None or self.holds[0][0] < next_due):
+                    next_due = self.holds[0][0]
+                if not callbacks:
+                    self.cond.wait(None if next_due is None else max(0.0, next_due - now))
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception:
+                    log.exception("Release callback failed")
+
+    def close(self):
+        """Switch everything to its inactive level immediately."""
+        with self.cond:
+            self.closed = True
+            self.holds.clear()
+            for out in self.outputs.values():
+                out.holders = 0
+                out.on = False
+                out.due = None
+                self.pi.write(out.pin, 1 - out.active)
+            self.cond.notify_all()
+        self.thread.join(1.0)
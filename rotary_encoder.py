@@ -1,25 +1,98 @@
 #!/usr/bin/env python
 
-import pigpio
+import os
+import threading
+import time
+
+import numpy as np
+import hal
+
+class counter:
+
+   """
+   Encoder count shared between the pigpio callback thread and
+   the control loop.  Every read-modify-write happens under one
+   short lock, so a rebase from the control loop can never lose
+   edges counted concurrently by the callback thread.
+   """
+
+   def __init__(self, count=0):
+
+      self._lock = threading.Lock()
+      self._count = count
+      self._tick = None
+      self._edges = 0
+
+   def add(self, delta, tick=None, edges=1):
+
+      """
+      Add delta counts observed at pigpio tick (microseconds).
+      """
+
+      with self._lock:
+         self._count += delta
+         self._edges += edges
+         if tick is not None:
+            self._tick = tick
+
+   def snapshot(self):
+
+      """
+      Return (count, tick) of the last counted edge atomically.
+      tick is None until the first edge has been seen.
+      """
+
+      with self._lock:
+         return self._count, self._tick
+
+   def rebase(self, offset):
+
+      """
+      Subtract offset from the count atomically and return the
+      new count.  Used to move the origin after a settled move.
+      """
+
+      with self._lock:
+         self._count -= offset
+         return self._count
+
+   def set(self, count):
+
+      """
+      Overwrite the count atomically.
+      """
+
+      with self._lock:
+         self._count = count
+
+   @property
+   def edges(self):
+
+      """
+      Total number of counted edges since creation.
+      """
+
+      return self._edges
 
 class decoder:
 
    """Class to decode mechanical rotary encoder pulses."""
 
-   def __init__(self, pi, gpioA, gpioB, callback):
+   def __init__(self, pi, gpioA, gpioB, callback=None):
 
       """
       Instantiate the class with the pi and gpios connected to
       rotary encoder contacts A and B.  The common contact
-      should be connected to ground.  The callback is
-      called when the rotary encoder is turned.  It takes
-      one parameter which is +1 for clockwise and -1 for
+      should be connected to ground.  Counts are kept in
+      self.counter.  The optional callback is also called
+      when the rotary encoder is turned.  It takes one
+      parameter which is +1 for clockwise and -1 for
       counterclockwise.
 
       EXAMPLE
 
       import time
-      import pigpio
+      import hal
 
       import rotary_encoder
 
@@ -33,7 +106,7 @@ class decoder:
 
          print("pos={}".format(pos))
 
-      pi = pigpio.pi()
+      pi = hal.gpio()
 
       decoder = rotary_encoder.decoder(pi, 7, 8, callback)
 
@@ -49,20 +122,21 @@ class decoder:
       self.gpioA = gpioA
       self.gpioB = gpioB
       self.callback = callback
+      self.counter = counter()
 
       self.levA = 0
       self.levB = 0
 
       self.lastGpio = None
 
-      self.pi.set_mode(gpioA, pigpio.INPUT)
-      self.pi.set_mode(gpioB, pigpio.INPUT)
+      self.pi.set_mode(gpioA, hal.INPUT)
+      self.pi.set_mode(gpioB, hal.INPUT)
 
-      self.pi.set_pull_up_down(gpioA, pigpio.PUD_UP)
-      self.pi.set_pull_up_down(gpioB, pigpio.PUD_UP)
+      self.pi.set_pull_up_down(gpioA, hal.PUD_UP)
+      self.pi.set_pull_up_down(gpioB, hal.PUD_UP)
 
-      self.cbA = self.pi.callback(gpioA, pigpio.EITHER_EDGE, self._pulse)
-      self.cbB = self.pi.callback(gpioB, pigpio.EITHER_EDGE, self._pulse)
+      self.cbA = self.pi.callback(gpioA, hal.EITHER_EDGE, self._pulse)
+      self.cbB = self.pi.callback(gpioB, hal.EITHER_EDGE, self._pulse)
 
    def _pulse(self, gpio, level, tick):
 
@@ -92,10 +166,16 @@ class decoder:
 
          if   gpio == self.gpioA and level == 1:
             if self.levB == 1:
-               self.callback(1)
+               self._count(1, tick)
          elif gpio == self.gpioB and level == 1:
             if self.levA == 1:
-               self.callback(-1)
+               self._count(-1, tick)
+
+   def _count(self, way, tick):
+
+      self.counter.add(way, tick)
+      if self.callback is not None:
+         self.callback(way)
 
    def cancel(self):
 
@@ -106,10 +186,191 @@ class decoder:
       self.cbA.cancel()
       self.cbB.cancel()
 
+class batch_decoder:
+
+   """
+   Decode rotary encoder pulses from the pigpio notification pipe.
+
+   Instead of one callback per edge, pigpiod level reports are
+   read from /dev/pigpioN in bulk, decoded with a state table in
+   one numpy pass and the callback is called once per block with
+   the net movement.  Counting matches decoder exactly, so the
+   two are interchangeable.  The pipe is local to the pigpiod
+   host, so this only works on the Pi itself.
+   """
+
+   REPORT = np.dtype([("seq", "<u2"), ("flags", "<u2"),
+                      ("tick", "<u4"), ("level", "<u4")])
+
+   # Edge codes for the state table.
+   EDGE_A, EDGE_B, EDGE_ILLEGAL = 0, 1, 2
+
+   def __init__(self, pi, gpioA, gpioB, callback=None, interval=0.005,
+                start=True):
+
+      """
+      Instantiate the class with the pi and gpios connected to
+      rotary encoder contacts A and B.  Counts are kept in
+      self.counter, which is updated once per block.  The
+      optional callback takes one parameter, the net count
+      since the previous block.  The
+      reader sleeps interval seconds between reads so that edges
+      accumulate into larger blocks.  With start=False the
+      notification pipe is not opened and reports are only
+      decoded when passed to decode(), e.g. from a recording.
+      """
+
+      self.pi = pi
+      self.gpioA = gpioA
+      self.gpioB = gpioB
+      self.callback = callback
+      self.interval = interval
+      self.counter = counter()
+
+      self.illegal = 0
+
+      self.pi.set_mode(gpioA, hal.INPUT)
+      self.pi.set_mode(gpioB, hal.INPUT)
+
+      self.pi.set_pull_up_down(gpioA, hal.PUD_UP)
+      self.pi.set_pull_up_down(gpioB, hal.PUD_UP)
+
+      self.mask = (1 << gpioA) | (1 << gpioB)
+      self.lastLevel = self.pi.read_bank_1() & self.mask
+      self.lastCode = self.EDGE_ILLEGAL
+
+      self.table = self._state_table()
+
+      self.running = False
+      if start:
+         self.start()
+
+   def start(self):
+
+      """
+      Open the notification pipe and start the reader thread.
+      """
+
+      self.handle = self.pi.notify_open()
+      self.pipe = open("/dev/pigpio{}".format(self.handle), "rb", buffering=0)
+      self.pi.notify_begin(self.handle, self.mask)
+
+      self.running = True
+      self.thread = threading.Thread(target=self._run, daemon=True)
+      self.thread.start()
+
+   @classmethod
+   def _state_table(cls):
+
+      """
+      Build the delta lookup indexed by
+      (previous edge code, edge code, level A, level B).
+
+      Mirrors decoder._pulse: a rising A with B high is +1 and a
+      rising B with A high is -1, unless the previous edge was on
+      the same gpio (debounce).  After an illegal transition the
+      next edge is always accepted.
+      """
+
+      table = np.zeros((3, 3, 2, 2), dtype=np.int64)
+      for prev in range(3):
+         if prev != cls.EDGE_A:
+            table[prev, cls.EDGE_A, 1, 1] = 1
+         if prev != cls.EDGE_B:
+            table[prev, cls.EDGE_B, 1, 1] = -1
+      return table.ravel()
+
+   def decode(self, reports):
+
+      """
+      Decode a block of notification reports into the counter and
+      return the net count.  Keep-alive and watchdog reports are
+      ignored.
+      """
+
+      events = reports[reports["flags"] == 0]
+      levels = events["level"] & self.mask
+      if len(levels) == 0:
+         return 0
+
+      prev = np.empty_like(levels)
+      prev[0] = self.lastLevel
+      prev[1:] = levels[:-1]
+      changed = levels ^ prev
+
+      edges = changed != 0
+      changed = changed[edges]
+      levels = levels[edges]
+      ticks = events["tick"][edges]
+      if len(levels) == 0:
+         return 0
+
+      chA = (changed >> self.gpioA) & 1
+      chB = (changed >> self.gpioB) & 1
+      codes = np.where(chA & chB, self.EDGE_ILLEGAL,
+                       np.where(chA, self.EDGE_A, self.EDGE_B))
+
+      prevCodes = np.empty_like(codes)
+      prevCodes[0] = self.lastCode
+      prevCodes[1:] = codes[:-1]
+
+      levA = (levels >> self.gpioA) & 1
+      levB = (levels >> self.gpioB) & 1
+
+      index = ((prevCodes * 3 + codes) * 2 + levA) * 2 + levB
+      deltas = self.table[index]
+      counted = np.flatnonzero(deltas)
+      net = int(deltas.sum())
+
+      self.illegal += int(np.count_nonzero(codes == self.EDGE_ILLEGAL))
+      self.lastLevel = int(levels[-1])
+      self.lastCode = int(codes[-1])
+
+      if len(counted):
+         self.counter.add(net, int(ticks[counted[-1]]), len(counted))
+
+      return net
+
+   def _run(self):
+
+      size = self.REPORT.itemsize
+      pending = b""
+
+      while self.running:
+         try:
+            chunk = os.read(self.pipe.fileno(), 65536)
+         except OSError:
+            break
+         if not chunk:
+            break
+
+         pending += chunk
+         whole = len(pending) - len(pending) % size
+         if whole:
+            net = self.decode(np.frombuffer(pending[:whole], dtype=self.REPORT))
+            pending = pending[whole:]
+            if net and self.callback is not None:
+               self.callback(net)
+
+         time.sleep(self.interval)
+
+   def cancel(self):
+
+      """
+      Cancel the rotary encoder decoder.
+      """
+
+      if not self.running:
+         return
+      self.running = False
+      self.pi.notify_close(self.handle)
+      self.thread.join(1.0)
+      self.pipe.close()
+
 if __name__ == "__main__":
 
    import time
-   import pigpio
+   import hal
 
    import rotary_encoder
 
@@ -123,7 +384,7 @@ if __name__ == "__main__":
 
       print("pos={}".format(pos))
 
-   pi = pigpio.pi()
+   pi = hal.gpio()
 
    decoder = rotary_encoder.decoder(pi, 7, 8, callback)
 
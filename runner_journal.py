@@ -0,0 +1,149 @@
+"""Append-only journal of what the runner is doing, for crash recovery.
+
+Every dispatched task gets an intent record, then start and end records
+as it runs, one short JSON object per line:
+
+    {"e": "intent", "n": 7, "time": 1735718400, "device": "valve1", "action": "on", "value": 60.0}
+    {"e": "start", "n": 7, "at": 1735718400.4}
+    {"e": "start", "n": 8, "at": 1735718460.5, "move": "20250101T080100-motor1.3"}
+    {"e": "end", "n": 7, "at": 1735718460.4, "status": "done"}
+    {"e": "mark", "time": 1735718400}
+
+A move's start record names the move id the controller knows it by, so
+a restarted runner can find out whether the move is still running.
+A mark carries the latest dispatched time across a compaction, so the
+journal alone tells the runner how far the schedule has been run.
+
+Intents are fsynced, since they decide what runs after a restart; start
+and end records only need to survive a crash of the runner, not of the
+Pi, because a power loss releases the outputs anyway. replay() reads
+the file once and returns the tasks that never ended; compact()
+rewrites the file with only those, so it stays a few lines long.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+import persistence
+
+log = logging.getLogger(__name__)
+
+JOURNAL_FILE = "runner_journal.jsonl"
+
+
+class Journal:
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.open = {}  # n -> {"intent": record, "start": record or None}
+        self.next_n = 1
+        self.last_scheduled = None  # epoch of the latest intent
+        self.fd = None
+
+    def replay(self):
+        """Load the journal. Returns the entries that never ended, oldest
+        first, as (task, started) with started None if the task never
+        began. Call once, before logging anything."""
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            lines = []
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # a line torn by the crash
+            if record["e"] == "mark":
+                self.last_scheduled = max(self.last_scheduled or record["time"], record["time"])
+                continue
+            n = record["n"]
+            self.next_n = max(self.next_n, n + 1)
+            if record["e"] == "intent":
+                self.open[n] = {"intent": record, "start": None}
+                self.last_scheduled = max(self.last_scheduled or record["time"], record["time"])
+            elif record["e"] == "start" and n in self.open:
+                self.open[n]["start"] = record
+            elif record["e"] == "end":
+                self.open.pop(n, None)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        entries = []
+        for n, entry in sorted(self.open.items()):
+            intent = entry["intent"]
+            task = {"time": datetime.fromtimestamp(intent["time"]), "device": intent["device"],
+                    "action": intent["action"], "value": intent["value"], "journal": n}
+            if entry["start"] and "move" in entry["start"]:
+                task["move_id"] = entry["start"]["move"]
+            entries.append((task, entry["start"]["at"] if entry["start"] else None))
+        return entries
+
+    def _append(self, records, sync=False):
+        if self.fd is None:
+            return  # closed; a late callback during shutdown
+        data = "".join(json.dumps(r, separators=(",", ":")) + "\n" for r in records).encode()
+        os.write(self.fd, data)
+        if sync:
+            os.fsync(self.fd)
+        persistence.STATS.add("journal", len(data))
+
+    def intent(self, tasks, through=None):
+        """Record that tasks are being dispatched and number them. through
+        is the schedule time dispatching has reached, if later than the
+        tasks (e.g. skipped markers)."""
+        with self.lock:
+            records = []
+            for task in tasks:
+                task["journal"] = n = self.next_n
+                self.next_n += 1
+                record = {"e": "intent", "n": n, "time": int(task["time"].timestamp()),
+                          "device": task["device"], "action": task["action"], "value": task["value"]}
+                self.open[n] = {"intent": record, "start": None}
+                records.append(record)
+                self.last_scheduled = max(self.last_scheduled or record["time"], record["time"])
+            if through is not None and (self.last_scheduled is None or through > self.last_scheduled):
+                self.last_scheduled = through
+                records.append({"e": "mark", "time": through})
+            if records:
+                self._append(records, sync=True)
+
+    def start(self, task):
+        n = task.get("journal")
+        with self.lock:
+            if n not in self.open or self.open[n]["start"] is not None:
+                return  # a resumed task keeps its first start
+            record = {"e": "start", "n": n, "at": task.get("started", time.time())}
+            if "move_id" in task:
+                record["move"] = task["move_id"]
+            self.open[n]["start"] = record
+            self._append([record])
+
+    def end(self, task, status):
+        n = task.get("journal")
+        with self.lock:
+            if self.open.pop(n, None) is None:
+                return
+            self._append([{"e": "end", "n": n, "at": time.time(), "status": status}])
+
+    def compact(self):
+        """Rewrite the journal with only the entries that are still open."""
+        with self.lock:
+            records = [{"e": "mark", "time": self.last_scheduled}] if self.last_scheduled else []
+            for n, entry in sorted(self.open.items()):
+                records.append(entry["intent"])
+                if entry["start"]:
+                    records.append(entry["start"])
+            data = "".join(json.dumps(r, separators=(",", ":")) + "\n" for r in records)
+            persistence.atomic_write(self.path, data, category="journal")
+            os.close(self.fd)
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.fsync(self.fd)
+                os.close(self.fd)
+                self.fd = None
@@ -0,0 +1,122 @@
+"""Sampling profiler for the long-running processes, toggled by signals.
+
+    kill -USR1 <pid>    start sampling every thread
+    kill -USR2 <pid>    stop and write logs/profile-<component>-<pid>-<time>.folded
+
+or `python sampling_profiler.py <pid> --seconds 30` to do both. The
+output is one collapsed stack per line ("thread;outer;inner count"),
+the input format of flamegraph.pl and speedscope. While not sampling
+the profiler is only a pair of signal handlers; while sampling, a
+background thread reads sys._current_frames() every interval, which
+includes the pigpio callback and notification threads.
+"""
+
+import argparse
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+import automation_logging
+import persistence
+
+log = logging.getLogger(__name__)
+
+INTERVAL = 0.005  # s between samples
+MAX_DURATION = 600.0  # s, sampling stops by itself after this long
+
+
+def _frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Sampler:
+    def __init__(self, component, interval=INTERVAL, directory=None, max_duration=MAX_DURATION):
+        self.component = component
+        self.interval = interval
+        self.directory = directory or automation_logging.LOG_DIR
+        self.max_duration = max_duration
+        self.stopping = threading.Event()
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Ask the sampler to stop; it writes its file from its own thread."""
+        self.stopping.set()
+
+    def _run(self):
+        own = threading.get_ident()
+        counts = collections.Counter()  # (thread name, code objects root first) -> samples
+        samples = 0
+        names = {}
+        start = time.monotonic()
+        log.info("Sampling every %.1f ms", self.interval * 1000)
+        while not self.stopping.wait(self.interval):
+            frames = sys._current_frames()
+            if frames.keys() - names.keys():
+                names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                counts[(names.get(ident, str(ident)), tuple(reversed(stack)))] += 1
+            samples += 1
+            if time.monotonic() - start > self.max_duration:
+                log.warning("Sampling stopped after the %.0f s limit", self.max_duration)
+                break
+        elapsed = time.monotonic() - start
+        name = f"profile-{self.component}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded"
+        path = os.path.join(self.directory, name)
+        lines = collections.Counter()
+        for (thread, codes), n in counts.items():
+            lines[";".join([thread] + [_frame_name(c) for c in codes])] += n
+        os.makedirs(self.directory, exist_ok=True)
+        persistence.atomic_write(path, "".join(f"{stack} {n}\n" for stack, n in lines.most_common()),
+                                 sync=False, category="profile")
+        log.info("Wrote %d samples over %.1f s (%.0f Hz) to %s", samples, elapsed,
+                 samples / elapsed if elapsed else 0, path)
+
+
+_sampler = None
+
+
+def install(component, interval=INTERVAL, directory=None):
+    """Start sampling on SIGUSR1 and stop on SIGUSR2. Call from the main thread."""
+    global _sampler
+    _sampler = Sampler(component, interval, directory)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: _sampler.start())
+    signal.signal(signal.SIGUSR2, lambda signum, frame: _sampler.stop())
+    return _sampler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile a running process for a while")
+    parser.add_argument("pid", type=int)
+    parser.add_argument("--seconds", type=float, default=30.0)
+    args = parser.parse_args()
+    os.kill(args.pid, signal.SIGUSR1)
+    try:
+        time.sleep(args.seconds)
+    finally:
+        os.kill(args.pid, signal.SIGUSR2)
+    print(f"Profile of {args.pid} written to {automation_logging.LOG_DIR}")
+
+
+if __name__ == "__main__":
+    main()
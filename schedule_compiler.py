@@ -0,0 +1,279 @@
+"""Compiled schedule: automation_schedule.csv validated once and stored
+as a time-sorted array for the runner and editor to memory-map.
+
+Layout: a fixed header, the device/action name tables as JSON, then
+fixed-width records (int64 epoch seconds, float64 value, uint16 device
+id, uint16 action id), 8-byte aligned. The header carries the size and
+mtime of the CSV it was compiled from, so load() recompiles only after
+the CSV has been edited.
+
+The CSV stays the file people and Scheduler.py edit. The runner no
+longer deletes finished rows from it; it keeps the time of the last
+dispatched task in a cursor file instead. export writes the pending
+tasks back out as CSV (--prune does so in place).
+
+    python schedule_compiler.py compile
+    python schedule_compiler.py export pending.csv
+"""
+
+import argparse
+import csv
+import io
+import json
+import logging
+import math
+import os
+import struct
+from datetime import datetime
+
+import numpy as np
+
+import persistence
+import racks
+
+log = logging.getLogger(__name__)
+
+SCHEDULE_FILE = "automation_schedule.csv"
+MAGIC = b"WGSCHED1"
+HEADER = struct.Struct("<8sIIQqQ")  # magic, names length, reserved, count, source mtime_ns, source size
+TASK = np.dtype([("time", "<i8"), ("value", "<f8"), ("device", "<u2"), ("action", "<u2"), ("pad", "V4")])
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+FIELDNAMES = ["timestamp", "device", "action", "value"]
+
+
+def compiled_path(csv_path):
+    return os.path.splitext(csv_path)[0] + ".bin"
+
+
+def cursor_path(csv_path):
+    return os.path.splitext(csv_path)[0] + ".cursor"
+
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return 0, 0
+    return st.st_mtime_ns, st.st_size
+
+
+def _known_device(config, device):
+    if device == "system" or ":" in device:  # batch markers and other nodes' devices
+        return True
+    try:
+        config.resolve(device)
+    except KeyError:
+        return False
+    return True
+
+
+def compile_schedule(csv_path=SCHEDULE_FILE, out_path=None, config=None):
+    """Validate csv_path and write the compiled file. Invalid rows are
+    logged and left out. Returns the number of tasks written."""
+    data, count = compile_bytes(csv_path, config)
+    persistence.atomic_write(out_path or compiled_path(csv_path), data, category="schedule")
+    return count
+
+
+def compile_bytes(csv_path=SCHEDULE_FILE, config=None):
+    """The compiled file's contents for csv_path, and its task count."""
+    config = config or racks.load_racks()
+    stamp = _stamp(csv_path)
+    names = {"device": [], "action": []}
+    ids = {"device": {}, "action": {}}
+    rows = []
+
+    def name_id(field, name):
+        if name not in ids[field]:
+            ids[field][name] = len(names[field])
+            names[field].append(name)
+        return ids[field][name]
+
+    if os.path.exists(csv_path):
+        with open(csv_path, newline="") as f:
+            for line, row in enumerate(csv.DictReader(f), start=2):
+                try:
+                    when = int(datetime.strptime(row["timestamp"], TIME_FORMAT).timestamp())
+                    value = float(row["value"])
+                    if not math.isfinite(value):
+                        raise ValueError(f"value {row['value']!r} is not finite")
+                    if not row["action"]:
+                        raise ValueError("missing action")
+                    if not _known_device(config, row["device"]):
+                        raise ValueError(f"unknown device {row['device']!r}")
+                except (ValueError, TypeError, KeyError) as e:
+                    log.warning("%s line %d skipped: %s", csv_path, line, e)
+                    continue
+                rows.append((when, value, name_id("device", row["device"]), name_id("action", row["action"])))
+
+    tasks = np.zeros(len(rows), dtype=TASK)
+    if rows:
+        columns = list(zip(*rows))
+        for name, column in zip(("time", "value", "device", "action"), columns):
+            tasks[name] = column
+        tasks = tasks[np.argsort(tasks["time"], kind="stable")]
+
+    names_json = json.dumps(names).encode()
+    header = HEADER.pack(MAGIC, len(names_json), 0, len(tasks), *stamp)
+    padding = b"\0" * (-(len(header) + len(names_json)) % 8)
+    return header + names_json + padding + tasks.tobytes(), len(tasks)
+
+
+class CompiledSchedule:
+    """Read-only, memory-mapped view of a compiled schedule, or a view of
+    compiled data held in memory if data is given."""
+
+    def __init__(self, path, data=None):
+        self.path = path
+        if data is None:
+            with open(path, "rb") as f:
+                head = f.read(HEADER.size)
+                magic, names_len, _, count, mtime_ns, size = HEADER.unpack(head)
+                names_json = f.read(names_len)
+        else:
+            magic, names_len, _, count, mtime_ns, size = HEADER.unpack_from(data)
+            names_json = data[HEADER.size:HEADER.size + names_len]
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a compiled schedule")
+        self.names = json.loads(names_json)
+        self.source_stamp = (mtime_ns, size)
+        offset = HEADER.size + names_len
+        offset += -offset % 8
+        if not count:
+            self.tasks = np.zeros(0, dtype=TASK)
+        elif data is None:
+            self.tasks = np.memmap(path, dtype=TASK, mode="r", offset=offset, shape=(count,))
+        else:
+            self.tasks = np.frombuffer(data, dtype=TASK, count=count, offset=offset)
+        self.times = self.tasks["time"]
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def current(self, csv_path):
+        """False once csv_path has changed since this was compiled."""
+        return self.source_stamp == _stamp(csv_path)
+
+    def after(self, epoch):
+        """Index of the first task later than epoch."""
+        return int(np.searchsorted(self.times, epoch, side="right"))
+
+    def task(self, i):
+        """Task i as a load_schedule()-style dict."""
+        rec = self.tasks[i]
+        return {"time": datetime.fromtimestamp(int(rec["time"])),
+                "device": self.names["device"][rec["device"]],
+                "action": self.names["action"][rec["action"]],
+                "value": float(rec["value"])}
+
+    def pending(self, cursor):
+        return [self.task(i) for i in range(self.after(cursor), len(self))]
+
+
+def load(csv_path=SCHEDULE_FILE, config=None, write=True):
+    """The compiled schedule for csv_path, compiled first if the CSV has
+    changed since the last compile. Only the runner writes the compiled
+    file; readers such as the editor pass write=False and compile a stale
+    schedule in memory instead."""
+    path = compiled_path(csv_path)
+    try:
+        compiled = CompiledSchedule(path)
+    except (FileNotFoundError, ValueError, struct.error):
+        compiled = None
+    if compiled is None or not compiled.current(csv_path):
+        if not write:
+            return CompiledSchedule(path, compile_bytes(csv_path, config)[0])
+        compile_schedule(csv_path, path, config)
+        compiled = CompiledSchedule(path)
+    return compiled
+
+
+def read_cursor(csv_path=SCHEDULE_FILE):
+    """Epoch of the last dispatched task; everything up to it has run."""
+    try:
+        with open(cursor_path(csv_path)) as f:
+            return int(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        return -2**63
+
+
+def write_cursor(epoch, csv_path=SCHEDULE_FILE, writer=None):
+    """Save the cursor now, or through writer (a persistence.WriteCoalescer)
+    if the caller keeps its own durable record of it."""
+    if writer is not None:
+        writer.write(cursor_path(csv_path), str(int(epoch)))
+    else:
+        persistence.atomic_write(cursor_path(csv_path), str(int(epoch)), category="schedule")
+
+
+def load_schedule(path=SCHEDULE_FILE):
+    """All rows of the CSV as task dicts, in file order. Invalid rows are
+    logged and skipped; the file is left as it is."""
+    tasks = []
+    if not os.path.exists(path):
+        return tasks
+    with open(path, newline="") as f:
+        for line, row in enumerate(csv.DictReader(f), start=2):
+            try:
+                tasks.append({"time": datetime.strptime(row["timestamp"], TIME_FORMAT), "device": row["device"],
+                              "action": row["action"], "value": float(row["value"])})
+            except (ValueError, TypeError, KeyError) as e:
+                log.warning("%s line %d skipped: %s", path, line, e)
+    return tasks
+
+
+def save_schedule(path, tasks):
+    out = io.StringIO(newline="")
+    writer = csv.DictWriter(out, fieldnames=FIELDNAMES)
+    writer.writeheader()
+    for task in tasks:
+        writer.writerow({"timestamp": task["time"].strftime(TIME_FORMAT), "device": task["device"],
+                         "action": task["action"], "value": task["value"]})
+    persistence.atomic_write(path, out.getvalue(), category="schedule")
+
+
+def export_csv(compiled, out_path, cursor=None):
+    """Write the tasks after cursor (all tasks if None) as CSV."""
+    start = 0 if cursor is None else compiled.after(cursor)
+    tmp = out_path + ".tmp"
+    with open(tmp, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(FIELDNAMES)
+        for i in range(start, len(compiled)):
+            task = compiled.task(i)
+            writer.writerow([task["time"].strftime(TIME_FORMAT), task["device"], task["action"], task["value"]])
+    os.replace(tmp, out_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile or export the binary schedule")
+    parser.add_argument("--schedule", default=SCHEDULE_FILE)
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("compile", help="validate the CSV and write the compiled schedule")
+    export = sub.add_parser("export", help="write the pending tasks as CSV")
+    export.add_argument("output", nargs="?")
+    export.add_argument("--all", action="store_true", help="include tasks that already ran")
+    export.add_argument("--prune", action="store_true", help="rewrite the schedule CSV with pending tasks only")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if args.command == "compile":
+        count = compile_schedule(args.schedule)
+        print(f"Compiled {count} tasks to {compiled_path(args.schedule)}")
+        return
+
+    compiled = load(args.schedule)
+    cursor = None if args.all else read_cursor(args.schedule)
+    if args.prune:
+        export_csv(compiled, args.schedule, cursor)
+        compile_schedule(args.schedule)
+        pending = len(compiled) if cursor is None else len(compiled) - compiled.after(cursor)
+        print(f"Pruned {args.schedule} to {pending} pending tasks")
+    elif args.output:
+        export_csv(compiled, args.output, cursor)
+    else:
+        parser.error("export needs an output file or --prune")
+
+
+if __name__ == "__main__":
+    main()
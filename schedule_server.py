@@ -0,0 +1,216 @@
+"""Central schedule for several Pis.
+
+The server owns automation_schedule.csv (still edited with
+Schedule_Editor.py and Scheduler.py on the server). Devices are
+addressed as node:rackN/device; devices without a node belong to
+--default-node. Each Pi runs node_agent.py, which pulls its node's
+upcoming tasks and reports results back.
+
+The protocol is one JSON object per line in each direction over TCP
+(host:port) or a Unix socket (a path):
+
+    {"op": "pull", "node": "pi2", "until": "2025-01-01 09:00:00"}
+        -> {"ok": true, "tasks": [{"id", "time", "device", "action", "value"}, ...]}
+    {"op": "results", "node": "pi2", "results": [{"id", "status", "started", "finished", "error"}, ...]}
+        -> {"ok": true, "acked": n}
+
+Tasks stay in the schedule until their result arrives, so an agent that
+restarts or loses its cache simply pulls them again.
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+from datetime import datetime
+
+import automation_logging
+import sampling_profiler
+from Schedule_Runner import task_id
+from schedule_compiler import load_schedule, save_schedule
+
+log = logging.getLogger("schedule_server")
+
+DEFAULT_ADDRESS = "127.0.0.1:9200"
+SCHEDULE_FILE = "automation_schedule.csv"
+RESULTS_FILE = "schedule_results.jsonl"
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def parse_address(address):
+    """A path for a Unix socket, otherwise host:port."""
+    if "/" in address:
+        return socket.AF_UNIX, address
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+
+def connect(address, timeout=5.0):
+    family, addr = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(addr)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+class Connection:
+    """Client side of the line protocol."""
+
+    def __init__(self, address, timeout=5.0):
+        self.sock = connect(address, timeout)
+        self.file = self.sock.makefile("rwb")
+
+    def request(self, message):
+        self.file.write(json.dumps(message).encode() + b"\n")
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError("server closed the connection")
+        reply = json.loads(line)
+        if not reply.get("ok"):
+            raise RuntimeError(reply.get("error", "request failed"))
+        return reply
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ScheduleStore:
+    """The schedule file, reloaded whenever it changes on disk."""
+
+    def __init__(self, path=SCHEDULE_FILE, results_path=RESULTS_FILE, default_node="local"):
+        self.path = path
+        self.results_path = results_path
+        self.default_node = default_node
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.tasks = []
+
+    def _reload(self):
+        try:
+            st = os.stat(self.path)
+            stamp = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            stamp = None
+        if stamp != self.stamp:
+            self.stamp = stamp
+            self.tasks = load_schedule(self.path)
+            self.tasks.sort(key=lambda t: t["time"])
+
+    def split(self, device):
+        node, sep, local = device.partition(":")
+        return (node, local) if sep else (self.default_node, device)
+
+    def window(self, node, until):
+        """Tasks of node due no later than until, oldest first."""
+        with self.lock:
+            self._reload()
+            tasks = []
+            for task in self.tasks:
+                if task["time"] > until:
+                    break
+                owner, device = self.split(task["device"])
+                if owner == node:
+                    tasks.append({"id": task_id(task), "time": task["time"].strftime(TIME_FORMAT),
+                                  "device": device, "action": task["action"], "value": task["value"]})
+            return tasks
+
+    def complete(self, node, results):
+        """Drop finished tasks from the schedule and log their results."""
+        finished = {r["id"] for r in results}
+        with self.lock:
+            self._reload()
+            keep = [t for t in self.tasks
+                    if task_id(t) not in finished or self.split(t["device"])[0] != node]
+            if len(keep) != len(self.tasks):
+                save_schedule(self.path, keep)
+                self.tasks = keep
+                st = os.stat(self.path)
+                self.stamp = (st.st_mtime_ns, st.st_size)
+            with open(self.results_path, "a") as f:
+                for result in results:
+                    f.write(json.dumps(dict(result, node=node)) + "\n")
+        return len(finished)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        store = self.server.store
+        for line in self.rfile:
+            try:
+                message = json.loads(line)
+                op = message.get("op")
+                node = message["node"]
+                if op == "pull":
+                    until = datetime.strptime(message["until"], TIME_FORMAT)
+                    reply = {"ok": True, "tasks": store.window(node, until)}
+                elif op == "results":
+                    acked = store.complete(node, message["results"])
+                    log.info("%d result(s) from %s", acked, node)
+                    reply = {"ok": True, "acked": acked}
+                else:
+                    reply = {"ok": False, "error": f"unknown op {op!r}"}
+            except (ValueError, KeyError, TypeError) as e:
+                reply = {"ok": False, "error": str(e)}
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+            self.wfile.flush()
+
+
+class TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(address, store):
+    family, addr = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(addr):
+            os.remove(addr)
+        server = UnixServer(addr, Handler)
+    else:
+        server = TCPServer(addr, Handler)
+    server.store = store
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Central schedule server for node agents")
+    parser.add_argument("--listen", default=DEFAULT_ADDRESS, help="host:port or Unix socket path")
+    parser.add_argument("--schedule", default=SCHEDULE_FILE)
+    parser.add_argument("--results", default=RESULTS_FILE)
+    parser.add_argument("--default-node", default="local", help="node for devices without a node: prefix")
+    args = parser.parse_args()
+
+    automation_logging.setup_logging("schedule_server", console=True)
+    sampling_profiler.install("schedule_server")
+    store = ScheduleStore(args.schedule, args.results, args.default_node)
+    server = make_server(args.listen, store)
+    log.info("Serving %s on %s", args.schedule, args.listen)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,16 +3,9 @@
 echo "Automation script starting" >> /home/pi/automation_debug.log
 date >> /home/pi/automation_debug.log
 
-# Ensure pigpiod is running
-sudo /usr/bin/pigpiod -s 5
-sleep 3
-
-# Activate environment and launch scripts
+# Activate environment and hand over to the supervisor, which starts
+# pigpiod, the motor controllers and the schedule runner in order and
+# restarts them if they crash. exec keeps it as the systemd main process.
 source /home/pi/motoron_env/bin/activate
-echo "Starting motor and schedule scripts..." >> /home/pi/automation_debug.log
-/home/pi/motoron_env/bin/python3 /home/pi/Schedule_Runner.py >> /home/pi/schedule.log 2>&1 &
-/home/pi/motoron_env/bin/python3 /home/pi/motor1_control.py >> /home/pi/motor1.log 2>&1 &
-/home/pi/motoron_env/bin/python3 /home/pi/motor2_control.py >> /home/pi/motor2.log 2>&1 &
-
-# Keep script alive so systemd doesn't stop it
-tail -f /dev/null
+echo "Starting supervisor..." >> /home/pi/automation_debug.log
+exec /home/pi/motoron_env/bin/python3 /home/pi/supervisor.py >> /home/pi/automation_debug.log 2>&1
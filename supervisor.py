@@ -0,0 +1,199 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import psutil
+
+import heartbeat
+import automation_logging
+import racks
+
+log = automation_logging.setup_logging("supervisor", console=True)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PYTHON = sys.executable
+
+PIGPIOD_CMD = ["sudo", "/usr/bin/pigpiod", "-s", "5"]
+PIGPIOD_ADDR = ("localhost", 8888)
+PIGPIOD_TIMEOUT = 10  # s
+
+READY_TIMEOUT = 15  # s to wait for a first heartbeat before starting dependents anyway
+BACKOFF_START = 1.0
+BACKOFF_MAX = 60.0
+STABLE_AFTER = 60.0  # a child running this long gets its backoff reset
+STOP_TIMEOUT = 5.0
+POLL_INTERVAL = 0.2
+
+
+def components(config):
+    """One controller per motor in racks.json, then the runner.
+
+    Started in this order; a component starts once everything it depends
+    on has sent its first heartbeat.
+    """
+    specs = [{"name": axis.id, "script": axis.script, "args": axis.args, "log": f"{axis.id}.log",
+              "after": [], "heartbeat_timeout": 10}
+             for axis in config.axes()]
+    specs.append({"name": "runner", "script": "Schedule_Runner.py", "log": "schedule.log",
+                  "after": [s["name"] for s in specs], "heartbeat_timeout": 30})
+    return specs
+
+
+def pigpiod_ready():
+    try:
+        with socket.create_connection(PIGPIOD_ADDR, timeout=0.2):
+            return True
+    except OSError:
+        return False
+
+
+def ensure_pigpiod():
+    """Start pigpiod if needed and wait until it accepts connections."""
+    if pigpiod_ready():
+        return True
+    log.info("Starting pigpiod")
+    subprocess.run(PIGPIOD_CMD)
+    deadline = time.monotonic() + PIGPIOD_TIMEOUT
+    while time.monotonic() < deadline:
+        if pigpiod_ready():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+class Child:
+    def __init__(self, spec):
+        self.spec = spec
+        self.name = spec["name"]
+        self.proc = None
+        self.started_at = None
+        self.backoff = BACKOFF_START
+        self.restart_at = None
+
+    def start(self):
+        heartbeat.clear(self.name)
+        # Structured logs go to logs/; this only catches crash tracebacks.
+        output = open(os.path.join(BASE_DIR, self.spec["log"]), "ab")
+        env = dict(os.environ, WHEATGRASS_SUPERVISED="1")
+        self.proc = subprocess.Popen([PYTHON, self.spec["script"]] + self.spec.get("args", []), cwd=BASE_DIR,
+                                     stdout=output, stderr=subprocess.STDOUT, env=env)
+        output.close()
+        self.started_at = time.monotonic()
+        self.restart_at = None
+        log.info("Started %s (pid %d)", self.name, self.proc.pid)
+
+    def ready(self):
+        return self.proc is not None and heartbeat.last_beat(self.name) is not None
+
+    def suspended(self):
+        """Schedule_Runner suspends the idle motor controller; a stopped
+        process cannot beat, so it is not judged on its heartbeat."""
+        try:
+            return psutil.Process(self.proc.pid).status() == psutil.STATUS_STOPPED
+        except psutil.Error:
+            return False
+
+    def stale(self):
+        if self.suspended():
+            return False
+        last = heartbeat.last_beat(self.name)
+        timeout = self.spec["heartbeat_timeout"]
+        if last is None:
+            return time.monotonic() - self.started_at > max(timeout, READY_TIMEOUT)
+        return time.time() - last > timeout
+
+    def stop(self):
+        if self.proc is None or self.proc.poll() is not None:
+            return
+        if self.suspended():
+            psutil.Process(self.proc.pid).resume()
+        self.proc.send_signal(signal.SIGINT)  # controllers stop their motor on KeyboardInterrupt
+        try:
+            self.proc.wait(STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+    def schedule_restart(self, reason):
+        ran = time.monotonic() - self.started_at
+        if ran > STABLE_AFTER:
+            self.backoff = BACKOFF_START
+        log.warning("%s %s after %.1f s, restarting in %.1f s", self.name, reason, ran, self.backoff)
+        self.restart_at = time.monotonic() + self.backoff
+        self.backoff = min(self.backoff * 2, BACKOFF_MAX)
+        self.proc = None
+
+
+class Supervisor:
+    def __init__(self, components):
+        self.children = [Child(spec) for spec in components]
+        self.by_name = {c.name: c for c in self.children}
+        self.running = True
+
+    def start_all(self):
+        """Start components in dependency order, waiting only as long as
+        each dependency takes to report its first heartbeat."""
+        for child in self.children:
+            deps = [self.by_name[name] for name in child.spec["after"]]
+            deadline = time.monotonic() + READY_TIMEOUT
+            while self.running and not all(d.ready() for d in deps):
+                if time.monotonic() > deadline:
+                    waiting = [d.name for d in deps if not d.ready()]
+                    log.warning("Starting %s without ready %s", child.name, ", ".join(waiting))
+                    break
+                time.sleep(0.05)
+            if not self.running:
+                return
+            child.start()
+
+    def monitor(self):
+        while self.running:
+            now = time.monotonic()
+            for child in self.children:
+                if child.proc is None:
+                    if child.restart_at is not None and now >= child.restart_at:
+                        child.start()
+                    continue
+                code = child.proc.poll()
+                if code is not None:
+                    child.schedule_restart(f"exited with {code}")
+                elif child.stale():
+                    child.stop()
+                    child.schedule_restart("stopped sending heartbeats")
+            time.sleep(POLL_INTERVAL)
+
+    def stop_all(self, *_):
+        self.running = False
+
+    def shutdown(self):
+        for child in reversed(self.children):
+            child.stop()
+
+
+def main():
+    os.chdir(BASE_DIR)
+    start = time.monotonic()
+
+    if not ensure_pigpiod():
+        log.error("pigpiod did not become ready")
+        sys.exit(1)
+    log.info("pigpiod ready after %.2f s", time.monotonic() - start)
+
+    supervisor = Supervisor(components(racks.load_racks()))
+    signal.signal(signal.SIGTERM, supervisor.stop_all)
+    signal.signal(signal.SIGINT, supervisor.stop_all)
+
+    try:
+        supervisor.start_all()
+        log.info("All components started after %.2f s", time.monotonic() - start)
+        supervisor.monitor()
+    finally:
+        supervisor.shutdown()
+        log.info("Supervisor stopped")
+
+
+if __name__ == "__main__":
+    main()